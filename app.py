@@ -1,13 +1,99 @@
-from flask import Flask, g
-from flask import render_template, request, redirect, url_for
+from flask import Flask, g, Response
+from flask import abort, render_template, request, redirect, url_for
+from flask import before_render_template, template_rendered
+import click
+from contextlib import closing
+import datetime
+import functools
+import hashlib
+import io
+import json
+import os
 import sqlite3
-import unicodedata
+import time
+
+import archive
+import backup
+from cache import LRUCache
+from db import ConnectionPool, begin_immediate, connect, has_table, run_transaction
+import exporter
+import importer
+from metrics import Metrics, TimedConnection, fingerprint
+from refdata import ReferenceData
+import schema
+import shards
+from slowlog import SlowQueryLog, explain
+import stats
+from suggest import Suggester
+from search import (has_search_index, like_pattern, search_index_add,
+                    search_index_delete, search_match)
+from validation import (format_timestamp, has_control_character, now_timestamp,
+                        parse_timestamp, split_ids)
+from writer import GroupCommitWriter
 
 
-app = Flask(__name__)
-
 DATABASE: str = 'sample.db'
 
+app = Flask(__name__)
+app.config.from_mapping(
+    DATABASE=DATABASE,
+    PAGE_SIZE=50,  # 一覧 1 ページあたりの既定件数
+    MAX_PAGE_SIZE=500,  # ?size= で指定できる件数の上限
+    # 接続作成時に適用する PRAGMA
+    SQLITE_PRAGMAS={
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # ミリ秒
+        'cache_size': -65536,  # 負の値は KiB 単位（64 MiB）
+        'mmap_size': 268435456,  # 256 MiB
+    },
+    SQLITE_CACHED_STATEMENTS=256,  # 接続ごとのプリペアドステートメントのキャッシュ数
+    POOL_MAX_AGE=3600,  # この秒数を超えた接続は作り直す
+    POOL_MAX_USES=10000,  # この回数使った接続は作り直す
+    # 図書館ごとのシャード（library-<図書館番号>.db）を置いたディレクトリ
+    # 指定すると DATABASE をカタログとして、蔵書と貸し出し履歴をシャードに分けて持つ
+    # （split-shards で作る。None なら分割しない）
+    SHARD_DIRECTORY=None,
+    # True にすると書き込みを専用スレッドでまとめてコミットし、
+    # リクエストの接続は読み取り専用で開く
+    WRITER_MODE=False,
+    WRITER_MAX_BATCH=64,  # 1 回のコミットにまとめる書き込みの上限
+    WRITER_MAX_WAIT=0.001,  # 後続の書き込みを待つ秒数
+    # 書き込みロックが取れなかった（busy_timeout を過ぎた、または WAL で先を越された）時に
+    # トランザクションを始めからやり直す回数と、最初にやり直すまでの秒数（回数ごとに倍にする）
+    WRITE_RETRIES=5,
+    WRITE_RETRY_BACKOFF=0.01,
+    BOOK_CACHE_SIZE=1024,  # 本の詳細をキャッシュする件数
+    BOOK_CACHE_TTL=60,  # 本の詳細をキャッシュする秒数
+    REFERENCE_DATA_TTL=60,  # マイグレーション前のデータベースで参照データを読み直す間隔（秒）
+    IMPORT_MAX_ERRORS=1000,  # 一括登録の結果画面に表示するエラーの件数
+    EXPORT_CHUNK_SIZE=1000,  # 出力で 1 回に取り出す行数
+    HISTORY_ARCHIVE_DAYS=365,  # 返却からこの日数を過ぎた貸し出し履歴を archive-histories で移す
+    HISTORY_ARCHIVE_BATCH=10000,  # 1 回のトランザクションで移す行数
+    BACKUP_DIRECTORY='backups',  # 管理画面から取るバックアップの置き場所
+    BACKUP_PAGES=256,  # バックアップで 1 ステップに写すページ数
+    BACKUP_PAUSE=0.01,  # バックアップのステップの間に空ける秒数（この間に書き込みが進む）
+    BACKUP_COMPRESS=True,  # 管理画面から取るバックアップを gzip で圧縮する
+    RESULT_PAGE_MAX_AGE=3600,  # 処理結果ページをブラウザにキャッシュさせる秒数
+    STATS_TOP_BOOKS=20,  # 貸し出し統計に表示する、よく借りられた本の件数
+    OVERDUE_DAYS=14,  # 延滞一覧で、貸し出しからこの日数を過ぎた未返却の貸し出しを表示する
+    SUGGEST_LIMIT=10,  # 入力補完で 1 種類あたりに返す件数の既定値
+    SUGGEST_MAX_LIMIT=50,  # ?limit= で指定できる件数の上限
+    SUGGEST_MAX_ENTRIES=1000000,  # 入力補完のインデックスに載せる 1 種類あたりの件数の上限
+    SUGGEST_MAX_KEY_LENGTH=64,  # 入力補完で比べる先頭の文字数（インデックスの大きさを抑える）
+    SUGGEST_REFRESH_INTERVAL=300,  # 他のプロセスによる更新を入力補完へ取り込む間隔（秒）
+    METRICS_ENABLED=True,  # SQL・テンプレート・リクエストの時間を計測して /metrics で出力する
+    SERVER_TIMING=False,  # True にすると計測値を Server-Timing レスポンスヘッダでも返す
+    # この秒数以上かかった SQL を実行計画とともに記録する（None なら記録しない。計測が有効な場合のみ）
+    SLOW_QUERY_THRESHOLD=0.1,
+    SLOW_QUERY_LOG='slow-queries.log',  # 記録先のファイル（None ならファイルには書かない）
+    SLOW_QUERY_LOG_MAX_BYTES=10 * 1024 * 1024,  # このサイズを超えたらローテーションする
+    SLOW_QUERY_LOG_BACKUPS=5,  # 残す古いログファイルの数
+    SLOW_QUERY_MAX_ENTRIES=200,  # 管理画面用に集計する SQL の種類の上限
+)
+# 環境変数 LIBRARY_SETTINGS で指定された設定ファイルがあれば上書きする
+app.config.from_envvar('LIBRARY_SETTINGS', silent=True)
+
 # 処理結果コードとメッセージ
 RESULT_MESSAGES: dict[str, str] = {
     'book-id-has-invalid-charactor':
@@ -48,9 +134,16 @@ RESULT_MESSAGES: dict[str, str] = {
     'author-id-has-invalid-charactor':
     '指定された著者IDには使えない文字があります - '
     '数字のみで指定してください',
+    'author-id-does-not-exist':
+    '指定された著者IDは存在しません - ',
+    'author-id-already-exists':
+    '指定された著者IDは既に存在します - '
+    '存在しない著者IDを指定してください',
     'user-id-has-invalid-charactor':
     '指定されたユーザーIDには使えない文字があります - '
     '数字のみで指定してください',
+    'user-id-does-not-exist':
+    '指定されたユーザーIDは存在しません - ',
     'user-id-already-exists':
     '指定されたユーザーIDは既に存在します - '
     '存在しないユーザーIDを指定してください',
@@ -67,6 +160,21 @@ RESULT_MESSAGES: dict[str, str] = {
     '貸し出し日に制御文字があります。制御文字は使用しないでください',
     'return-time-has-control-charactor':
     '返却日に制御文字があります。制御文字は使用しないでください',
+    'borrow-time-is-invalid':
+    '貸し出し日を日時として読めません - '
+    '2024-04-01 10:30 のように指定してください（空欄なら現在時刻）',
+    'return-time-is-invalid':
+    '返却日を日時として読めません - '
+    '2024-04-01 10:30 のように指定してください（空欄なら現在時刻）',
+    'invalid-record':
+    '読み込めない行です - '
+    'CSV または JSONL の形式を確認してください',
+    'copy-id-is-duplicated':
+    '同じ蔵書IDが複数回指定されています - ',
+    'copy-is-on-loan':
+    '指定された蔵書は貸し出し中です - ',
+    'loan-does-not-exist':
+    '指定された蔵書は貸し出し中ではありません - ',
     'database-error':
     'データベースエラー',
     'book-added':
@@ -90,11 +198,161 @@ RESULT_MESSAGES: dict[str, str] = {
 }
 
 
+def get_pool() -> ConnectionPool:
+    # 接続プールは最初に使われた時点の設定で作成する
+    pool = app.extensions.get('db_pool')
+    if pool is None:
+        if app.config['WRITER_MODE']:
+            # 読み取り専用の接続より先に書き込み用の接続を作り、WAL に切り替えておく
+            get_writer()
+        pool = app.extensions['db_pool'] = ConnectionPool(
+            app.config['DATABASE'],
+            app.config['SQLITE_PRAGMAS'],
+            cached_statements=app.config['SQLITE_CACHED_STATEMENTS'],
+            max_age=app.config['POOL_MAX_AGE'],
+            max_uses=app.config['POOL_MAX_USES'],
+            readonly=app.config['WRITER_MODE'],
+            factory=TimedConnection if app.config['METRICS_ENABLED'] else sqlite3.Connection,
+            shard_directory=app.config['SHARD_DIRECTORY'])
+    return pool
+
+
+def open_db() -> sqlite3.Connection:
+    # 書き込みのできる接続を新しく作る（コマンドや一括登録用。使い終わったら閉じる）
+    return connect(app.config['DATABASE'], app.config['SQLITE_PRAGMAS'],
+                   app.config['SQLITE_CACHED_STATEMENTS'],
+                   shard_directory=app.config['SHARD_DIRECTORY'])
+
+
+def get_writer() -> GroupCommitWriter:
+    writer = app.extensions.get('writer')
+    if writer is None:
+        writer = app.extensions['writer'] = GroupCommitWriter(
+            lambda: connect(app.config['DATABASE'], app.config['SQLITE_PRAGMAS'],
+                            app.config['SQLITE_CACHED_STATEMENTS'], isolation_level=None,
+                            shard_directory=app.config['SHARD_DIRECTORY']),
+            max_batch=app.config['WRITER_MAX_BATCH'],
+            max_wait=app.config['WRITER_MAX_WAIT'],
+            begin=write_begin(),
+            retries=app.config['WRITE_RETRIES'],
+            backoff=app.config['WRITE_RETRY_BACKOFF'],
+            observe=functools.partial(observe_lock_wait, 'group-commit'))
+        writer.start()
+    return writer
+
+
+def write_begin():
+    # 書き込みのトランザクションの始め方
+    # （シャードに分けている場合はカタログ・シャードの順にロックを取る）
+    return begin_immediate if app.config['SHARD_DIRECTORY'] is None else shards.begin_write
+
+
+def observe_lock_wait(label: str, seconds: float, retries: int) -> None:
+    if app.config['METRICS_ENABLED']:
+        metrics = get_metrics()
+        metrics.write_lock_wait.observe(label, seconds)
+        metrics.write_retries.observe(label, retries)
+
+
+def run_write(write):
+    # 書き込み処理 write(cursor) を実行してコミットし、その戻り値を返す
+    # ロックが取れなければ WRITE_RETRIES 回まで write からやり直す（write は何度呼ばれても良いこと）
+    # 失敗した場合は書き込みを取り消し、sqlite3.Error などをそのまま送出する
+    if app.config['WRITER_MODE']:
+        # 書き込み専用スレッドで他のリクエストの書き込みとまとめてコミットする
+        return get_writer().submit(write)
+    return run_transaction(get_db(), write, write_begin(), app.config['WRITE_RETRIES'],
+                           app.config['WRITE_RETRY_BACKOFF'],
+                           lambda seconds, retries: observe_lock_wait(route_label(), seconds,
+                                                                      retries))
+
+
+def get_book_cache() -> LRUCache:
+    # 本の詳細ページのデータのキャッシュ（本番号 -> 詳細）
+    book_cache = app.extensions.get('book_cache')
+    if book_cache is None:
+        book_cache = app.extensions['book_cache'] = LRUCache(
+            app.config['BOOK_CACHE_SIZE'], app.config['BOOK_CACHE_TTL'])
+    return book_cache
+
+
+# 処理結果コードだけで内容が決まるページのテンプレート
+RESULT_TEMPLATES: list[str] = [
+    'book-add-results.html',
+    'copy-add-results.html',
+    'book-del-results.html',
+    'copy-del-results.html',
+    'user-add-results.html',
+    'borrow-add-results.html',
+    'return-add-results.html',
+    'history-del-results.html',
+    'user-del-results.html',
+]
+
+
+def result_page(template: str, code: str) -> Response:
+    # 処理結果ページは初めて使われた時に全テンプレート・全コードの分を描画しておき、
+    # その後はバイト列をそのまま返す（知らないコードはその都度描画する）
+    pages = app.extensions.get('result_pages', {}).get(request.script_root)
+    if pages is None:
+        pages = {}
+        for name in RESULT_TEMPLATES:
+            for result_code, message in RESULT_MESSAGES.items():
+                body = render_template(name, results=message).encode()
+                pages[name, result_code] = (body, hashlib.sha1(body).hexdigest())
+        # アプリケーションのパスごとに持つ（ページ内のリンクが変わるため）
+        app.extensions.setdefault('result_pages', {})[request.script_root] = pages
+    page = pages.get((template, code))
+    if page is None:
+        # codeが存在しなければ'code error 'を返す
+        return app.make_response(render_template(template, results='code error'))
+    body, etag = page
+    response = Response(body, content_type='text/html; charset=utf-8')
+    response.headers['Cache-Control'] = f'public, max-age={app.config["RESULT_PAGE_MAX_AGE"]}'
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+def get_suggester() -> Suggester:
+    # 入力補完用のインデックス（初めて使われた時に全件を読み込む）
+    suggester = app.extensions.get('suggester')
+    if suggester is None:
+        suggester = app.extensions['suggester'] = Suggester(
+            app.config['SUGGEST_MAX_ENTRIES'], app.config['SUGGEST_MAX_KEY_LENGTH'],
+            app.config['SUGGEST_REFRESH_INTERVAL'])
+    suggester.refresh(get_db().cursor())
+    return suggester
+
+
+def loaded_suggester() -> Suggester | None:
+    # 書き込みの後に入力補完のインデックスを直す時に使う
+    # （まだ作っていなければ作らず、全件の読み込みは /suggest が使われるまで遅らせる）
+    return app.extensions.get('suggester')
+
+
+def get_reference_data() -> ReferenceData:
+    # ジャンル・図書館・著者の一覧（更新されていれば 1 リクエストに 1 回だけ読み直す）
+    reference_data = app.extensions.get('reference_data')
+    if reference_data is None:
+        reference_data = app.extensions['reference_data'] = ReferenceData(
+            app.config['REFERENCE_DATA_TTL'])
+    if not g.get('_reference_data_checked'):
+        reference_data.refresh(get_db().cursor())
+        g._reference_data_checked = True
+    return reference_data
+
+
 def get_db() -> sqlite3.Connection:
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row  # カラム名でアクセスできるよう設定変更
+        # スレッドごとの接続をプールから借りる
+        started = time.perf_counter()
+        db = g._database = get_pool().acquire()
+        if isinstance(db, TimedConnection):
+            elapsed = time.perf_counter() - started
+            g._timing_connection = elapsed
+            get_metrics().connection_duration.observe('default', elapsed)
+            db.observer = observe_query
     return db
 
 
@@ -102,11 +360,330 @@ def get_db() -> sqlite3.Connection:
 def close_connection(exception) -> None:
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
-
-
-def has_control_character(s: str) -> bool:
-    return any(map(lambda c: unicodedata.category(c) == 'Cc', s))
+        if isinstance(db, TimedConnection):
+            db.flush()
+            db.observer = None
+        # 接続は閉じずにプールへ返す
+        get_pool().release(db)
+
+
+def get_metrics() -> Metrics:
+    metrics = app.extensions.get('metrics')
+    if metrics is None:
+        metrics = app.extensions['metrics'] = Metrics()
+    return metrics
+
+
+@functools.lru_cache(maxsize=1024)
+def query_fingerprint(sql: str) -> str:
+    return fingerprint(sql)
+
+
+def route_label() -> str:
+    # 計測値のラベルに使うルート名（例: 'GET /books/<id>'）
+    return f'{request.method} {request.url_rule.rule}' if request.url_rule else 'unmatched'
+
+
+def get_slow_query_log() -> SlowQueryLog:
+    slow_query_log = app.extensions.get('slow_query_log')
+    if slow_query_log is None:
+        slow_query_log = app.extensions['slow_query_log'] = SlowQueryLog(
+            app.config['SLOW_QUERY_LOG'],
+            max_bytes=app.config['SLOW_QUERY_LOG_MAX_BYTES'],
+            backup_count=app.config['SLOW_QUERY_LOG_BACKUPS'],
+            max_entries=app.config['SLOW_QUERY_MAX_ENTRIES'])
+    return slow_query_log
+
+
+def observe_query(sql: str, parameters, seconds: float) -> None:
+    # リクエストの接続で実行した SQL 1 つ分の時間（実行と取り出しの合計）
+    g._timing_queries = g.get('_timing_queries', 0) + 1
+    g._timing_sql = g.get('_timing_sql', 0.0) + seconds
+    key = query_fingerprint(sql)
+    get_metrics().query_duration.observe(key, seconds)
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold is not None and seconds >= threshold:
+        route = route_label()
+        plan = explain(g._database, sql, parameters)
+        get_slow_query_log().record(key, sql, parameters, seconds, plan, route)
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra) -> None:
+    g._template_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def observe_template(sender, template, context, **extra) -> None:
+    started = g.pop('_template_started', None)
+    if started is None or not app.config['METRICS_ENABLED']:
+        return
+    elapsed = time.perf_counter() - started
+    g._timing_template = g.get('_timing_template', 0.0) + elapsed
+    get_metrics().template_duration.observe(template.name or '(string)', elapsed)
+
+
+@app.before_request
+def start_request_timer() -> None:
+    g._request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response: Response) -> Response:
+    started = g.get('_request_started')
+    if started is None or not app.config['METRICS_ENABLED']:
+        return response
+    db = g.get('_database')
+    if isinstance(db, TimedConnection):
+        db.flush()  # 最後の SQL の時間を集計に入れる
+    elapsed = time.perf_counter() - started
+    route = route_label()
+    metrics = get_metrics()
+    metrics.request_duration.observe(route, elapsed)
+    metrics.request_queries.observe(route, g.get('_timing_queries', 0))
+    metrics.request_sql_duration.observe(route, g.get('_timing_sql', 0.0))
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = (
+            f'conn;dur={g.get("_timing_connection", 0.0) * 1000:.2f}, '
+            f'db;dur={g.get("_timing_sql", 0.0) * 1000:.2f};'
+            f'desc="{g.get("_timing_queries", 0)} queries", '
+            f'tpl;dur={g.get("_timing_template", 0.0) * 1000:.2f}, '
+            f'total;dur={elapsed * 1000:.2f}')
+    return response
+
+
+def page_size() -> int:
+    # ?size= で 1 ページの件数を指定できる（1 以上、上限まで）
+    size = request.args.get('size', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+
+def fetch_page(cur: sqlite3.Cursor, query: str, key: str,
+               params: tuple = ()) -> tuple[list[sqlite3.Row], dict | None, dict | None]:
+    # キーセット（カーソル）方式で 1 ページ分だけ取得する
+    # query は WHERE 句までを含む SELECT 文、key は並び順に使う一意なカラム
+    # ?after=<key> でそれより後ろ、?before=<key> でそれより前のページを返す
+    size = page_size()
+    column = key.split('.')[-1]
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+
+    if before is not None:
+        # 逆順に size + 1 件取り出し、さらに前のページがあるかを判定する
+        rows = cur.execute(f'{query} AND {key} < ? ORDER BY {key} DESC LIMIT ?',
+                           (*params, before, size + 1)).fetchall()
+        has_prev = len(rows) > size
+        rows = rows[:size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = f'{query} AND {key} > ?'
+            params = (*params, after)
+        rows = cur.execute(f'{query} ORDER BY {key} LIMIT ?',
+                           (*params, size + 1)).fetchall()
+        has_next = len(rows) > size
+        rows = rows[:size]
+        has_prev = after is not None
+
+    prev_args = {'before': rows[0][column]} if rows and has_prev else None
+    next_args = {'after': rows[-1][column]} if rows and has_next else None
+    return rows, prev_args, next_args
+
+
+def fetch_ranked_page(cur: sqlite3.Cursor, query: str,
+                      params: tuple = ()) -> tuple[list[sqlite3.Row], dict | None, dict | None]:
+    # 全文検索の結果を関連度順に 1 ページ分だけ取得する
+    # 関連度は検索語ごとに変わるのでキーセットではなく ?page= で送る
+    # query の最後の 2 つのパラメータに LIMIT と OFFSET の値を渡す
+    # （全文検索の中で件数を絞ってから JOIN できるようにするため）
+    size = page_size()
+    page = max(0, request.args.get('page', 0, type=int))
+    rows = cur.execute(query, (*params, size + 1, page * size)).fetchall()
+    prev_args = {'page': page - 1} if page > 0 else None
+    next_args = {'page': page + 1} if len(rows) > size else None
+    return rows[:size], prev_args, next_args
+
+
+def with_genre_names(rows: list[sqlite3.Row]) -> list[dict]:
+    # ジャンル名は Genre と JOIN せず、メモリ上の参照データから補う
+    genres = get_reference_data().genres
+    return [dict(row, Name=genres.get(row['GenreID'], '')) for row in rows]
+
+
+def with_author_names(cur: sqlite3.Cursor, rows: list[dict]) -> list[dict]:
+    # 一覧の本の著者を 1 回の問い合わせでまとめて取り出し、
+    # 著者名はメモリ上の参照データから補う
+    book_ids = [row['BookID'] for row in rows]
+    authors: dict[int, list[dict]] = {book_id: [] for book_id in book_ids}
+    names = get_reference_data().authors
+    for row in cur.execute('SELECT BookID, AuthorID FROM CoAuthors '
+                           'WHERE BookID IN (SELECT value FROM json_each(?)) '
+                           'ORDER BY BookID, AuthorID', (json.dumps(book_ids),)):
+        authors[row['BookID']].append({'AuthorID': row['AuthorID'],
+                                       'Name': names.get(row['AuthorID'], '')})
+    return [dict(row, Authors=authors[row['BookID']]) for row in rows]
+
+
+def page_urls(prev_args: dict | None, next_args: dict | None,
+              **filters: str) -> tuple[str | None, str | None]:
+    # 前後のページへのリンクを作る
+    # 絞り込み条件と件数指定はリンクに引き継ぐ
+    if 'size' in request.args:
+        filters['size'] = request.args['size']
+    prev_url = None
+    next_url = None
+    if prev_args is not None:
+        prev_url = url_for(request.endpoint, **prev_args, **filters)
+    if next_args is not None:
+        next_url = url_for(request.endpoint, **next_args, **filters)
+    return prev_url, next_url
+
+
+def render_page(template: str, rows: list[sqlite3.Row],
+                prev_args: dict | None, next_args: dict | None,
+                **filters: str) -> str:
+    # 前後のページへのリンクを作り、一覧をテンプレートへ渡す
+    prev_url, next_url = page_urls(prev_args, next_args, **filters)
+    return render_template(template, e_list=rows,
+                           prev_url=prev_url, next_url=next_url)
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search() -> None:
+    # 全文検索インデックスを（無ければ作成して）既存の行から作り直す
+    with closing(open_db()) as con:
+        for statement in schema.split_statements(schema.SCHEMA_SEARCH_INDEXES):
+            con.execute(statement)
+        con.commit()
+
+
+@app.cli.command('migrate')
+def migrate() -> None:
+    # スキーマとインデックスを最新のバージョンまで更新する
+    with closing(open_db()) as con:
+        applied = schema.migrate(con)
+    if applied:
+        click.echo(f'バージョン {applied[-1]} まで更新しました')
+    else:
+        click.echo(f'最新です（バージョン {schema.latest_version()}）')
+
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(sorted(importer.IMPORTERS)))
+@click.argument('file', type=click.File(encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='ファイル形式（省略時は拡張子で判断）')
+@click.option('--batch-size', default=importer.BATCH_SIZE, show_default=True,
+              help='1 回のチェックとコミットで扱う行数')
+def import_data(kind: str, file: io.TextIOBase, fmt: str | None, batch_size: int) -> None:
+    # CSV / JSONL ファイルから本・蔵書・著者・ユーザーを一括登録する
+    if fmt is None:
+        fmt = 'jsonl' if file.name.endswith(('.jsonl', '.json')) else 'csv'
+
+    def report(line_no: int, code: str) -> None:
+        click.echo(f'{line_no} 行目: {code} {RESULT_MESSAGES[code]}', err=True)
+
+    with closing(open_db()) as con:
+        inserted = importer.import_file(con, kind, file, fmt, report, batch_size)
+    click.echo(f'{inserted} 件登録しました')
+
+
+@app.cli.command('export-data')
+@click.argument('kind', type=click.Choice(sorted(exporter.EXPORTS)))
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(sorted(exporter.FORMATS)),
+              help='ファイル形式（省略時は拡張子で判断）')
+@click.option('--gzip', 'use_gzip', is_flag=True, help='gzip で圧縮する')
+@click.option('--chunk-size', type=int, help='1 回に取り出す行数')
+def export_data_command(kind: str, output: io.BufferedWriter, fmt: str | None,
+                        use_gzip: bool, chunk_size: int | None) -> None:
+    # 本・蔵書・ユーザー・貸し出し履歴を CSV / JSONL で出力する（OUTPUT を省略すると標準出力）
+    name = output.name.removesuffix('.gz') if isinstance(output.name, str) else ''
+    if fmt is None:
+        fmt = 'jsonl' if name.endswith(('.jsonl', '.json')) else 'csv'
+    with closing(open_export_db()) as con:
+        for chunk in exporter.export(con, kind, fmt, use_gzip,
+                                     chunk_size or app.config['EXPORT_CHUNK_SIZE']):
+            output.write(chunk)
+
+
+def open_export_db() -> sqlite3.Connection:
+    # 出力専用の読み取り専用の接続（使い終わったら閉じる）
+    return connect(app.config['DATABASE'], app.config['SQLITE_PRAGMAS'], readonly=True,
+                   shard_directory=app.config['SHARD_DIRECTORY'])
+
+
+@app.cli.command('backup')
+@click.argument('destination', type=click.Path())
+@click.option('--gzip', 'use_gzip', is_flag=True, help='gzip で圧縮する（ファイル名に .gz を付ける）')
+@click.option('--pages', type=int, help='1 ステップに写すページ数（省略時は BACKUP_PAGES）')
+@click.option('--pause', type=float, help='ステップの間に空ける秒数（省略時は BACKUP_PAUSE）')
+@click.option('--no-check', is_flag=True, help='写したファイルの integrity_check を省く')
+def backup_command(destination: str, use_gzip: bool, pages: int | None, pause: float | None,
+                   no_check: bool) -> None:
+    # 動いているアプリケーションを止めずに DATABASE を DESTINATION へ写す
+    # （シャードに分けている場合、DESTINATION はカタログとシャードを置くディレクトリ）
+    with closing(open_export_db()) as con:
+        try:
+            files = run_backup(con, destination, use_gzip, pages, pause, not no_check)
+        except (FileExistsError, sqlite3.DatabaseError) as e:
+            raise click.ClickException(str(e))
+    for path in files.values():
+        click.echo(f'{path} に書き出しました')
+
+
+def run_backup(con: sqlite3.Connection, destination: str, compress: bool,
+               pages: int | None = None, pause: float | None = None, check: bool = True,
+               progress: backup.Progress | None = None) -> dict[str, str]:
+    return backup.backup(con, destination,
+                         pages or app.config['BACKUP_PAGES'],
+                         app.config['BACKUP_PAUSE'] if pause is None else pause,
+                         compress, check, progress)
+
+
+@app.cli.command('archive-histories')
+@click.option('--days', type=int, help='返却からの日数（省略時は HISTORY_ARCHIVE_DAYS）')
+@click.option('--batch-size', type=int, help='1 回のトランザクションで移す行数')
+@click.option('--pause', default=0.0, show_default=True,
+              help='トランザクションの間に空ける秒数')
+def archive_histories(days: int | None, batch_size: int | None, pause: float) -> None:
+    # 返却済みの古い貸し出し履歴を HistoriesArchive へ移す
+    cutoff = archive.archive_cutoff(app.config['HISTORY_ARCHIVE_DAYS'] if days is None else days)
+    with closing(open_db()) as con:
+        moved = archive.archive_histories(
+            con, cutoff, batch_size or app.config['HISTORY_ARCHIVE_BATCH'], pause)
+    click.echo(f'{cutoff} より前に返却された {moved} 件を移しました')
+
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats() -> None:
+    # 貸し出し統計を貸し出し履歴から集計し直す
+    with closing(open_db()) as con:
+        run_transaction(con, stats.rebuild, retries=app.config['WRITE_RETRIES'],
+                        backoff=app.config['WRITE_RETRY_BACKOFF'])
+    click.echo('貸し出し統計を集計し直しました')
+
+
+@app.cli.command('split-shards')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--library', 'library_ids', type=int, multiple=True,
+              help='シャードにする図書館番号（複数指定可。省略時は蔵書のある全ての図書館）')
+def split_shards(directory: str, library_ids: tuple[int, ...]) -> None:
+    # DATABASE をカタログと図書館ごとのシャードに分けて DIRECTORY へ書き出す
+    # （元のデータベースは変更しない）
+    if app.config['SHARD_DIRECTORY'] is not None:
+        raise click.ClickException('既に分割されています（SHARD_DIRECTORY が設定されています）')
+    with closing(connect(app.config['DATABASE'], app.config['SQLITE_PRAGMAS'])) as con:
+        if schema.current_version(con) < schema.latest_version():
+            raise click.ClickException('先に migrate で最新のバージョンまで更新してください')
+        try:
+            counts = shards.split_database(con, directory, list(library_ids) or None)
+        except (FileExistsError, ValueError) as e:
+            raise click.ClickException(str(e))
+    for library_id, (copies, histories) in counts.items():
+        click.echo(f'図書館 {library_id}: 蔵書 {copies} 件、貸し出し履歴 {histories} 件')
+    click.echo(f'DATABASE を {os.path.join(directory, shards.CATALOG)}、'
+               f'SHARD_DIRECTORY を {directory} に設定してください')
 
 
 @app.route('/')
@@ -114,99 +691,263 @@ def index():
     return render_template('index.html')
 
 
+# 本の一覧に表示する項目（蔵書数と貸し出し可能な冊数は with_copy_counts で補う）
+BOOK_LIST_COLUMNS = 'b.BookID, b.Title, b.Year, b.GenreID'
+
+
+def with_copy_counts(cur: sqlite3.Cursor, rows: list[dict]) -> list[dict]:
+    # 蔵書数と貸し出し可能な冊数を、ページに表示する行の分だけ 1 回の問い合わせで
+    # インデックス（CopiesBookID, HistoriesOpenLoan）を使って数える
+    # （本番号は json_each ではなくパラメータの並びで渡す。図書館ごとのシャードに分けている
+    #   場合も、条件が各シャードの Copies まで渡ってインデックスで引かれるように）
+    book_ids = [row['BookID'] for row in rows]
+    counts = {row['BookID']: (row['CopyCount'], row['AvailableCount']) for row in cur.execute(
+        'SELECT c.BookID, COUNT(*) AS CopyCount, '
+        'SUM(NOT EXISTS (SELECT 1 FROM Histories h '
+        '                WHERE h.CopyID = c.CopyID AND h.ReturnTime IS NULL)) AS AvailableCount '
+        f'FROM Copies c WHERE c.BookID IN ({", ".join("?" * len(book_ids))}) '
+        'GROUP BY c.BookID', book_ids)}
+    results = []
+    for row in rows:
+        copy_count, available_count = counts.get(row['BookID'], (0, 0))
+        results.append(dict(row, CopyCount=copy_count, AvailableCount=available_count))
+    return results
+
+
 @app.route('/books')
 def books() -> str:
     cur = get_db().cursor()
-    # 図書館が所有する全ての本のタイトルの情報を取得
-    coordinates = 'SELECT  B.BookID, b.Title, b.Year, b.genreID, Genre.Name FROM Books b    ' \
-                  'JOIN Genre ON b.GenreID = Genre.GenreID;'
-    e_list = cur.execute(coordinates).fetchall()
-    return render_template('books.html', e_list=e_list)
+    # 図書館が所有する本のタイトルの情報を 1 ページ分取得
+    coordinates = f'SELECT {BOOK_LIST_COLUMNS} FROM Books b WHERE 1'
+    rows, prev_args, next_args = fetch_page(cur, coordinates, 'b.BookID')
+    rows = with_copy_counts(cur, with_genre_names(rows))
+    return render_page('books.html', rows, prev_args, next_args)
 
 
-@app.route('/books_filtered', methods=['POST'])
+@app.route('/books_filtered', methods=['GET', 'POST'])
 def books_filtered() -> str:
     # データベース接続してカーソルを得る
     con = get_db()
     cur = con.cursor()
 
-    # Books テーブルからタイトルで絞り込み、
-    e_list = cur.execute('SELECT  B.BookID, b.Title, b.Year, b.genreID, Genre.Name FROM Books b '
-                         'JOIN Genre ON b.GenreID = Genre.GenreID WHERE Title LIKE ?;',
-                         (request.form['title_filter'], )).fetchall()
+    # Books テーブルからタイトルで絞り込み、1 ページ分取得
+    # （ページ送りのリンクは GET で絞り込み条件を引き継ぐ）
+    title_filter = request.values['title_filter']
+    match = search_match(title_filter)
+    if match is not None and has_search_index(cur, 'BooksFts'):
+        # 全文検索インデックスから関連度順に取得
+        rows, prev_args, next_args = fetch_ranked_page(
+            cur, f'SELECT {BOOK_LIST_COLUMNS} '
+            'FROM (SELECT rowid, rank FROM BooksFts WHERE BooksFts MATCH ? '
+            '      ORDER BY rank LIMIT ? OFFSET ?) f '
+            'JOIN Books b ON b.BookID = f.rowid ORDER BY f.rank',
+            (match, ))
+    else:
+        rows, prev_args, next_args = fetch_page(
+            cur, f'SELECT {BOOK_LIST_COLUMNS} FROM Books b WHERE Title LIKE ?',
+            'b.BookID', (like_pattern(title_filter), ))
 
     # 一覧をテンプレートへ渡してレンダリングしたものを返す
-    return render_template('books.html', e_list=e_list)
+    rows = with_copy_counts(cur, with_genre_names(rows))
+    return render_page('books.html', rows, prev_args, next_args,
+                       title_filter=title_filter)
 
 
-@app.route('/genres_filtered', methods=['POST'])
+@app.route('/genres_filtered', methods=['GET', 'POST'])
 def genres_filtered() -> str:
     # データベース接続してカーソルを得る
     con = get_db()
     cur = con.cursor()
 
-    # Users テーブルから名前で絞り込み、
-    e_list = cur.execute('SELECT  B.BookID, b.Title, b.Year, b.genreID, Genre.Name FROM Books b '
-                         'JOIN Genre ON b.GenreID = Genre.GenreID WHERE Genre.GenreID LIKE ?;',
-                         (request.form['genre_filter'], )).fetchall()
+    # Books テーブルからジャンルで絞り込み、1 ページ分取得
+    genre_filter = request.values['genre_filter']
+    rows, prev_args, next_args = fetch_page(
+        cur, f'SELECT {BOOK_LIST_COLUMNS} FROM Books b WHERE b.GenreID LIKE ?',
+        'b.BookID', (genre_filter, ))
     # 一覧をテンプレートへ渡してレンダリングしたものを返す
-    return render_template('books.html', e_list=e_list)
-
+    rows = with_copy_counts(cur, with_genre_names(rows))
+    return render_page('books.html', rows, prev_args, next_args,
+                       genre_filter=genre_filter)
 
-@app.route('/books/<id>')
-def book(id: str) -> str:
-    con = get_db()
-    cur = con.cursor()
-
-    try:
-        id_num = int(id)
-    except ValueError:  # id が数値でない場合
-        return render_template('book-not-found.html')
 
+def load_book(cur: sqlite3.Cursor, id_num: int) -> dict | None:
+    # 本・蔵書・作者を 1 回の問い合わせでまとめて取得する
+    # （蔵書と作者は JSON 配列にまとめて受け取る）
     coordinate_book = '''
     SELECT
     Books.BookID,
     Books.Title,
     Books.Year,
     Genre.Name,
-    Genre.GenreID
+    Genre.GenreID,
+    (SELECT json_group_array(json_object(
+        'Name', l.Name, 'CopyID', c.CopyID,
+        'OnLoan', EXISTS (SELECT 1 FROM Histories h
+                          WHERE h.CopyID = c.CopyID AND h.ReturnTime IS NULL)))
+     FROM Copies c
+     JOIN Libraries l ON c.LibraryID = l.LibraryID
+     WHERE c.BookID = ?1) AS Libraries,
+    (SELECT json_group_array(json_object('AuthorID', Authors.AuthorID, 'Name', Authors.Name))
+     FROM CoAuthors
+     JOIN Authors ON CoAuthors.AuthorID = Authors.AuthorID
+     WHERE CoAuthors.BookID = Books.BookID) AS Authors
     FROM
         Books
     JOIN
         Genre ON Books.GenreID = Genre.GenreID
     WHERE
-        Books.BookID = ?;
+        Books.BookID = ?1;
     '''
+    row = cur.execute(coordinate_book, (id_num, )).fetchone()
+    if row is None:
+        return None
+    book = {key: row[key] for key in ('BookID', 'Title', 'Year', 'Name', 'GenreID')}
+    return {'book': book,
+            'libraries': json.loads(row['Libraries']),
+            'authors': json.loads(row['Authors'])}
 
-    coordinate_library = '''
-    SELECT l.Name, c.copyID
-    FROM Copies c
-    JOIN Books b ON c.BookID = b.BookID
-    JOIN Libraries l ON c.LibraryID = l.LibraryID
-    WHERE b.BookID = ?;
-    '''
 
-    coordinate_author = '''
-    SELECT
-    Authors.Name
-    FROM
-        Books
-    JOIN
-        CoAuthors ON Books.BookID = CoAuthors.BookID
-    JOIN
-        Authors ON CoAuthors.AuthorID = Authors.AuthorID
-    WHERE
-        Books.BookID = ?;
-    '''
+def invalidate_books_of_copies(cur: sqlite3.Cursor, copy_ids: list[int]) -> None:
+    # 貸し出し状況が変わった蔵書について、本の詳細のキャッシュを破棄する
+    rows = cur.execute('SELECT DISTINCT BookID FROM Copies '
+                       'WHERE CopyID IN (SELECT value FROM json_each(?))',
+                       (json.dumps(copy_ids),)).fetchall()
+    book_cache = get_book_cache()
+    for row in rows:
+        book_cache.invalidate(row['BookID'])
 
-    book = cur.execute(coordinate_book, (id_num, )).fetchone()
-    libraries = cur.execute(coordinate_library, (id_num, )).fetchall()
-    authors = cur.execute(coordinate_author, (id_num, )).fetchall()
 
-    if book is None:  # 本が見つからなかった場合
+@app.route('/books/<id>')
+def book(id: str) -> str:
+    try:
+        id_num = int(id)
+    except ValueError:  # id が数値でない場合
         return render_template('book-not-found.html')
 
-    return render_template('book.html', book=book, libraries=libraries, authors=authors)
+    # 人気のある本は何度も参照されるのでキャッシュから返す
+    book_cache = get_book_cache()
+    detail = book_cache.get(id_num)
+    if detail is None:
+        detail = load_book(get_db().cursor(), id_num)
+        if detail is None:  # 本が見つからなかった場合
+            return render_template('book-not-found.html')
+        book_cache.set(id_num, detail)
+
+    return render_template('book.html', **detail)
+
+
+AUTHOR_LIST_COLUMNS = '''a.AuthorID, a.Name, a.BirthYear,
+    (SELECT COUNT(*) FROM CoAuthors ca WHERE ca.AuthorID = a.AuthorID) AS BookCount'''
+
+
+def fetch_author_books(cur: sqlite3.Cursor,
+                       author_id: int) -> tuple[list[dict], dict | None, dict | None]:
+    # 著者の本を CoAuthors (AuthorID, BookID) のインデックスから 1 ページ分取得する
+    rows, prev_args, next_args = fetch_page(
+        cur, f'SELECT {BOOK_LIST_COLUMNS} FROM CoAuthors ca '
+        'JOIN Books b ON b.BookID = ca.BookID WHERE ca.AuthorID = ?',
+        'ca.BookID', (author_id,))
+    rows = with_copy_counts(cur, with_genre_names(rows))
+    return with_author_names(cur, rows), prev_args, next_args
+
+
+@app.route('/authors')
+def authors() -> str:
+    cur = get_db().cursor()
+    # 著者と本の冊数を 1 ページ分取得
+    rows, prev_args, next_args = fetch_page(
+        cur, f'SELECT {AUTHOR_LIST_COLUMNS} FROM Authors a WHERE 1', 'a.AuthorID')
+    return render_page('authors.html', rows, prev_args, next_args)
+
+
+@app.route('/authors/<id>')
+def author(id: str) -> str:
+    try:
+        id_num = int(id)
+    except ValueError:  # id が数値でない場合
+        return render_template('author-not-found.html')
+
+    cur = get_db().cursor()
+    author = cur.execute(f'SELECT {AUTHOR_LIST_COLUMNS} FROM Authors a WHERE a.AuthorID = ?',
+                         (id_num,)).fetchone()
+    if author is None:  # 著者が見つからなかった場合
+        return render_template('author-not-found.html')
+    rows, prev_args, next_args = fetch_author_books(cur, id_num)
+    prev_url, next_url = page_urls(prev_args, next_args, id=id)
+    return render_template('author.html', author=author, e_list=rows,
+                           prev_url=prev_url, next_url=next_url)
+
+
+@app.route('/metrics')
+def show_metrics() -> Response:
+    # Prometheus のテキスト形式で計測値を返す
+    return Response(get_metrics().expose(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/admin/slow-queries')
+def slow_queries() -> str:
+    # 遅い SQL を合計時間（?order=max なら最大時間、count なら回数）の大きい順に表示する
+    order = request.args.get('order', 'total')
+    if order not in ('total', 'max', 'count'):
+        order = 'total'
+    return render_template('slow-queries.html',
+                           entries=get_slow_query_log().worst(order=order),
+                           order=order,
+                           threshold=app.config['SLOW_QUERY_THRESHOLD'],
+                           enabled=app.config['METRICS_ENABLED'])
+
+
+def get_backup_runner() -> backup.BackupRunner:
+    runner = app.extensions.get('backup_runner')
+    if runner is None:
+        runner = app.extensions['backup_runner'] = backup.BackupRunner()
+    return runner
+
+
+@app.route('/admin/backup')
+def backup_status() -> dict:
+    # 管理画面から取ったバックアップの状態（このプロセスで取ったものだけ）
+    return get_backup_runner().status()
+
+
+@app.route('/admin/backup', methods=['POST'])
+def backup_start() -> tuple[dict, int]:
+    # BACKUP_DIRECTORY へバックアップを取り始める（終わるのを待たずに返す）
+    # 状態は GET /admin/backup で確かめる
+    name = backup.backup_name()
+    if app.config['SHARD_DIRECTORY'] is None:
+        name += '.db'
+    destination = os.path.join(app.config['BACKUP_DIRECTORY'], name)
+    compress = app.config['BACKUP_COMPRESS']
+
+    def run(progress: backup.Progress) -> dict[str, str]:
+        with closing(open_export_db()) as con:
+            return run_backup(con, destination, compress, progress=progress)
+
+    runner = get_backup_runner()
+    if not runner.start(run, destination):
+        return dict(runner.status(), error='backup-is-running'), 409
+    return runner.status(), 202
+
+
+@app.route('/suggest')
+def suggest() -> dict:
+    # 本のタイトル・著者名・ユーザー名のうち q で始まるものを返す
+    # （?kind=books,authors,users で種類を絞る。全角と半角、大文字と小文字は区別しない）
+    prefix = request.args.get('q', '')
+    kinds = [kind for kind in request.args.get('kind', 'books,authors,users').split(',')
+             if kind in ('books', 'authors', 'users')]
+    limit = request.args.get('limit', app.config['SUGGEST_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SUGGEST_MAX_LIMIT']))
+    return {'q': prefix,
+            'suggestions': get_suggester().search(prefix, kinds, limit)}
+
+
+@app.route('/cache-stats')
+def cache_stats() -> dict:
+    # キャッシュのヒット数・ミス数を返す
+    return {'book': get_book_cache().stats()}
 
 
 @app.route('/book-add')
@@ -268,11 +1009,10 @@ def book_add_execute():
         return redirect(url_for('book_add_results',
                                 code='genre-id-has-invalid-charactor'))
     # ジャンル番号の存在チェックをする：
-    # Genre テーブルで同じ本番号の行を 1 行だけ取り出す
-    genre = cur.execute('SELECT GenreID FROM Genre WHERE GenreID = ?',
-                           (genre_id,)).fetchone()
-    if genre is None:
-        # 指定された本番号の行が既に存在
+    # メモリ上の参照データから探す
+    reference_data = get_reference_data()
+    if genre_id not in reference_data.genres:
+        # 指定されたジャンル番号が存在しない
         return redirect(url_for('book_add_results',
                                 code='genre-id-does-not-exists'))
 
@@ -284,33 +1024,38 @@ def book_add_execute():
         except ValueError:
             return redirect(url_for('book_add_results',
                                     code='author-id-has-invalid-charactor'))
+    # 著者番号の存在チェックをまとめて行う
+    if any(int(author) not in reference_data.authors for author in authors):
+        return redirect(url_for('book_add_results',
+                                code='author-id-does-not-exist'))
 
     # データベースへ本を追加
-    try:
+    def write(cur: sqlite3.Cursor) -> None:
         # Books テーブルに指定されたパラメータの行を挿入
         cur.execute('INSERT INTO Books '
                     '(BookID, Title, Year, GenreID) '
                     'VALUES (?, ?, ?, ?)',
                     (book_id, title, publish_year, genre_id))
+        # 全文検索インデックスにタイトルを登録
+        search_index_add(cur, 'BooksFts', book_id, title)
+        for author in authors:
+            # CoAuthors テーブルに本の筆者の行を挿入
+            cur.execute('INSERT INTO CoAuthors'
+                        '(BookID, AuthorID) '
+                        'VALUES (?, ?)',
+                        (book_id, int(author)))
+
+    try:
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('book_add_results',
                                 code='database-error'))
-    for author in authors:
-        # データベースへ本の筆者を追加
-        author = int(author)
-        try:
-            # CoAuthors テーブルに指定されたパラメータの行を挿入
-            cur.execute('INSERT INTO CoAuthors'
-                        '(BookID, AuthorID) '
-                        'VALUES (?, ?)',
-                        (book_id, author))
-        except sqlite3.Error:
-            # データベースエラーが発生
-            return redirect(url_for('book_add_results',
-                                    code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    get_book_cache().invalidate(book_id)
+    suggester = loaded_suggester()
+    if suggester is not None:
+        suggester.add('books', book_id, title)
 
     # 本追加完了
     return redirect(url_for('book_add_results',
@@ -318,11 +1063,8 @@ def book_add_execute():
 
 
 @app.route('/book-add-results/<code>')
-def book_add_results(code: str) -> str:
-    return render_template('book-add-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def book_add_results(code: str) -> Response:
+    return result_page('book-add-results.html', code)
 
 
 @app.route('/copy-add')
@@ -383,27 +1125,30 @@ def copy_add_execute():
         return redirect(url_for('copy_add_results',
                                 code='library-id-has-invalid-charactor'))
     # 図書館番号の存在チェックをする：
-    # Librariesテーブルで同じ図書館番号の行を 1 行だけ取り出す
-    library = cur.execute('SELECT LibraryID FROM Libraries WHERE LibraryID = ?',
-                           (library_id,)).fetchone()
-    if library is None:
+    # メモリ上の参照データから探す
+    if library_id not in get_reference_data().libraries:
         # 指定された図書館番号の行が存在しない場合
         return redirect(url_for('copy_add_results',
                                 code='library-id-does-not-exists'))
 
-    # データベースへ本を追加
+    # データベースへ蔵書を追加
+    def write(cur: sqlite3.Cursor) -> None:
+        # Copies テーブル（図書館のシャード）に指定されたパラメータの行を挿入
+        # （シャードに分けている場合は、ロックを取った後に全シャードの重複を確かめる）
+        shards.insert_copies(cur, [(copy_id, book_id, library_id)])
+
     try:
-        # Books テーブルに指定されたパラメータの行を挿入
-        cur.execute('INSERT INTO Copies '
-                    '(CopyID, BookID, LibraryID) '
-                    'VALUES (?, ?, ?)',
-                    (copy_id, book_id, library_id))
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
+    except sqlite3.IntegrityError:
+        # チェックの後に他の書き込みが同じ蔵書番号を追加した
+        return redirect(url_for('copy_add_results',
+                                code='copy-already-exists'))
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('copy_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    get_book_cache().invalidate(book_id)
 
     # 本追加完了
     return redirect(url_for('copy_add_results',
@@ -411,11 +1156,8 @@ def copy_add_execute():
 
 
 @app.route('/copy-add-results/<code>')
-def copy_add_results(code: str) -> str:
-    return render_template('copy-add-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def copy_add_results(code: str) -> Response:
+    return result_page('copy-add-results.html', code)
 
 
 @app.route('/book-del/<id>')
@@ -470,7 +1212,7 @@ def book_del_execute(id: str):
                                 code='book-id-has-invalid-charactor'))
     # 本番号の存在チェックをする：
     # Booksテーブルで同じ本番号の行を 1 行だけ取り出す
-    book = cur.execute('SELECT BookID FROM Books WHERE BookID = ?',
+    book = cur.execute('SELECT BookID, Title FROM Books WHERE BookID = ?',
                            (id_num,)).fetchone()
     if book is None:
         # 指定された本番号の行が無い
@@ -486,15 +1228,23 @@ def book_del_execute(id: str):
                                 code='book-is-in-library'))
 
     # データベースから削除
-    try:
+    def write(cur: sqlite3.Cursor) -> None:
         # Books テーブルの指定された行を削除
         cur.execute('DELETE FROM Books WHERE BookID = ?', (id_num,))
+        # 全文検索インデックスからタイトルを削除
+        search_index_delete(cur, 'BooksFts', id_num, book['Title'])
+
+    try:
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('book_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    get_book_cache().invalidate(id_num)
+    suggester = loaded_suggester()
+    if suggester is not None:
+        suggester.remove('books', id_num)
 
     # 本追加完了
     return redirect(url_for('book_add_results',
@@ -502,9 +1252,8 @@ def book_del_execute(id: str):
 
 
 @app.route('/book-del-results/<code>')
-def book_del_results(code: str) -> str:
-    return render_template('book-del-results.html',
-                           results=RESULT_MESSAGES.get(code, 'code error'))
+def book_del_results(code: str) -> Response:
+    return result_page('book-del-results.html', code)
 
 
 @app.route('/copy-del/<id>')
@@ -549,7 +1298,7 @@ def copy_del_execute(id: str):
                                 code='copy-id-has-invalid-charactor'))
     # 蔵書番号の存在チェックをする：
     # Copiesテーブルで同じ蔵書番号の行を1行だけ取り出す
-    copy = cur.execute('SELECT CopyID FROM Copies WHERE CopyID = ?',
+    copy = cur.execute('SELECT CopyID, BookID, LibraryID FROM Copies WHERE CopyID = ?',
                            (id_num,)).fetchone()
     if copy is None:
         # 指定された本番号の行が無い
@@ -557,15 +1306,28 @@ def copy_del_execute(id: str):
                                 code='copy-id-does-not-exist'))
 
     # データベースから削除
+    def write(cur: sqlite3.Cursor) -> None:
+        # 貸し出し統計からこの蔵書の貸し出し（移動済みの履歴を含む）の分を減らす
+        # （削除した後は蔵書から本・図書館を引けず、返却や履歴の削除で減らせなくなる）
+        loans = cur.execute('SELECT ReturnTime FROM Histories WHERE CopyID = ?',
+                            (id_num,)).fetchall()
+        if has_table(cur, 'HistoriesArchive'):
+            loans += cur.execute('SELECT ReturnTime FROM HistoriesArchive WHERE CopyID = ?',
+                                 (id_num,)).fetchall()
+        stats.record_deleted_loans(cur, [id_num] * len(loans),
+                                   [id_num for row in loans if row['ReturnTime'] is None])
+        # Copies テーブル（図書館のシャード）の指定された行を削除
+        cur.execute(f'DELETE FROM {shards.copies_table(cur, copy["LibraryID"])} '
+                    'WHERE CopyID = ?', (id_num,))
+
     try:
-        # Books テーブルの指定された行を削除
-        cur.execute('DELETE FROM Copies WHERE CopyID = ?', (id_num,))
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('copy_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    get_book_cache().invalidate(copy['BookID'])
 
     # 本追加完了
     return redirect(url_for('copy_add_results',
@@ -573,17 +1335,19 @@ def copy_del_execute(id: str):
 
 
 @app.route('/copy-del-results/<code>')
-def copy_del_results(code: str) -> str:
-    return render_template('copy-del-results.html',
-                           results=RESULT_MESSAGES.get(code, 'code error'))
+def copy_del_results(code: str) -> Response:
+    return result_page('copy-del-results.html', code)
 
 
 @app.route('/users')
 def users() -> str:
+    # ページ送りのリンクは GET で絞り込み条件を引き継ぐ
+    if 'user_filter' in request.args:
+        return users_filtered()
     cur = get_db().cursor()
-    coordinates = 'SELECT * FROM Users;'
-    e_list = cur.execute(coordinates).fetchall()
-    return render_template('users.html', e_list=e_list)
+    coordinates = 'SELECT * FROM Users WHERE 1'
+    page = fetch_page(cur, coordinates, 'UserID')
+    return render_page('users.html', *page)
 
 
 @app.route('/users', methods=['POST'])
@@ -592,11 +1356,20 @@ def users_filtered() -> str:
     con = get_db()
     cur = con.cursor()
 
-    # Users テーブルから名前で絞り込み、
-    e_list = cur.execute('SELECT * FROM Users WHERE Name LIKE ?;',
-                         (request.form['user_filter'], )).fetchall()
+    # Users テーブルから名前で絞り込み、1 ページ分取得
+    user_filter = request.values['user_filter']
+    match = search_match(user_filter)
+    if match is not None and has_search_index(cur, 'UsersFts'):
+        # 全文検索インデックスから関連度順に取得
+        page = fetch_ranked_page(cur, 'SELECT u.* FROM (SELECT rowid, rank FROM UsersFts '
+                                 '      WHERE UsersFts MATCH ? ORDER BY rank LIMIT ? OFFSET ?) f '
+                                 'JOIN Users u ON u.UserID = f.rowid ORDER BY f.rank',
+                                 (match, ))
+    else:
+        page = fetch_page(cur, 'SELECT * FROM Users WHERE Name LIKE ?',
+                          'UserID', (like_pattern(user_filter), ))
     # 一覧をテンプレートへ渡してレンダリングしたものを返す
-    return render_template('users.html', e_list=e_list)
+    return render_page('users.html', *page, user_filter=user_filter)
 
 
 @app.route('/users/<id>')
@@ -609,21 +1382,97 @@ def user(id: str) -> str:
     except ValueError:  # id が数値でない場合
         return render_template('user-not-found.html')
 
-    coordinate_histories = '''
-    SELECT h.CopyID, h.BorrowTime, h.ReturnTime
-    FROM Histories h
-    JOIN Users u ON u.UserID = h.UserID
-    WHERE u.UserID = ?;
-    '''
     coordinates_user = 'SELECT * FROM Users WHERE UserID = ?;'
 
-    histories = cur.execute(coordinate_histories, (id_num, )).fetchall()
     user = cur.execute(coordinates_user, (id_num, )).fetchone()
 
-    if user is None:  # 本が見つからなかった場合
+    if user is None:  # ユーザーが見つからなかった場合
         return render_template('user-not-found.html')
 
-    return render_template('user.html', histories=histories, user=user)
+    open_loans = fetch_open_loans(cur, id_num)
+    # 返却済みの履歴は新しい順にページ単位で表示する
+    histories, prev_args, next_args = fetch_history_page(cur, id_num)
+    prev_url, next_url = page_urls(prev_args, next_args, id=id)
+
+    return render_template('user.html', open_loans=open_loans, histories=histories,
+                           user=user, prev_url=prev_url, next_url=next_url)
+
+
+def fetch_open_loans(cur: sqlite3.Cursor, user_id: int) -> list[sqlite3.Row]:
+    # 貸し出し中の履歴は件数が限られるので全件取得する
+    coordinate_open_loans = '''
+    SELECT CopyID, BorrowTime, ReturnTime FROM Histories
+    WHERE UserID = ? AND ReturnTime IS NULL
+    ORDER BY BorrowTime, CopyID;
+    '''
+    return cur.execute(coordinate_open_loans, (user_id, )).fetchall()
+
+
+def fetch_history_page(cur: sqlite3.Cursor,
+                       user_id: int) -> tuple[list[sqlite3.Row], dict | None, dict | None]:
+    # 返却済みの貸し出し履歴を新しい順に 1 ページ取得する（Histories と HistoriesArchive の両方から）
+    return fetch_loan_page(cur, history_page_queries(cur), (user_id,), newest_first=True)
+
+
+def history_page_queries(cur: sqlite3.Cursor) -> list[str]:
+    # ユーザーの返却済みの履歴を取り出す文（fetch_loan_page に渡す形）
+    tables = ['Histories']
+    if has_table(cur, 'HistoriesArchive'):
+        tables.append('HistoriesArchive')
+    return [f'SELECT CopyID, BorrowTime, ReturnTime FROM {table} '
+            'WHERE UserID = ? AND ReturnTime IS NOT NULL' for table in tables]
+
+
+def fetch_loan_page(cur: sqlite3.Cursor, queries: list[str], params: tuple,
+                    newest_first: bool) -> tuple[list[sqlite3.Row], dict | None, dict | None]:
+    # 貸し出し履歴を (貸し出し日, 蔵書ID) の順にキーセット方式で 1 ページ取得する
+    # queries は CopyID と BorrowTime を含む WHERE 句までの SELECT 文で、それぞれに params を渡す
+    # 各文から（インデックスの順に）必要な件数だけ取り出して合わせる
+    # ?after_time=&after_copy= でそれより後ろ、?before_time=&before_copy= でそれより前のページ
+    size = page_size()
+    after = (request.args.get('after_time'), request.args.get('after_copy', type=int))
+    before = (request.args.get('before_time'), request.args.get('before_copy', type=int))
+    forward, backward = ('DESC', 'ASC') if newest_first else ('ASC', 'DESC')
+
+    if None not in before:
+        order, cursor_params = backward, before
+    elif None not in after:
+        order, cursor_params = forward, after
+    else:
+        order, cursor_params = forward, ()
+    all_params = []
+    for _ in queries:
+        all_params += [*params, *cursor_params, size + 1]
+    rows = cur.execute(loan_page_query(queries, order, bool(cursor_params)),
+                       (*all_params, size + 1)).fetchall()
+
+    if None not in before:
+        # 逆順に size + 1 件取り出し、さらに前のページがあるかを判定する
+        has_prev = len(rows) > size
+        rows = rows[:size][::-1]
+        has_next = True
+    else:
+        has_next = len(rows) > size
+        rows = rows[:size]
+        has_prev = None not in after
+
+    prev_args = ({'before_time': rows[0]['BorrowTime'], 'before_copy': rows[0]['CopyID']}
+                 if rows and has_prev else None)
+    next_args = ({'after_time': rows[-1]['BorrowTime'], 'after_copy': rows[-1]['CopyID']}
+                 if rows and has_next else None)
+    return rows, prev_args, next_args
+
+
+def loan_page_query(queries: list[str], order: str, has_cursor: bool) -> str:
+    # fetch_loan_page の 1 ページ分の文（order は 'ASC' か 'DESC'）
+    # パラメータは文ごとに (params, カーソルの 2 つ（has_cursor の時）, 件数)、最後に全体の件数
+    operator = {'DESC': '<', 'ASC': '>'}[order]  # 並び順で次に来る行の条件
+    condition = f'(BorrowTime, CopyID) {operator} (?, ?)' if has_cursor else '1'
+    query = ' UNION ALL '.join(
+        f'SELECT * FROM ({query} AND {condition} '
+        f'ORDER BY BorrowTime {order}, CopyID {order} LIMIT ?)'
+        for query in queries)
+    return f'{query} ORDER BY BorrowTime {order}, CopyID {order} LIMIT ?'
 
 
 @app.route('/user-add')
@@ -677,18 +1526,25 @@ def user_add_execute():
                                 code='phone-number-has-control-charactor'))
 
     # データベースへユーザー情報を追加
-    try:
+    def write(cur: sqlite3.Cursor) -> None:
         # Users テーブルに指定されたパラメータの行を挿入
         cur.execute('INSERT INTO Users '
                     '(UserID, Name, Email, PhoneNumber) '
                     'VALUES (?, ?, ?, ?)',
                     (user_id, name, email_address, phone_number))
+        # 全文検索インデックスに名前を登録
+        search_index_add(cur, 'UsersFts', user_id, name)
+
+    try:
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('user_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    suggester = loaded_suggester()
+    if suggester is not None:
+        suggester.add('users', user_id, name)
 
     # ユーザ追加完了
     return redirect(url_for('user_add_results',
@@ -696,11 +1552,45 @@ def user_add_execute():
 
 
 @app.route('/user-add-results/<code>')
-def user_add_results(code: str) -> str:
-    return render_template('user-add-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def user_add_results(code: str) -> Response:
+    return result_page('user-add-results.html', code)
+
+
+@app.route('/import')
+def import_add() -> str:
+    # 種類ごとの列名をテンプレートへ渡してレンダリングしたものを返す
+    return render_template('import.html', fields=importer.FIELDS)
+
+
+@app.route('/import', methods=['POST'])
+def import_add_execute() -> str:
+    # アップロードされたファイルを読みながら一括登録する
+    kind = request.form['kind']
+    upload = request.files['file']
+    fmt = 'jsonl' if (upload.filename or '').endswith(('.jsonl', '.json')) else 'csv'
+    if kind not in importer.IMPORTERS:
+        kind = 'books'
+
+    # エラーは先頭 IMPORT_MAX_ERRORS 件だけ表示し、件数は全て数える
+    errors = []
+    error_count = 0
+
+    def report(line_no: int, code: str) -> None:
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < app.config['IMPORT_MAX_ERRORS']:
+            errors.append((line_no, RESULT_MESSAGES[code]))
+
+    f = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    with closing(open_db()) as con:
+        inserted = importer.import_file(con, kind, f, fmt, report)
+    if kind in ('books', 'authors', 'users'):
+        # 一括登録した分は次に使う時にまとめて読み直す
+        suggester = loaded_suggester()
+        if suggester is not None:
+            suggester.invalidate()
+    return render_template('import-results.html', inserted=inserted,
+                           errors=errors, error_count=error_count)
 
 
 @app.route('/borrow-add')
@@ -736,25 +1626,54 @@ def borrow_add_execute():
         return redirect(url_for('borrow_add_results',
                                 code='copy-id-has-invalid-charactor'))
 
+    # 蔵書番号の存在チェックをする：
+    copy = cur.execute('SELECT CopyID, BookID FROM Copies WHERE CopyID = ?',
+                       (copy_id,)).fetchone()
+    if copy is None:
+        # 指定された蔵書番号の行が無い
+        return redirect(url_for('borrow_add_results',
+                                code='copy-id-does-not-exist'))
+    # 貸し出し中かどうかのチェック：
+    # 未返却の貸し出しは部分インデックス HistoriesOpenLoan から引ける
+    loan = cur.execute('SELECT CopyID FROM Histories WHERE CopyID = ? AND ReturnTime IS NULL',
+                       (copy_id,)).fetchone()
+    if loan is not None:
+        # 指定された蔵書は貸し出し中
+        return redirect(url_for('borrow_add_results',
+                                code='copy-is-on-loan'))
+
     # 貸し出し日チェック
     if has_control_character(borrow_time):
         # 貸し出し日に制御文字が含まれる
         return redirect(url_for('borrow_add_results',
                                 code='borrow-time-has-control-charactor'))
+    borrow_time = to_timestamp(borrow_time)
+    if borrow_time is None:
+        # 貸し出し日が日時として読めない
+        return redirect(url_for('borrow_add_results',
+                                code='borrow-time-is-invalid'))
 
     # データベースへ貸し出し情報を追加
-    try:
-        # Histories テーブルに指定されたパラメータの行を挿入
-        cur.execute('INSERT INTO Histories   '
+    def write(cur: sqlite3.Cursor) -> None:
+        # Histories テーブル（蔵書のある図書館のシャード）に指定されたパラメータの行を挿入
+        cur.execute(f'INSERT INTO {shards.histories_table(cur, copy_id)} '
                     '(CopyID, UserID, BorrowTime) '
                     'VALUES (?, ?, ?)',
                     (copy_id, user_id, borrow_time))
+        stats.record_borrows(cur, [copy_id])
+
+    try:
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
+    except sqlite3.IntegrityError:
+        # チェックの後に他のリクエストが先に貸し出した
+        return redirect(url_for('borrow_add_results',
+                                code='copy-is-on-loan'))
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('borrow_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    get_book_cache().invalidate(copy['BookID'])
 
     # ユーザ追加完了
     return redirect(url_for('borrow_add_results',
@@ -762,11 +1681,8 @@ def borrow_add_execute():
 
 
 @app.route('/borrow-add-results/<code>')
-def borrow_add_results(code: str) -> str:
-    return render_template('borrow-add-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def borrow_add_results(code: str) -> Response:
+    return result_page('borrow-add-results.html', code)
 
 
 @app.route('/return-add', methods=['POST'])
@@ -781,23 +1697,51 @@ def return_add_execute():
     copy_id = request.form['copy_id']
     borrow_time = request.form['borrow_time']
 
+    # 貸し出し日チェック（保存形式にそろえてから照合する。空欄は現在時刻にせず読めない扱い）
+    if has_control_character(borrow_time):
+        # 貸し出し日に制御文字が含まれる
+        return redirect(url_for('return_add_results',
+                                code='borrow-time-has-control-charactor'))
+    borrow_time = to_timestamp(borrow_time) if borrow_time.strip() else None
+    if borrow_time is None:
+        # 貸し出し日が日時として読めない
+        return redirect(url_for('return_add_results',
+                                code='borrow-time-is-invalid'))
+
     # 返却日チェック
     if has_control_character(return_time):
         # 返却日に制御文字が含まれる
         return redirect(url_for('return_add_results',
                                 code='return-time-has-control-charactor'))
+    return_time = to_timestamp(return_time)
+    if return_time is None:
+        # 返却日が日時として読めない
+        return redirect(url_for('return_add_results',
+                                code='return-time-is-invalid'))
+
+    # データベースへ返却情報を追加
+    def write(cur: sqlite3.Cursor) -> None:
+        # 返却済みの履歴は返却日を直すだけなので、貸し出し中の冊数は変えない
+        was_open = cur.execute('SELECT 1 FROM Histories WHERE UserID = ? AND CopyID = ? '
+                               'AND BorrowTime = ? AND ReturnTime IS NULL',
+                               (user_id, copy_id, borrow_time)).fetchone() is not None
+        # Histories テーブルの指定された行に返却日を設定
+        # （行を持つテーブルが蔵書の今の図書館とは限らないので、全てのテーブルに対して行う）
+        for table in shards.all_tables(cur, 'Histories'):
+            cur.execute(f'UPDATE {table} '
+                        'SET ReturnTime = ? WHERE UserID = ? AND CopyID = ? AND BorrowTime = ?',
+                        (return_time, user_id, copy_id, borrow_time))
+        if was_open:
+            stats.record_returns(cur, [int(copy_id)])
 
-    # データベースへ貸し出し情報を追加
     try:
-        # Histories テーブルに指定されたパラメータの行を挿入
-        cur.execute('UPDATE Histories SET ReturnTime = ? WHERE UserID = ? AND CopyID = ? AND BorrowTime = ?',
-                    (return_time, user_id, copy_id, borrow_time))
+        # 書き込んでコミット（データベース更新処理を確定）
+        run_write(write)
     except sqlite3.Error:
         # データベースエラーが発生
         return redirect(url_for('return_add_results',
                                 code='database-error'))
-    # コミット（データベース更新処理を確定）
-    con.commit()
+    invalidate_books_of_copies(cur, [copy_id])
 
     # ユーザ追加完了
     return redirect(url_for('return_add_results',
@@ -805,48 +1749,451 @@ def return_add_execute():
 
 
 @app.route('/return-add-results/<code>')
-def return_add_results(code: str) -> str:
-    return render_template('return-add-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def return_add_results(code: str) -> Response:
+    return result_page('return-add-results.html', code)
 
 
-@app.route('/history-del/<int:copy_id>/<int:user_id>/<borrow_time>', methods=['POST'])
-def history_del(copy_id, user_id, borrow_time):
+@app.route('/overdue')
+def overdue() -> str:
+    # 貸し出しから ?days= 日を過ぎても返却されていない貸し出しを古い順に表示する
+    # 部分インデックス HistoriesOpenBorrowTime の範囲検索で引く
+    days = max(0, request.args.get('days', app.config['OVERDUE_DAYS'], type=int))
+    cutoff = format_timestamp(datetime.datetime.now() - datetime.timedelta(days=days))
+    cur = get_db().cursor()
+    loans, prev_args, next_args = fetch_loan_page(
+        cur, ['SELECT CopyID, UserID, BorrowTime FROM Histories '
+              'WHERE ReturnTime IS NULL AND BorrowTime < ?'], (cutoff,), newest_first=False)
+
+    # 本のタイトルとユーザー名は表示する行の分だけまとめて引く
+    copy_ids = json.dumps([loan['CopyID'] for loan in loans])
+    user_ids = json.dumps([loan['UserID'] for loan in loans])
+    titles = dict(cur.execute('SELECT c.CopyID, b.Title FROM Copies c '
+                              'JOIN Books b ON b.BookID = c.BookID '
+                              'WHERE c.CopyID IN (SELECT value FROM json_each(?))',
+                              (copy_ids,)).fetchall())
+    names = dict(cur.execute('SELECT UserID, Name FROM Users '
+                             'WHERE UserID IN (SELECT value FROM json_each(?))',
+                             (user_ids,)).fetchall())
+    loans = [dict(loan, Title=titles.get(loan['CopyID'], ''), Name=names.get(loan['UserID'], ''))
+             for loan in loans]
+    prev_url, next_url = page_urls(prev_args, next_args, days=days)
+    return render_template('overdue.html', loans=loans, days=days, cutoff=cutoff,
+                           prev_url=prev_url, next_url=next_url)
+
+
+@app.route('/stats')
+def loan_stats() -> str:
+    # 貸し出し統計（集計表から表示する）
+    cur = get_db().cursor()
+    if not has_table(cur, 'BookLoanStats'):
+        return render_template('stats.html', enabled=False)
+    reference_data = get_reference_data()
+    top_books = cur.execute('SELECT s.BookID, b.Title, s.LoanCount, s.OpenCount '
+                            'FROM BookLoanStats s JOIN Books b ON b.BookID = s.BookID '
+                            'ORDER BY s.LoanCount DESC LIMIT ?',
+                            (app.config['STATS_TOP_BOOKS'],)).fetchall()
+    libraries = [dict(row, Name=reference_data.libraries.get(row['LibraryID'], ''))
+                 for row in cur.execute('SELECT LibraryID, LoanCount, OpenCount '
+                                        'FROM LibraryLoanStats ORDER BY LoanCount DESC')]
+    genres = [dict(row, Name=reference_data.genres.get(row['GenreID'], ''))
+              for row in cur.execute('SELECT GenreID, LoanCount, OpenCount '
+                                     'FROM GenreLoanStats ORDER BY LoanCount DESC')]
+    return render_template('stats.html', enabled=True, top_books=top_books,
+                           libraries=libraries, genres=genres)
+
+
+@app.route('/export/<kind>.<fmt>')
+def export_data(kind: str, fmt: str) -> Response:
+    # /export/books.csv のように出力する（?gzip=1 で gzip 圧縮）
+    # 出力専用の接続で読みながら少しずつ送る
+    if kind not in exporter.EXPORTS or fmt not in exporter.FORMATS:
+        abort(404)
+    use_gzip = request.args.get('gzip', 0, type=int) == 1
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+
+    def generate():
+        with closing(open_export_db()) as con:
+            yield from exporter.export(con, kind, fmt, use_gzip, chunk_size)
+
+    filename = f'{kind}.{fmt}' + ('.gz' if use_gzip else '')
+    return Response(generate(),
+                    mimetype='application/gzip' if use_gzip else exporter.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.route('/borrow-batch')
+def borrow_batch() -> str:
+    # テンプレートへ何も渡さずにレンダリングしたものを返す
+    return render_template('borrow-batch.html')
+
+
+@app.route('/borrow-batch', methods=['POST'])
+def borrow_batch_execute() -> str:
+    # 複数の蔵書をまとめて貸し出す（1 トランザクションで登録する）
     con = get_db()
     cur = con.cursor()
-    cur.execute('DELETE FROM Histories WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
-                (copy_id, user_id, borrow_time))
-    con.commit()
+
+    # リクエストされた POST パラメータの内容を取り出す
+    user_id_str = request.form['user_id']
+    copy_id_strs = split_ids(request.form['copy_ids'])
+    borrow_time = request.form['borrow_time']
+
+    # 蔵書ごとの処理結果コード
+    results = check_batch_ids(cur, user_id_str, copy_id_strs)
+
+    # 貸し出し日チェック
+    if has_control_character(borrow_time):
+        results = [(copy_id, code or 'borrow-time-has-control-charactor')
+                   for copy_id, code in results]
+    borrow_time = to_timestamp(borrow_time)
+    if borrow_time is None:
+        results = [(copy_id, code or 'borrow-time-is-invalid')
+                   for copy_id, code in results]
+
+    # 蔵書番号の存在チェックと貸し出し中かどうかのチェックをまとめて行う
+    copy_ids = [int(copy_id) for copy_id, code in results if code is None]
+    found = importer.existing_ids(cur, 'Copies', 'CopyID', set(copy_ids))
+    on_loan = {row['CopyID'] for row in cur.execute(
+        'SELECT CopyID FROM Histories WHERE ReturnTime IS NULL '
+        'AND CopyID IN (SELECT value FROM json_each(?))', (json.dumps(copy_ids),))}
+    results = [(copy_id, code or (None if int(copy_id) in found else 'copy-id-does-not-exist'))
+               for copy_id, code in results]
+    results = [(copy_id, code or ('copy-is-on-loan' if int(copy_id) in on_loan else None))
+               for copy_id, code in results]
+
+    # データベースへ貸し出し情報をまとめて追加
+    rows = [(int(copy_id), int(user_id_str), borrow_time)
+            for copy_id, code in results if code is None]
+
+    def write(cur: sqlite3.Cursor) -> None:
+        # 蔵書のある図書館のシャードごとにまとめて挿入する
+        tables = shards.histories_tables(cur, [row[0] for row in rows])
+        for table in sorted(set(tables.values())):
+            cur.executemany(f'INSERT INTO {table} (CopyID, UserID, BorrowTime) '
+                            'VALUES (?, ?, ?)', [row for row in rows if tables[row[0]] == table])
+        stats.record_borrows(cur, [row[0] for row in rows])
+
+    results = execute_batch(results, write if rows else None, 'borrow-added')
+    return render_template('borrow-batch-results.html', results=results)
+
+
+@app.route('/return-batch')
+def return_batch() -> str:
+    # テンプレートへ何も渡さずにレンダリングしたものを返す
+    return render_template('return-batch.html')
+
+
+@app.route('/return-batch', methods=['POST'])
+def return_batch_execute() -> str:
+    # 複数の蔵書をまとめて返却する（1 トランザクションで更新する）
+    con = get_db()
+    cur = con.cursor()
+
+    # リクエストされた POST パラメータの内容を取り出す
+    user_id_str = request.form['user_id']
+    copy_id_strs = split_ids(request.form['copy_ids'])
+    return_time = request.form['return_time']
+
+    # 蔵書ごとの処理結果コード
+    results = check_batch_ids(cur, user_id_str, copy_id_strs)
+
+    # 返却日チェック
+    if has_control_character(return_time):
+        results = [(copy_id, code or 'return-time-has-control-charactor')
+                   for copy_id, code in results]
+    return_time = to_timestamp(return_time)
+    if return_time is None:
+        results = [(copy_id, code or 'return-time-is-invalid')
+                   for copy_id, code in results]
+
+    # 返却されていない貸し出しをまとめて探す
+    copy_ids = [int(copy_id) for copy_id, code in results if code is None]
+    loans = {}
+    if copy_ids:
+        loans = dict(cur.execute('SELECT CopyID, BorrowTime FROM Histories '
+                                 'WHERE UserID = ? AND ReturnTime IS NULL '
+                                 'AND CopyID IN (SELECT value FROM json_each(?))',
+                                 (int(user_id_str), json.dumps(copy_ids))).fetchall())
+    results = [(copy_id, code or (None if int(copy_id) in loans else 'loan-does-not-exist'))
+               for copy_id, code in results]
+
+    # データベースの貸し出し情報をまとめて更新
+    rows = [(return_time, int(user_id_str), int(copy_id), loans[int(copy_id)])
+            for copy_id, code in results if code is None]
+
+    def write(cur: sqlite3.Cursor) -> None:
+        # 返却されていない行だけを更新する（チェックの後に返却された分は数えない）
+        # （行を持つテーブルが蔵書の今の図書館とは限らないので、見つかるまで全てのテーブルを探す）
+        returned = []
+        tables = shards.all_tables(cur, 'Histories')
+        for row in rows:
+            for table in tables:
+                cur.execute(f'UPDATE {table} SET ReturnTime = ? '
+                            'WHERE UserID = ? AND CopyID = ? AND BorrowTime = ? '
+                            'AND ReturnTime IS NULL', row)
+                if cur.rowcount:
+                    returned.append(row[2])
+                    break
+        stats.record_returns(cur, returned)
+
+    results = execute_batch(results, write if rows else None, 'return-added')
+    return render_template('return-batch-results.html', results=results)
+
+
+def to_timestamp(s: str) -> str | None:
+    # 入力された日時を保存形式にそろえる（空欄なら現在時刻、読めなければ None）
+    if not s.strip():
+        return now_timestamp()
+    return parse_timestamp(s)
+
+
+def check_batch_ids(cur: sqlite3.Cursor, user_id_str: str,
+                    copy_id_strs: list[str]) -> list[tuple[str, str | None]]:
+    # ユーザー番号と蔵書番号の並びをチェックし、蔵書ごとの (蔵書番号, 処理結果コード) を返す
+    # （問題が無ければコードは None）
+    user_code = None
+    try:
+        user_id = int(user_id_str)  # 文字列型で渡されたユーザー番号を整数型へ変換する
+    except ValueError:
+        user_code = 'user-id-has-invalid-charactor'
+    else:
+        user = cur.execute('SELECT UserID FROM Users WHERE UserID = ?',
+                           (user_id,)).fetchone()
+        if user is None:
+            user_code = 'user-id-does-not-exist'
+
+    results = []
+    seen = set()
+    for copy_id in copy_id_strs:
+        code = user_code
+        if code is None:
+            try:
+                copy_id_num = int(copy_id)
+            except ValueError:
+                code = 'copy-id-has-invalid-charactor'
+            else:
+                if copy_id_num in seen:
+                    code = 'copy-id-is-duplicated'
+                seen.add(copy_id_num)
+        results.append((copy_id, code))
+    return results
+
+
+def execute_batch(results: list[tuple[str, str | None]],
+                  write, done_code: str) -> list[tuple[str, str]]:
+    # チェックを通った行をまとめて書き込み、蔵書ごとの (蔵書番号, メッセージ) を返す
+    # （書き込む行が無ければ write は None）
+    if write is not None:
+        try:
+            # 書き込んでコミット（データベース更新処理を確定）
+            run_write(write)
+        except sqlite3.Error:
+            # データベースエラーが発生（1 件も書き込まない）
+            done_code = 'database-error'
+        else:
+            invalidate_books_of_copies(get_db().cursor(),
+                                       [int(copy_id) for copy_id, code in results if code is None])
+    return [(copy_id, RESULT_MESSAGES[code or done_code]) for copy_id, code in results]
+
+
+@app.route('/history-del/<int:copy_id>/<int:user_id>/<borrow_time>', methods=['POST'])
+def history_del(copy_id, user_id, borrow_time):
+    # 貸し出し日は保存形式にそろえてから照合する（URL の部分は空にならない）
+    if has_control_character(borrow_time):
+        return redirect(url_for('history_del_results',
+                                code='borrow-time-has-control-charactor'))
+    borrow_time = to_timestamp(borrow_time)
+    if borrow_time is None:
+        # 貸し出し日が日時として読めない
+        return redirect(url_for('history_del_results',
+                                code='borrow-time-is-invalid'))
+
+    def write(cur: sqlite3.Cursor) -> None:
+        # 削除する履歴の分だけ貸し出し統計を減らす
+        # 履歴はその行を持つテーブルから削除する（シャードに分けている場合、蔵書を削除した後の
+        # 履歴も蔵書のあった図書館のシャードに残っているので、全てのテーブルから削除する）
+        deleted = []
+        for table in shards.all_tables(cur, 'Histories'):
+            deleted += cur.execute(f'SELECT ReturnTime FROM {table} '
+                                   'WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
+                                   (copy_id, user_id, borrow_time)).fetchall()
+            cur.execute(f'DELETE FROM {table} '
+                        'WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
+                        (copy_id, user_id, borrow_time))
+        if has_table(cur, 'HistoriesArchive'):
+            # 移した後の古い履歴も削除できるようにする
+            deleted += cur.execute('SELECT ReturnTime FROM HistoriesArchive '
+                                   'WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
+                                   (copy_id, user_id, borrow_time)).fetchall()
+            cur.execute('DELETE FROM HistoriesArchive '
+                        'WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
+                        (copy_id, user_id, borrow_time))
+        stats.record_deleted_loans(cur, [copy_id] * len(deleted),
+                                   [copy_id for row in deleted if row['ReturnTime'] is None])
+
+    run_write(write)
+    invalidate_books_of_copies(get_db().cursor(), [copy_id])
     return redirect(url_for('history_del_results',
                             code='history-deleted'))
 
 
 @app.route('/history-del-results/<code>')
-def history_del_results(code: str) -> str:
-    return render_template('history-del-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def history_del_results(code: str) -> Response:
+    return result_page('history-del-results.html', code)
 
 
 @app.route('/user_del/<int:user_id>', methods=['POST'])
 def user_del(user_id):
-    con = get_db()
-    cur = con.cursor()
-    cur.execute('DELETE FROM Users WHERE UserID = ?', (user_id,))
-    con.commit()
+    user = get_db().execute('SELECT Name FROM Users WHERE UserID = ?',
+                            (user_id,)).fetchone()
+
+    def write(cur: sqlite3.Cursor) -> None:
+        cur.execute('DELETE FROM Users WHERE UserID = ?', (user_id,))
+        if user is not None:
+            # 全文検索インデックスから名前を削除
+            search_index_delete(cur, 'UsersFts', user_id, user['Name'])
+
+    run_write(write)
+    suggester = loaded_suggester()
+    if suggester is not None:
+        suggester.remove('users', user_id)
     return redirect(url_for('user_del_results',
                             code='user-deleted'))
 
 
 @app.route('/user-del-results/<code>')
-def user_del_results(code: str) -> str:
-    return render_template('user-del-results.html',
-                           # codeが存在しなければ'code error 'を返す
-                           results=RESULT_MESSAGES.get(code, 'code error')
-                           )
+def user_del_results(code: str) -> Response:
+    return result_page('user-del-results.html', code)
+
+
+# JSON API
+# 応答には使ったテーブルの更新回数（DataVersion）から作った ETag を付け、
+# If-None-Match が一致すれば問い合わせをせずに 304 を返す
+
+def make_etag(tables: list[str]) -> str | None:
+    # DataVersion が無い（マイグレーション前の）データベースでは ETag を付けない
+    try:
+        rows = get_db().execute('SELECT Name, Version FROM DataVersion '
+                                'WHERE Name IN (SELECT value FROM json_each(?)) ORDER BY Name',
+                                (json.dumps(tables),)).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    versions = ','.join(f'{row["Name"]}={row["Version"]}' for row in rows)
+    return hashlib.sha1(f'{request.full_path}|{versions}'.encode()).hexdigest()
+
+
+def conditional_json(tables: list[str], build) -> Response:
+    # build は JSON にする値を返す関数（304 を返す場合は呼ばない）
+    etag = make_etag(tables)
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = app.make_response(build())
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+@app.route('/api/books')
+def api_books() -> Response:
+    def build() -> dict:
+        cur = get_db().cursor()
+        rows, prev_args, next_args = fetch_page(
+            cur, f'SELECT {BOOK_LIST_COLUMNS} FROM Books b WHERE 1', 'b.BookID')
+        prev_url, next_url = page_urls(prev_args, next_args)
+        rows = with_copy_counts(cur, with_genre_names(rows))
+        return {'books': rows, 'prev': prev_url, 'next': next_url}
+
+    return conditional_json(['Books', 'Copies', 'Histories', 'Genre'], build)
+
+
+@app.route('/api/books/<int:id>')
+def api_book(id: int) -> Response:
+    def build() -> dict | tuple[dict, int]:
+        # ETag はデータベースの今の更新回数から作るので、本文もプロセスごとのキャッシュ
+        # （他のワーカーの書き込みや invalidate の前の読み取りで古くなりうる）ではなく
+        # データベースから読む
+        detail = load_book(get_db().cursor(), id)
+        if detail is None:  # 本が見つからなかった場合
+            return {'error': 'book-id-does-not-exist'}, 404
+        return detail
+
+    return conditional_json(['Books', 'Genre', 'Copies', 'Libraries', 'CoAuthors',
+                             'Authors', 'Histories'], build)
+
+
+@app.route('/api/authors')
+def api_authors() -> Response:
+    def build() -> dict:
+        cur = get_db().cursor()
+        rows, prev_args, next_args = fetch_page(
+            cur, f'SELECT {AUTHOR_LIST_COLUMNS} FROM Authors a WHERE 1', 'a.AuthorID')
+        prev_url, next_url = page_urls(prev_args, next_args)
+        return {'authors': [dict(row) for row in rows], 'prev': prev_url, 'next': next_url}
+
+    return conditional_json(['Authors', 'CoAuthors'], build)
+
+
+@app.route('/api/authors/<int:id>')
+def api_author(id: int) -> Response:
+    def build() -> dict | tuple[dict, int]:
+        cur = get_db().cursor()
+        author = cur.execute(f'SELECT {AUTHOR_LIST_COLUMNS} FROM Authors a WHERE a.AuthorID = ?',
+                             (id,)).fetchone()
+        if author is None:  # 著者が見つからなかった場合
+            return {'error': 'author-id-does-not-exist'}, 404
+        rows, prev_args, next_args = fetch_author_books(cur, id)
+        prev_url, next_url = page_urls(prev_args, next_args, id=str(id))
+        return {'author': dict(author), 'books': rows, 'prev': prev_url, 'next': next_url}
+
+    return conditional_json(['Authors', 'CoAuthors', 'Books', 'Copies', 'Histories', 'Genre'],
+                            build)
+
+
+@app.route('/api/users')
+def api_users() -> Response:
+    def build() -> dict:
+        cur = get_db().cursor()
+        rows, prev_args, next_args = fetch_page(cur, 'SELECT * FROM Users WHERE 1', 'UserID')
+        prev_url, next_url = page_urls(prev_args, next_args)
+        return {'users': [dict(row) for row in rows], 'prev': prev_url, 'next': next_url}
+
+    return conditional_json(['Users'], build)
+
+
+@app.route('/api/users/<int:id>')
+def api_user(id: int) -> Response:
+    def build() -> dict | tuple[dict, int]:
+        cur = get_db().cursor()
+        user = cur.execute('SELECT * FROM Users WHERE UserID = ?;', (id, )).fetchone()
+        if user is None:  # ユーザーが見つからなかった場合
+            return {'error': 'user-id-does-not-exist'}, 404
+        # /users/<id> と同じく、貸し出し中は全件、返却済みは新しい順に 1 ページ分を返す
+        open_loans = fetch_open_loans(cur, id)
+        histories, prev_args, next_args = fetch_history_page(cur, id)
+        prev_url, next_url = page_urls(prev_args, next_args, id=str(id))
+        return {'user': dict(user), 'open_loans': [dict(row) for row in open_loans],
+                'histories': [dict(row) for row in histories],
+                'prev': prev_url, 'next': next_url}
+
+    return conditional_json(['Users', 'Histories', 'HistoriesArchive'], build)
+
+
+def create_app(config: dict | None = None) -> Flask:
+    # 本番用の入口（wsgi.py から呼ぶ）。設定を上書きしてアプリケーションを返す
+    # 環境変数 LIBRARY_DATABASE があれば DATABASE をそれで上書きする（config の指定が優先）
+    # ルートはこのモジュールの app に登録しているので、1 プロセスに 1 つしか作れない
+    # 接続やキャッシュは最初に使われた時に作るので、ワーカーの fork 前に呼んでも共有されない
+    if 'LIBRARY_DATABASE' in os.environ:
+        app.config['DATABASE'] = os.environ['LIBRARY_DATABASE']
+    app.config.update(config or {})
+    # 存在しないファイルを指定すると SQLite が空のデータベースを作ってしまうので、ここで止める
+    if not os.path.exists(app.config['DATABASE']):
+        raise RuntimeError(f'{app.config["DATABASE"]}: データベースがありません')
+    shard_directory = app.config['SHARD_DIRECTORY']
+    if shard_directory is not None and not os.path.isdir(shard_directory):
+        raise RuntimeError(f'{shard_directory}: シャードのディレクトリがありません')
+    return app
 
 
 if __name__ == '__main__':
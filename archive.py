@@ -0,0 +1,60 @@
+# 返却済みの古い貸し出し履歴を HistoriesArchive へ移す
+# Histories を小さく保ち、貸し出し中の判定や返却の処理を軽くする
+# 書き込みロックを長く持たないよう、batch_size 行ずつ別のトランザクションで移す
+import datetime
+import json
+import sqlite3
+import time
+
+from db import run_transaction
+import shards
+from validation import format_timestamp
+
+
+BATCH_SIZE: int = 10000
+
+
+def archive_cutoff(days: int) -> str:
+    # 今から days 日前の日時（これより前に返却された履歴を移す）
+    return format_timestamp(datetime.datetime.now() - datetime.timedelta(days=days))
+
+
+def archive_histories(con: sqlite3.Connection, cutoff: str,
+                      batch_size: int = BATCH_SIZE, pause: float = 0.0) -> int:
+    # ReturnTime が cutoff より前の履歴を移し、移した行数を返す
+    # （貸し出し中の履歴は移さない。pause 秒ずつ間を空けて他の書き込みを通す）
+    # 図書館ごとのシャードに分けている場合はシャードごとに移す
+    moved = 0
+    for table in shards.all_tables(con.cursor(), 'Histories'):
+        moved += archive_table(con, table, cutoff, batch_size, pause)
+    return moved
+
+
+def archive_table(con: sqlite3.Connection, table: str, cutoff: str,
+                  batch_size: int, pause: float) -> int:
+    moved = 0
+    last_rowid = 0
+
+    def move(cur: sqlite3.Cursor) -> list[int]:
+        rowids = [row[0] for row in cur.execute(
+            f'SELECT rowid FROM {table} '
+            'WHERE rowid > ? AND ReturnTime IS NOT NULL AND ReturnTime < ? '
+            'ORDER BY rowid LIMIT ?', (last_rowid, cutoff, batch_size))]
+        if rowids:
+            batch = json.dumps(rowids)
+            cur.execute('INSERT INTO HistoriesArchive (CopyID, UserID, BorrowTime, ReturnTime) '
+                        f'SELECT CopyID, UserID, BorrowTime, ReturnTime FROM {table} '
+                        'WHERE rowid IN (SELECT value FROM json_each(?))', (batch,))
+            cur.execute(f'DELETE FROM {table} '
+                        'WHERE rowid IN (SELECT value FROM json_each(?))', (batch,))
+        return rowids
+
+    while True:
+        # 貸し出し中の書き込みとロックを取り合ったら、そのバッチだけをやり直す
+        rowids = run_transaction(con, move)
+        if not rowids:
+            return moved
+        moved += len(rowids)
+        last_rowid = rowids[-1]
+        if pause:
+            time.sleep(pause)
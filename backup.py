@@ -0,0 +1,164 @@
+# 稼働中のデータベースのオンラインバックアップ
+# ファイルをそのままコピーすると書き込みの途中を写してしまうことがあるので、SQLite の
+# バックアップ API で pages ページずつ写し、ステップの間に pause 秒空けて他の処理を通す
+#
+# バックアップ API はステップの間に他の接続が書き込むと最初から写し直すため、書き込みが
+# 続いているといつまでも終わらない。WAL モードでは写し始めに読み取りのトランザクションを
+# 開いて最後まで持つので、写し直しにならず、写し始めた時点の内容になる
+# （WAL では読み取りは書き込みを止めない。ただしその間はチェックポイントが進まず WAL が伸びる）
+#
+# 写したファイルは integrity_check で確かめてから置き、gzip で圧縮することもできる
+# 図書館ごとのシャードを ATTACH した接続なら、カタログと全シャードを同じ名前で写す
+# （ファイルごとの時点は読み取りを始めた順にわずかにずれる。shards.py の注意を参照）
+from contextlib import closing
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+import shards
+
+
+BACKUP_PAGES: int = 256
+BACKUP_PAUSE: float = 0.01
+
+# 進み具合を受け取る関数（スキーマ名, 残りのページ数, 全ページ数）
+Progress = Callable[[str, int, int], None]
+
+
+def backup_targets(cur: sqlite3.Cursor, destination: str) -> dict[str, str]:
+    # スキーマ名 -> 書き出すファイル
+    # シャードが無ければ destination はファイル、あればカタログとシャードを置くディレクトリ
+    schemas = shards.shard_schemas(cur)
+    if not schemas:
+        return {'main': destination}
+    targets = {'main': os.path.join(destination, shards.CATALOG)}
+    for library_id, schema in schemas.items():
+        targets[schema] = shards.shard_path(destination, library_id)
+    return targets
+
+
+def copy_schema(con: sqlite3.Connection, schema: str, path: str,
+                pages: int, pause: float, progress: Progress | None = None) -> None:
+    # con の schema を path へ pages ページずつ写す
+    def step(status: int, remaining: int, total: int) -> None:
+        if progress is not None:
+            progress(schema, remaining, total)
+        if pause and remaining:
+            time.sleep(pause)
+
+    with closing(sqlite3.connect(path)) as target:
+        con.backup(target, pages=pages, progress=step, name=schema)
+        # 元のデータベースの WAL の設定も写るので、1 ファイルで完結する形に戻しておく
+        target.execute('PRAGMA journal_mode = DELETE')
+
+
+def check_integrity(path: str) -> list[str]:
+    # integrity_check の結果（問題が無ければ空）
+    with closing(sqlite3.connect(path)) as con:
+        rows = [row[0] for row in con.execute('PRAGMA integrity_check')]
+    return [] if rows == ['ok'] else rows
+
+
+def compress_file(source: str, path: str) -> None:
+    with open(source, 'rb') as f, gzip.open(path, 'wb') as out:
+        shutil.copyfileobj(f, out, 1024 * 1024)
+
+
+def backup(con: sqlite3.Connection, destination: str, pages: int = BACKUP_PAGES,
+           pause: float = BACKUP_PAUSE, compress: bool = False, check: bool = True,
+           progress: Progress | None = None) -> dict[str, str]:
+    # con のデータベースを destination へ写し、スキーマ名 -> 書き出したファイルを返す
+    # （compress なら各ファイルの名前に .gz を付けて gzip で圧縮する）
+    # 書き出す先に既にファイルがあれば FileExistsError、写したファイルが壊れていれば
+    # sqlite3.DatabaseError を送出する（途中のファイルは残さない）
+    targets = backup_targets(con.cursor(), destination)
+    if compress:
+        targets = {schema: path + '.gz' for schema, path in targets.items()}
+    for path in targets.values():
+        if os.path.exists(path):
+            raise FileExistsError(f'{path}: 既にファイルがあります')
+    for path in targets.values():
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    temporaries = {schema: path + '.tmp' for schema, path in targets.items()}
+    try:
+        hold = con.execute('PRAGMA main.journal_mode').fetchone()[0].lower() == 'wal'
+        if hold:
+            # 全てのファイルの読み取りを始め、写し終わるまで同じ時点を読む
+            con.execute('BEGIN')
+            for schema in targets:
+                con.execute(f'SELECT count(*) FROM {schema}.sqlite_master').fetchone()
+        try:
+            for schema, path in temporaries.items():
+                copy_schema(con, schema, path, pages, pause, progress)
+        finally:
+            if hold:
+                con.rollback()
+
+        for schema, path in temporaries.items():
+            if check:
+                errors = check_integrity(path)
+                if errors:
+                    raise sqlite3.DatabaseError(
+                        f'{targets[schema]}: integrity_check で問題が見つかりました: '
+                        + '; '.join(errors[:10]))
+            if compress:
+                compress_file(path, path + '.gz')
+                os.remove(path)
+                path += '.gz'
+        for schema, path in temporaries.items():
+            os.replace(path + '.gz' if compress else path, targets[schema])
+    finally:
+        for path in temporaries.values():
+            for leftover in (path, path + '.gz', path + '-journal', path + '-wal', path + '-shm'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    return targets
+
+
+def backup_name(now: datetime.datetime | None = None) -> str:
+    # 管理画面から取るバックアップの名前（日時順に並ぶ）
+    return (now or datetime.datetime.now()).strftime('library-%Y%m%d-%H%M%S')
+
+
+class BackupRunner:
+    # 管理画面から頼まれたバックアップを別スレッドで取る（同時に 1 つだけ）
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._status: dict[str, Any] = {'state': 'idle'}
+
+    def start(self, run: Callable[[Progress], dict[str, str]], destination: str) -> bool:
+        # run(progress) を別スレッドで実行する（実行中なら何もせず False を返す）
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._status = {'state': 'running', 'destination': destination,
+                            'started': time.time(), 'progress': {}}
+            self._thread = threading.Thread(target=self._run, args=(run,),
+                                            name='backup', daemon=True)
+            self._thread.start()
+        return True
+
+    def status(self) -> dict[str, Any]:
+        with self._lock:
+            return dict(self._status, progress=dict(self._status.get('progress', {})))
+
+    def _progress(self, schema: str, remaining: int, total: int) -> None:
+        with self._lock:
+            self._status['progress'][schema] = {'remaining': remaining, 'total': total}
+
+    def _run(self, run: Callable[[Progress], dict[str, str]]) -> None:
+        try:
+            files = run(self._progress)
+        except Exception as e:
+            result = {'state': 'failed', 'error': str(e)}
+        else:
+            result = {'state': 'done', 'files': files}
+        with self._lock:
+            self._status.update(result, finished=time.time())
@@ -0,0 +1,377 @@
+# ルートごとの負荷測定
+# app.py の全ルートへ指定した並列数でリクエストを送り、ルートごとのスループットと
+# レイテンシ（p50/p95/p99）を表示する
+# 結果を JSON で保存しておけば、次回以降の測定と比べて遅くなったルートが分かる
+#
+#   python gen_data.py bench.db
+#   python bench.py bench.db --threads 8 --iterations 50 --save baseline.json
+#   python bench.py bench.db --threads 8 --iterations 50 --compare baseline.json
+#   python bench.py bench.db --url http://127.0.0.1:8000   # 起動中のサーバを測る
+import argparse
+import io
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from db import connect
+
+
+# 1 リクエストの送信先（返り値は (ステータスコード, リダイレクト先)）
+Client = Callable[[str, str, dict | None, tuple[str, bytes] | None], tuple[int, str]]
+
+
+class TestClient:
+    # Flask のテストクライアントで同じプロセス内のアプリを呼び出す
+    def __init__(self, app) -> None:
+        self._app = app
+        self._local = threading.local()
+
+    def __call__(self, method: str, path: str, form: dict | None = None,
+                 upload: tuple[str, bytes] | None = None) -> tuple[int, str]:
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self._app.test_client()
+        data = dict(form or {})
+        if upload is not None:
+            data['file'] = (io.BytesIO(upload[1]), upload[0])
+        response = client.open(path, method=method, data=data or None)
+        response.close()
+        return response.status_code, response.headers.get('Location', '')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HttpClient:
+    # 起動中のサーバへ HTTP で送る（リダイレクトはたどらない）
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url.rstrip('/')
+        self._opener = urllib.request.build_opener(NoRedirect)
+
+    def __call__(self, method: str, path: str, form: dict | None = None,
+                 upload: tuple[str, bytes] | None = None) -> tuple[int, str]:
+        headers = {}
+        body = None
+        if upload is not None:
+            boundary = uuid.uuid4().hex
+            body = b''
+            for name, value in (form or {}).items():
+                body += (f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"'
+                         f'\r\n\r\n{value}\r\n').encode()
+            body += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                     f'filename="{upload[0]}"\r\n\r\n').encode() + upload[1] + b'\r\n'
+            body += f'--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+        elif form is not None:
+            body = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers,
+                                     method=method)
+        try:
+            with self._opener.open(req) as response:
+                response.read()
+                return response.status, response.headers.get('Location', '')
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers.get('Location', '')
+
+
+class Recorder:
+    # ルートごとのレイテンシ（秒）とエラー数を集める
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.elapsed: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, latency: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies.setdefault(route, []).append(latency)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    # 最近接順位法（values は昇順に並んでいること）
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+def timed(client: Client, recorder: Recorder, route: str, method: str, path: str,
+          form: dict | None = None, upload: tuple[str, bytes] | None = None,
+          expected_code: str | None = None) -> None:
+    # リクエストを 1 回送って記録する
+    # 4xx/5xx と、処理結果コードが期待どおりでないリダイレクトはエラーとして数える
+    started = time.perf_counter()
+    try:
+        status, location = client(method, path, form, upload)
+    except Exception:
+        recorder.record(route, time.perf_counter() - started, False)
+        return
+    latency = time.perf_counter() - started
+    ok = status < 400
+    if ok and expected_code is not None:
+        ok = location.rstrip('/').endswith('/' + expected_code)
+    recorder.record(route, latency, ok)
+
+
+class Dataset:
+    # 測定に使う既存の ID をデータベースから抜き出しておく
+    def __init__(self, database: str, sample_size: int = 1000,
+                 shard_directory: str | None = None) -> None:
+        con = connect(database, {}, shard_directory=shard_directory)
+        try:
+            def sample(sql: str) -> list:
+                return [row[0] for row in con.execute(sql, (sample_size,))]
+            self.book_ids = sample('SELECT BookID FROM Books ORDER BY random() LIMIT ?')
+            self.user_ids = sample('SELECT DISTINCT UserID FROM Histories '
+                                   'ORDER BY random() LIMIT ?') or \
+                sample('SELECT UserID FROM Users ORDER BY random() LIMIT ?')
+            self.copy_ids = sample('SELECT CopyID FROM Copies ORDER BY random() LIMIT ?')
+            self.titles = sample('SELECT substr(Title, 1, 3) FROM Books '
+                                 'ORDER BY random() LIMIT ?')
+            self.names = sample('SELECT substr(Name, 1, 2) FROM Users ORDER BY random() LIMIT ?')
+            self.genre_ids = sample('SELECT GenreID FROM Genre LIMIT ?')
+            self.author_ids = sample('SELECT AuthorID FROM Authors LIMIT ?')
+            self.library_ids = sample('SELECT LibraryID FROM Libraries LIMIT ?')
+            # 書き込みの測定で作る ID はこの値より大きくする
+            self.next_id = 1 + max(con.execute(
+                'SELECT max(ifnull((SELECT max(BookID) FROM Books), 0), '
+                'ifnull((SELECT max(CopyID) FROM Copies), 0), '
+                'ifnull((SELECT max(UserID) FROM Users), 0))').fetchone()[0], 0)
+        finally:
+            con.close()
+        if not (self.book_ids and self.user_ids and self.copy_ids and self.genre_ids
+                and self.author_ids and self.library_ids):
+            raise SystemExit(f'{database}: データが足りません（gen_data.py で作成してください）')
+        self._lock = threading.Lock()
+
+    def new_id(self) -> int:
+        with self._lock:
+            self.next_id += 1
+            return self.next_id
+
+
+# 読み取りのルート: (ルート名, 呼び出す関数)
+def read_routes(data: Dataset) -> list[tuple[str, Callable[[Client, Recorder], None]]]:
+    def get(route: str, path: Callable[[], str]) -> tuple[str, Callable]:
+        return route, lambda client, rec: timed(client, rec, route, 'GET', path())
+
+    def post(route: str, path: str, form: Callable[[], dict]) -> tuple[str, Callable]:
+        return route, lambda client, rec: timed(client, rec, route, 'POST', path, form())
+
+    c = random.choice
+    return [
+        get('GET /', lambda: '/'),
+        get('GET /books', lambda: '/books'),
+        get('GET /books?after', lambda: f'/books?after={c(data.book_ids)}'),
+        get('GET /books_filtered', lambda: '/books_filtered?' + urllib.parse.urlencode(
+            {'title_filter': c(data.titles)})),
+        post('POST /books_filtered', '/books_filtered', lambda: {'title_filter': c(data.titles)}),
+        get('GET /genres_filtered', lambda: f'/genres_filtered?genre_filter={c(data.genre_ids)}'),
+        post('POST /genres_filtered', '/genres_filtered',
+             lambda: {'genre_filter': c(data.genre_ids)}),
+        get('GET /books/<id>', lambda: f'/books/{c(data.book_ids)}'),
+        get('GET /cache-stats', lambda: '/cache-stats'),
+        get('GET /book-add', lambda: '/book-add'),
+        get('GET /copy-add', lambda: '/copy-add'),
+        get('GET /book-del/<id>', lambda: f'/book-del/{c(data.book_ids)}'),
+        get('GET /copy-del/<id>', lambda: f'/copy-del/{c(data.copy_ids)}'),
+        get('GET /users', lambda: '/users'),
+        get('GET /users?user_filter', lambda: '/users?' + urllib.parse.urlencode(
+            {'user_filter': c(data.names)})),
+        post('POST /users', '/users', lambda: {'user_filter': c(data.names)}),
+        get('GET /users/<id>', lambda: f'/users/{c(data.user_ids)}'),
+        get('GET /user-add', lambda: '/user-add'),
+        get('GET /overdue', lambda: '/overdue'),
+        get('GET /stats', lambda: '/stats'),
+        get('GET /authors', lambda: '/authors'),
+        get('GET /authors/<id>', lambda: f'/authors/{c(data.author_ids)}'),
+        get('GET /suggest', lambda: '/suggest?' + urllib.parse.urlencode(
+            {'q': c(data.titles)[:2]})),
+        get('GET /export/books.csv', lambda: '/export/books.csv'),
+        get('GET /export/histories.jsonl?gzip', lambda: '/export/histories.jsonl?gzip=1'),
+        get('GET /import', lambda: '/import'),
+        get('GET /borrow-add', lambda: '/borrow-add'),
+        get('GET /borrow-batch', lambda: '/borrow-batch'),
+        get('GET /return-batch', lambda: '/return-batch'),
+        get('GET /*-results/<code>', lambda: c([
+            '/book-add-results/book-added', '/copy-add-results/copy-added',
+            '/book-del-results/deleted', '/copy-del-results/deleted',
+            '/user-add-results/user-added', '/borrow-add-results/borrow-added',
+            '/return-add-results/return-added', '/history-del-results/history-deleted',
+            '/user-del-results/user-deleted'])),
+        get('GET /api/books', lambda: '/api/books'),
+        get('GET /api/books/<id>', lambda: f'/api/books/{c(data.book_ids)}'),
+        get('GET /api/users', lambda: '/api/users'),
+        get('GET /api/users/<id>', lambda: f'/api/users/{c(data.user_ids)}'),
+        get('GET /api/authors', lambda: '/api/authors'),
+        get('GET /api/authors/<id>', lambda: f'/api/authors/{c(data.author_ids)}'),
+    ]
+
+
+def write_flow(client: Client, rec: Recorder, data: Dataset) -> None:
+    # 書き込みのルートを一通り呼び出し、作ったデータは最後に削除する
+    book_id, copy_id, user_id, import_user_id = (data.new_id() for _ in range(4))
+    borrow_time = time.strftime('%Y-%m-%d %H:%M:%S')
+    timed(client, rec, 'POST /book-add', 'POST', '/book-add', {
+        'book_id': book_id, 'title': f'負荷測定 {book_id}', 'publish_year': 2024,
+        'author_id': random.choice(data.author_ids), 'genre_id': random.choice(data.genre_ids)},
+        expected_code='book-added')
+    timed(client, rec, 'POST /copy-add', 'POST', '/copy-add', {
+        'book_id': book_id, 'copy_id': copy_id, 'library_id': random.choice(data.library_ids)},
+        expected_code='copy-added')
+    timed(client, rec, 'POST /user-add', 'POST', '/user-add', {
+        'user_id': user_id, 'name': f'負荷測定 {user_id}',
+        'email_address': f'bench{user_id}@example.com', 'phone_number': ''},
+        expected_code='user-added')
+    timed(client, rec, 'POST /borrow-add', 'POST', '/borrow-add', {
+        'user_id': user_id, 'copy_id': copy_id, 'borrow_time': borrow_time},
+        expected_code='borrow-added')
+    timed(client, rec, 'POST /return-add', 'POST', '/return-add', {
+        'user_id': user_id, 'copy_id': copy_id, 'borrow_time': borrow_time,
+        'return_time': borrow_time}, expected_code='return-added')
+    timed(client, rec, 'POST /history-del', 'POST',
+          f'/history-del/{copy_id}/{user_id}/{urllib.parse.quote(borrow_time)}',
+          expected_code='history-deleted')
+    timed(client, rec, 'POST /borrow-batch', 'POST', '/borrow-batch', {
+        'user_id': user_id, 'copy_ids': str(copy_id), 'borrow_time': borrow_time})
+    timed(client, rec, 'POST /return-batch', 'POST', '/return-batch', {
+        'user_id': user_id, 'copy_ids': str(copy_id), 'return_time': borrow_time})
+    timed(client, rec, 'POST /history-del', 'POST',
+          f'/history-del/{copy_id}/{user_id}/{urllib.parse.quote(borrow_time)}',
+          expected_code='history-deleted')
+    timed(client, rec, 'POST /copy-del/<id>', 'POST', f'/copy-del/{copy_id}',
+          expected_code='deleted')
+    timed(client, rec, 'POST /book-del/<id>', 'POST', f'/book-del/{book_id}',
+          expected_code='deleted')
+    timed(client, rec, 'POST /import', 'POST', '/import', {'kind': 'users'},
+          (f'users{import_user_id}.csv',
+           f'user_id,name,email_address,phone_number\n{import_user_id},負荷測定,,\n'.encode()))
+    for deleted in (user_id, import_user_id):
+        timed(client, rec, 'POST /user_del/<id>', 'POST', f'/user_del/{deleted}',
+              expected_code='user-deleted')
+
+
+def run_phase(threads: int, iterations: int, job: Callable[[], None]) -> float:
+    # job を threads 並列で合計 threads * iterations 回実行し、かかった秒数を返す
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [executor.submit(job) for _ in range(threads * iterations)]:
+            future.result()
+    return time.perf_counter() - started
+
+
+def summarize(recorder: Recorder) -> dict[str, dict[str, float]]:
+    results = {}
+    for route, latencies in recorder.latencies.items():
+        latencies.sort()
+        results[route] = {
+            'count': len(latencies),
+            'errors': recorder.errors.get(route, 0),
+            'throughput': len(latencies) / recorder.elapsed[route],
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # p95 が (1 + tolerance) 倍を超えるか、スループットが (1 - tolerance) 倍を下回ったルート
+    regressions = []
+    for route, result in results.items():
+        base = baseline.get(route)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{route}: p95 {base["p95_ms"]:.2f} -> {result["p95_ms"]:.2f} ms')
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append(f'{route}: スループット {base["throughput"]:.1f} -> '
+                               f'{result["throughput"]:.1f} req/s')
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='ルートごとの負荷測定')
+    parser.add_argument('database', help='測定に使うデータベース（gen_data.py で作成）')
+    parser.add_argument('--url', help='起動中のサーバの URL（省略時はテストクライアントを使う）')
+    parser.add_argument('--threads', type=int, default=4, help='並列数')
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='1 スレッドあたりの各ルートの呼び出し回数')
+    parser.add_argument('--no-writes', action='store_true', help='書き込みのルートを測らない')
+    parser.add_argument('--writer-mode', action='store_true',
+                        help='テストクライアントで WRITER_MODE を有効にする')
+    parser.add_argument('--shard-directory',
+                        help='テストクライアントで使う図書館ごとのシャードのディレクトリ（split-shards で作成）')
+    parser.add_argument('--routes', help='測るルート名に含まれる文字列（読み取りのみ）')
+    parser.add_argument('--save', help='結果を保存する JSON ファイル')
+    parser.add_argument('--compare', help='比較するベースラインの JSON ファイル')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='悪化とみなす割合（0.2 なら 20%%）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    data = Dataset(args.database, shard_directory=args.shard_directory)
+    if args.url:
+        client: Client = HttpClient(args.url)
+    else:
+        from app import app
+        app.config['DATABASE'] = args.database
+        app.config['WRITER_MODE'] = args.writer_mode
+        app.config['SHARD_DIRECTORY'] = args.shard_directory
+        client = TestClient(app)
+
+    recorder = Recorder()
+    for route, call in read_routes(data):
+        if args.routes and args.routes not in route:
+            continue
+        call(client, Recorder())  # 初回（接続の作成やテンプレートの読み込み）は数えない
+        recorder.elapsed[route] = run_phase(args.threads, args.iterations,
+                                            lambda: call(client, recorder))
+    if not args.no_writes and not args.routes:
+        elapsed = run_phase(args.threads, args.iterations,
+                            lambda: write_flow(client, recorder, data))
+        for route in recorder.latencies:
+            recorder.elapsed.setdefault(route, elapsed)
+
+    results = summarize(recorder)
+    print(f'{"ルート":<27} {"回数":>4} {"エラー":>3} {"req/s":>9} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for route, r in results.items():
+        print(f'{route:<30} {r["count"]:>6} {r["errors"]:>6} {r["throughput"]:>9.1f} '
+              f'{r["p50_ms"]:>8.2f} {r["p95_ms"]:>8.2f} {r["p99_ms"]:>8.2f}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({'settings': {'database': args.database, 'url': args.url,
+                                    'threads': args.threads, 'iterations': args.iterations,
+                                    'writer_mode': args.writer_mode,
+                                    'shard_directory': args.shard_directory},
+                       'routes': results}, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['routes']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('悪化:', line)
+        if regressions:
+            sys.exit(1)
+        print('ベースラインからの悪化はありません')
+
+
+if __name__ == '__main__':
+    main()
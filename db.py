@@ -0,0 +1,165 @@
+# SQLite 接続の管理
+# ワーカースレッドごとに接続を 1 本だけ持ち、リクエストをまたいで使い回す
+import random
+import sqlite3
+import threading
+import time
+import urllib.parse
+from typing import Any, Callable
+
+import shards
+
+
+def connect(database: str, pragmas: dict[str, str | int],
+            cached_statements: int = 128, readonly: bool = False,
+            isolation_level: str | None = '',
+            factory: type[sqlite3.Connection] = sqlite3.Connection,
+            shard_directory: str | None = None) -> sqlite3.Connection:
+    # 接続を作成し、チューニング用の PRAGMA を適用する
+    # shard_directory を指定すると図書館ごとのシャードを ATTACH する（shards.py）
+    # （スレッドをまたいだ close を許すため check_same_thread は外す。
+    #   実際に使うのは接続を作成したスレッドだけ）
+    if readonly:
+        database = f'file:{urllib.parse.quote(database)}?mode=ro'
+    con = sqlite3.connect(database, cached_statements=cached_statements,
+                          check_same_thread=False, uri=readonly,
+                          isolation_level=isolation_level, factory=factory)
+    con.row_factory = sqlite3.Row  # カラム名でアクセスできるよう設定変更
+    for name, value in pragmas.items():
+        if readonly and name == 'journal_mode':
+            # ジャーナルモードの切り替えは書き込みのできる接続で行う
+            continue
+        con.execute(f'PRAGMA {name} = {value}')
+    if shard_directory is not None:
+        shards.attach_shards(con, shard_directory, pragmas, readonly)
+    return con
+
+
+def has_table(cur: sqlite3.Cursor, table: str) -> bool:
+    # マイグレーション前のデータベースでは無いテーブルがある
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (table,)).fetchone() is not None
+
+
+def begin_immediate(cur: sqlite3.Cursor) -> None:
+    cur.execute('BEGIN IMMEDIATE')
+
+
+def is_busy(e: BaseException) -> bool:
+    # 他の接続（他のプロセスを含む）のロックが外れなかった（SQLITE_BUSY と拡張コード）
+    # WAL で読み取りを始めた後に書き込もうとして先を越された場合（SQLITE_BUSY_SNAPSHOT）は
+    # busy_timeout を待たずに返るので、トランザクションを始めからやり直すしかない
+    return (isinstance(e, sqlite3.OperationalError)
+            and (getattr(e, 'sqlite_errorcode', None) or 0) & 0xff == sqlite3.SQLITE_BUSY)
+
+
+def retry_delay(attempt: int, backoff: float) -> float:
+    # やり直すまでの秒数（回数ごとに倍にし、同時にやり直さないよう揺らす）
+    return backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+
+def run_transaction(con: sqlite3.Connection, job: Callable[[sqlite3.Cursor], Any],
+                    begin: Callable[[sqlite3.Cursor], None] | None = begin_immediate,
+                    retries: int = 5, backoff: float = 0.01,
+                    observe: Callable[[float, int], None] | None = None) -> Any:
+    # job(cursor) を 1 つのトランザクションで実行してコミットし、戻り値を返す
+    # ロックが取れずに失敗した場合は取り消して少し待ち、retries 回まで始めからやり直す
+    # （job は何度呼ばれても良いように、書き込みは全てカーソル経由で行うこと）
+    # begin を None にすると最初の書き込みで始まる暗黙のトランザクションに任せる
+    # observe にはロックを取るまでに待った秒数（やり直しの待ちを含む）とやり直した回数を渡す
+    waited = 0.0
+    attempt = 0
+    while True:
+        cur = con.cursor()
+        started = time.perf_counter()
+        try:
+            try:
+                if begin is not None:
+                    begin(cur)
+            finally:
+                waited += time.perf_counter() - started
+            result = job(cur)
+            con.commit()
+        except BaseException as e:
+            if con.in_transaction:
+                con.rollback()
+            if not is_busy(e) or attempt >= retries:
+                if observe is not None:
+                    observe(waited, attempt)
+                raise
+            delay = retry_delay(attempt, backoff)
+            time.sleep(delay)
+            waited += delay
+            attempt += 1
+            continue
+        if observe is not None:
+            observe(waited, attempt)
+        return result
+
+
+class ConnectionPool:
+    def __init__(self, database: str, pragmas: dict[str, str | int],
+                 cached_statements: int = 128, max_age: float = 3600.0,
+                 max_uses: int = 10000, readonly: bool = False,
+                 factory: type[sqlite3.Connection] = sqlite3.Connection,
+                 shard_directory: str | None = None) -> None:
+        self.database = database
+        self.readonly = readonly  # 読み取り専用で開く（書き込みは専用スレッドが行う場合）
+        self.pragmas = pragmas
+        self.cached_statements = cached_statements
+        self.max_age = max_age  # この秒数を超えた接続は作り直す
+        self.max_uses = max_uses  # この回数貸し出した接続は作り直す
+        self.factory = factory  # 接続のクラス（計測する場合は metrics.TimedConnection）
+        self.shard_directory = shard_directory  # 図書館ごとのシャードのディレクトリ
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: set[sqlite3.Connection] = set()
+
+    def acquire(self) -> sqlite3.Connection:
+        # 呼び出したスレッドの接続を返す（無いか不調なら作り直す）
+        con = getattr(self._local, 'connection', None)
+        if con is not None and not self._healthy():
+            self._discard(con)
+            con = None
+        if con is None:
+            con = connect(self.database, self.pragmas, self.cached_statements,
+                          readonly=self.readonly, factory=self.factory,
+                          shard_directory=self.shard_directory)
+            self._local.connection = con
+            self._local.created = time.monotonic()
+            self._local.uses = 0
+            with self._lock:
+                self._connections.add(con)
+        self._local.uses += 1
+        return con
+
+    def release(self, con: sqlite3.Connection) -> None:
+        # コミットされなかった変更は次のリクエストへ持ち越さない
+        if con.in_transaction:
+            con.rollback()
+
+    def close_all(self) -> None:
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for con in connections:
+            con.close()
+
+    def _healthy(self) -> bool:
+        if time.monotonic() - self._local.created > self.max_age:
+            return False
+        if self._local.uses >= self.max_uses:
+            return False
+        try:
+            self._local.connection.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, con: sqlite3.Connection) -> None:
+        self._local.connection = None
+        with self._lock:
+            self._connections.discard(con)
+        try:
+            con.close()
+        except sqlite3.Error:
+            pass
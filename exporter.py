@@ -0,0 +1,110 @@
+# 本・蔵書・ユーザー・貸し出し履歴の CSV / JSONL 出力
+# 行は chunk_size 件ずつ取り出して書き出すので、表の大きさに関わらず使うメモリは一定
+# 1 つの読み取りトランザクションの中で読むので、出力中に更新されても内容は食い違わない
+# 列名は一括登録（importer.FIELDS）と同じものを先頭に置き、出力したファイルをそのまま登録し直せる
+import csv
+import io
+import json
+import sqlite3
+import zlib
+from typing import Iterator
+
+from db import has_table
+
+
+CHUNK_SIZE: int = 1000
+
+# 種類 -> 問い合わせ
+EXPORTS: dict[str, str] = {
+    'books': '''
+    SELECT b.BookID AS book_id, b.Title AS title, b.Year AS publish_year,
+        (SELECT group_concat(AuthorID, ',') FROM
+            (SELECT AuthorID FROM CoAuthors WHERE BookID = b.BookID ORDER BY AuthorID)) AS author_id,
+        b.GenreID AS genre_id, g.Name AS genre_name,
+        (SELECT group_concat(Name, ',') FROM
+            (SELECT a.Name FROM CoAuthors ca JOIN Authors a ON a.AuthorID = ca.AuthorID
+             WHERE ca.BookID = b.BookID ORDER BY ca.AuthorID)) AS author_names
+    FROM Books b LEFT JOIN Genre g ON g.GenreID = b.GenreID
+    ORDER BY b.BookID
+    ''',
+    'copies': '''
+    SELECT c.BookID AS book_id, c.CopyID AS copy_id, c.LibraryID AS library_id,
+        l.Name AS library_name
+    FROM Copies c LEFT JOIN Libraries l ON l.LibraryID = c.LibraryID
+    ORDER BY c.CopyID
+    ''',
+    'users': '''
+    SELECT UserID AS user_id, Name AS name, Email AS email_address, PhoneNumber AS phone_number
+    FROM Users ORDER BY UserID
+    ''',
+    'histories': '''
+    SELECT CopyID AS copy_id, UserID AS user_id, BorrowTime AS borrow_time,
+        ReturnTime AS return_time, 0 AS archived
+    FROM Histories
+    ''',
+}
+
+# HistoriesArchive がある場合に histories へ続けて出力する分
+ARCHIVED_HISTORIES = '''
+    UNION ALL
+    SELECT CopyID, UserID, BorrowTime, ReturnTime, 1 FROM HistoriesArchive
+'''
+
+FORMATS: dict[str, str] = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def export_rows(con: sqlite3.Connection, kind: str,
+                chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[list[str], list[tuple]]]:
+    # (列名, 行のまとまり) を順に返す
+    # con は出力専用の接続（読み終わるとトランザクションを終える）
+    query = EXPORTS[kind]
+    cur = con.cursor()
+    cur.execute('BEGIN')
+    try:
+        if kind == 'histories' and has_table(cur, 'HistoriesArchive'):
+            query += ARCHIVED_HISTORIES
+        cur.execute(query)
+        columns = [column[0] for column in cur.description]
+        rows = cur.fetchmany(chunk_size)
+        yield columns, [tuple(row) for row in rows]  # 0 件でも列名は返す
+        while rows:
+            rows = cur.fetchmany(chunk_size)
+            if rows:
+                yield columns, [tuple(row) for row in rows]
+    finally:
+        con.rollback()
+
+
+def format_chunks(chunks: Iterator[tuple[list[str], list[tuple]]], fmt: str) -> Iterator[bytes]:
+    header_written = False
+    for columns, rows in chunks:
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if not header_written:
+                writer.writerow(columns)
+                header_written = True
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+        else:
+            yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+                          for row in rows).encode()
+
+
+def gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    # gzip 形式で少しずつ圧縮する
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(con: sqlite3.Connection, kind: str, fmt: str, gzip: bool = False,
+           chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    chunks = format_chunks(export_rows(con, kind, chunk_size), fmt)
+    return gzip_chunks(chunks) if gzip else chunks
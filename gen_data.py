@@ -0,0 +1,149 @@
+# 性能測定用のデータベースを作成する
+# 指定した規模の本・ジャンル・著者・共著・図書館・蔵書・ユーザー・貸し出し履歴を
+# 乱数で作成する（同じ --seed なら同じ内容になる）
+#
+#   python gen_data.py bench.db --books 300000 --users 100000 --histories 5000000
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import time
+from typing import Iterator
+
+import schema
+
+
+CHUNK_SIZE = 50000
+
+TITLE_WORDS = ['吾輩', '猫', '坊っちゃん', 'こころ', '銀河', '鉄道', '夜', '雪国', '羅生門',
+               '春', '夏', '秋', '冬', '海', '山', '図書館', '物語', '入門', '実践',
+               'Python', 'SQL', 'データベース', '設計', '歴史', '料理', '旅', '星', '風']
+FAMILY_NAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤']
+GIVEN_NAMES = ['太郎', '花子', '一郎', '美咲', '健太', '陽菜', '翔', '結衣', '大輔', '葵']
+GENRE_NAMES = ['小説', '技術', '歴史', '料理', '旅行', '芸術', '科学', '児童', '漫画', '語学']
+
+
+def chunks(rows: Iterator[tuple], size: int = CHUNK_SIZE) -> Iterator[list[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert(con: sqlite3.Connection, sql: str, rows: Iterator[tuple]) -> int:
+    count = 0
+    for chunk in chunks(rows):
+        con.executemany(sql, chunk)
+        count += len(chunk)
+    return count
+
+
+def person_name(rng: random.Random) -> str:
+    return rng.choice(FAMILY_NAMES) + rng.choice(GIVEN_NAMES)
+
+
+def generate(con: sqlite3.Connection, args: argparse.Namespace) -> dict[str, int]:
+    rng = random.Random(args.seed)
+    counts = {}
+    counts['Genre'] = insert(con, 'INSERT INTO Genre VALUES (?, ?)', (
+        (i, GENRE_NAMES[(i - 1) % len(GENRE_NAMES)] + (str(i) if i > len(GENRE_NAMES) else ''))
+        for i in range(1, args.genres + 1)))
+    counts['Libraries'] = insert(con, 'INSERT INTO Libraries VALUES (?, ?)', (
+        (i, f'第{i}図書館') for i in range(1, args.libraries + 1)))
+    counts['Authors'] = insert(con, 'INSERT INTO Authors VALUES (?, ?, ?)', (
+        (i, person_name(rng), rng.randint(1850, 2000)) for i in range(1, args.authors + 1)))
+    counts['Books'] = insert(con, 'INSERT INTO Books VALUES (?, ?, ?, ?)', (
+        (i, ''.join(rng.sample(TITLE_WORDS, rng.randint(1, 3))) + f' {i}',
+         rng.randint(1900, 2024), rng.randint(1, args.genres))
+        for i in range(1, args.books + 1)))
+    counts['CoAuthors'] = insert(con, 'INSERT INTO CoAuthors VALUES (?, ?)', (
+        (book_id, author_id)
+        for book_id in range(1, args.books + 1)
+        for author_id in rng.sample(range(1, args.authors + 1),
+                                    min(args.authors, rng.randint(1, args.max_coauthors)))))
+
+    # 蔵書は本ごとに 0 ～ 2 * copies_per_book 冊
+    def copies() -> Iterator[tuple]:
+        copy_id = 0
+        for book_id in range(1, args.books + 1):
+            for _ in range(rng.randint(0, 2 * args.copies_per_book)):
+                copy_id += 1
+                yield copy_id, book_id, rng.randint(1, args.libraries)
+    counts['Copies'] = insert(con, 'INSERT INTO Copies VALUES (?, ?, ?)', copies())
+
+    counts['Users'] = insert(con, 'INSERT INTO Users VALUES (?, ?, ?, ?)', (
+        (i, person_name(rng), f'user{i}@example.com', f'090-{i // 10000:04d}-{i % 10000:04d}')
+        for i in range(1, args.users + 1)))
+
+    # 貸し出し履歴は蔵書ごとに古い順に並べ、最後の 1 件だけが未返却になりうる
+    # （未返却の貸し出しは 1 冊につき 1 件まで）
+    def histories() -> Iterator[tuple]:
+        copy_count = counts['Copies']
+        if copy_count == 0 or args.users == 0:
+            return
+        per_copy = args.histories / copy_count
+        remaining = args.histories
+        start = datetime.datetime(2015, 1, 1)
+        for copy_id in range(1, copy_count + 1):
+            n = min(remaining, round(rng.uniform(0, 2 * per_copy)))
+            if copy_id == copy_count:
+                n = remaining
+            remaining -= n
+            borrow = start + datetime.timedelta(days=rng.randint(0, 30))
+            for k in range(n):
+                returned = borrow + datetime.timedelta(days=rng.randint(1, 21))
+                is_open = k == n - 1 and rng.random() < args.open_ratio
+                yield (copy_id, rng.randint(1, args.users),
+                       borrow.strftime('%Y-%m-%d %H:%M:%S'),
+                       None if is_open else returned.strftime('%Y-%m-%d %H:%M:%S'))
+                borrow = returned + datetime.timedelta(days=rng.randint(0, 14))
+    counts['Histories'] = insert(con, 'INSERT INTO Histories VALUES (?, ?, ?, ?)', histories())
+    return counts
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='性能測定用のデータベースを作成する')
+    parser.add_argument('database', help='作成するデータベースファイル（既にあれば作り直す）')
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--genres', type=int, default=50)
+    parser.add_argument('--authors', type=int, default=20000)
+    parser.add_argument('--max-coauthors', type=int, default=3, help='1 冊あたりの著者数の上限')
+    parser.add_argument('--libraries', type=int, default=10)
+    parser.add_argument('--copies-per-book', type=int, default=2, help='1 冊あたりの平均蔵書数')
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--histories', type=int, default=1000000)
+    parser.add_argument('--open-ratio', type=float, default=0.2,
+                        help='蔵書が貸し出し中になっている割合')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.database + suffix):
+            os.remove(args.database + suffix)
+
+    started = time.perf_counter()
+    con = sqlite3.connect(args.database, isolation_level=None)
+    con.execute('PRAGMA journal_mode = OFF')
+    con.execute('PRAGMA synchronous = OFF')
+    # テーブルだけを先に作り、データを入れてからインデックスなどを作成する
+    schema.migrate(con, target=1)
+    con.execute('BEGIN')
+    counts = generate(con, args)
+    con.execute('COMMIT')
+    schema.migrate(con)
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('ANALYZE')
+    con.close()
+
+    for table, count in counts.items():
+        print(f'{table}: {count}')
+    print(f'{time.perf_counter() - started:.1f} 秒')
+
+
+if __name__ == '__main__':
+    main()
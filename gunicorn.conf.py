@@ -0,0 +1,33 @@
+# gunicorn の本番用設定（pip install -r requirements.txt）
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# SQLite の書き込みはデータベースファイルごとに 1 つずつしか進まないので、ワーカーを増やしても
+# 書き込みは速くならない（読み取りは WAL なのでワーカー・スレッドの数だけ並列に進む）
+# ワーカー間のロックの待ちは busy_timeout と WRITE_RETRIES で吸収し、/metrics の
+# library_write_lock_wait_seconds で確かめる（stress.py で事前に測っておく）
+import multiprocessing
+import os
+
+
+bind = os.environ.get('LIBRARY_BIND', '127.0.0.1:8000')
+
+# 読み取りは CPU を使うので、ワーカー（プロセス）は CPU の数だけにする
+workers = int(os.environ.get('LIBRARY_WORKERS', multiprocessing.cpu_count()))
+# ワーカーごとのスレッド（接続はスレッドごとにプールされる。ロックを待つ間も他のリクエストを処理する）
+worker_class = 'gthread'
+threads = int(os.environ.get('LIBRARY_THREADS', 4))
+
+# 書き込みはロックを busy_timeout（5 秒）まで待ち、さらにやり直すことがあるので、それより長くする
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# 長く動かしたワーカーを入れ替える（一斉に入れ替わらないよう揺らす）
+max_requests = 10000
+max_requests_jitter = 1000
+
+# アプリケーションはワーカーごとに読み込む（接続・書き込みスレッドを fork で共有しない）
+preload_app = False
+
+accesslog = os.environ.get('LIBRARY_ACCESS_LOG', '-')
+errorlog = '-'
@@ -0,0 +1,301 @@
+# CSV / JSONL ファイルからの一括登録
+# 入力を batch_size 行ずつ読み込み、登録フォームと同じ規則でまとめてチェックして
+# executemany で挿入する（バッチごとに 1 回コミット）
+import csv
+import json
+import sqlite3
+from typing import Callable, Iterator, TextIO
+
+from db import run_transaction
+from search import search_index_add_many
+import shards
+from validation import has_control_character
+
+
+BATCH_SIZE: int = 10000
+
+# 種類ごとの列名（登録フォームの項目名と同じ）
+FIELDS: dict[str, tuple[str, ...]] = {
+    'books': ('book_id', 'title', 'publish_year', 'author_id', 'genre_id'),
+    'copies': ('book_id', 'copy_id', 'library_id'),
+    'authors': ('author_id', 'name', 'birth_year'),
+    'users': ('user_id', 'name', 'email_address', 'phone_number'),
+}
+
+# (行番号, 処理結果コード) を受け取るエラー報告先
+ErrorHandler = Callable[[int, str], None]
+
+
+def read_records(f: TextIO, fmt: str) -> Iterator[tuple[int, dict[str, str] | None]]:
+    # 1 行ずつ (行番号, 項目名 -> 値) を返す（読めない行は None）
+    if fmt == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, {k: v or '' for k, v in row.items() if k is not None}
+        return
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_no, None
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None
+            continue
+        yield line_no, {k: to_text(v) for k, v in record.items()}
+
+
+def to_text(value) -> str:
+    # JSON の値をフォームから送られてくる文字列と同じ形にそろえる
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ','.join(map(str, value))
+    return str(value)
+
+
+def to_int(s: str) -> int | None:
+    try:
+        return int(s)
+    except ValueError:
+        return None
+
+
+def existing_ids(cur: sqlite3.Cursor, table: str, column: str,
+                 ids: set[int]) -> set[int]:
+    # まとめて存在チェックする（パラメータは JSON 配列 1 つで渡す）
+    if not ids:
+        return set()
+    rows = cur.execute(f'SELECT {column} FROM {table} '
+                       f'WHERE {column} IN (SELECT value FROM json_each(?))',
+                       (json.dumps(sorted(ids)),)).fetchall()
+    return {row[0] for row in rows}
+
+
+def check_books(cur: sqlite3.Cursor,
+                batch: list[tuple[int, dict[str, str]]]) -> Iterator[tuple[int, str | None, tuple]]:
+    # book_add_execute と同じ順序でチェックする
+    books = existing_ids(cur, 'Books', 'BookID',
+                         {i for _, r in batch if (i := to_int(r.get('book_id', ''))) is not None})
+    genres = existing_ids(cur, 'Genre', 'GenreID',
+                          {i for _, r in batch if (i := to_int(r.get('genre_id', ''))) is not None})
+    authors = existing_ids(cur, 'Authors', 'AuthorID',
+                           {i for _, r in batch for a in r.get('author_id', '').split(',')
+                            if (i := to_int(a)) is not None})
+    for line_no, r in batch:
+        book_id = to_int(r.get('book_id', ''))
+        if book_id is None:
+            yield line_no, 'book-id-has-invalid-charactor', ()
+            continue
+        if book_id in books:
+            yield line_no, 'book-id-already-exists', ()
+            continue
+        title = r.get('title', '')
+        if has_control_character(title):
+            yield line_no, 'title-has-control-charactor', ()
+            continue
+        publish_year = to_int(r.get('publish_year', ''))
+        if publish_year is None:
+            yield line_no, 'publish-year-has-invalid-charactor', ()
+            continue
+        genre_id = to_int(r.get('genre_id', ''))
+        if genre_id is None:
+            yield line_no, 'genre-id-has-invalid-charactor', ()
+            continue
+        if genre_id not in genres:
+            yield line_no, 'genre-id-does-not-exists', ()
+            continue
+        author_ids = [to_int(a) for a in r.get('author_id', '').split(',')]
+        if None in author_ids:
+            yield line_no, 'author-id-has-invalid-charactor', ()
+            continue
+        if not authors.issuperset(author_ids):
+            yield line_no, 'author-id-does-not-exist', ()
+            continue
+        books.add(book_id)  # 同じファイル内での重複も弾く
+        yield line_no, None, (book_id, title, publish_year, genre_id, author_ids)
+
+
+def insert_books(cur: sqlite3.Cursor, rows: list[tuple]) -> None:
+    cur.executemany('INSERT INTO Books (BookID, Title, Year, GenreID) VALUES (?, ?, ?, ?)',
+                    [row[:4] for row in rows])
+    cur.executemany('INSERT INTO CoAuthors (BookID, AuthorID) VALUES (?, ?)',
+                    [(row[0], author) for row in rows for author in row[4]])
+    search_index_add_many(cur, 'BooksFts', [(row[0], row[1]) for row in rows])
+
+
+def check_copies(cur: sqlite3.Cursor,
+                 batch: list[tuple[int, dict[str, str]]]) -> Iterator[tuple[int, str | None, tuple]]:
+    # copy_add_execute と同じ順序でチェックする
+    books = existing_ids(cur, 'Books', 'BookID',
+                         {i for _, r in batch if (i := to_int(r.get('book_id', ''))) is not None})
+    copies = existing_ids(cur, 'Copies', 'CopyID',
+                          {i for _, r in batch if (i := to_int(r.get('copy_id', ''))) is not None})
+    libraries = existing_ids(cur, 'Libraries', 'LibraryID',
+                             {i for _, r in batch if (i := to_int(r.get('library_id', ''))) is not None})
+    for line_no, r in batch:
+        book_id = to_int(r.get('book_id', ''))
+        if book_id is None:
+            yield line_no, 'book-id-has-invalid-charactor', ()
+            continue
+        if book_id not in books:
+            yield line_no, 'book-id-does-not-exist', ()
+            continue
+        copy_id = to_int(r.get('copy_id', ''))
+        if copy_id is None:
+            yield line_no, 'copy-id-has-invalid-charactor', ()
+            continue
+        if copy_id in copies:
+            yield line_no, 'copy-already-exists', ()
+            continue
+        library_id = to_int(r.get('library_id', ''))
+        if library_id is None:
+            yield line_no, 'library-id-has-invalid-charactor', ()
+            continue
+        if library_id not in libraries:
+            yield line_no, 'library-id-does-not-exists', ()
+            continue
+        copies.add(copy_id)
+        yield line_no, None, (copy_id, book_id, library_id)
+
+
+def insert_copies(cur: sqlite3.Cursor, rows: list[tuple]) -> None:
+    # 図書館のシャードごとにまとめて挿入する（シャードをまたいだ蔵書番号の重複も確かめる）
+    shards.insert_copies(cur, rows)
+
+
+def check_authors(cur: sqlite3.Cursor,
+                  batch: list[tuple[int, dict[str, str]]]) -> Iterator[tuple[int, str | None, tuple]]:
+    authors = existing_ids(cur, 'Authors', 'AuthorID',
+                           {i for _, r in batch if (i := to_int(r.get('author_id', ''))) is not None})
+    for line_no, r in batch:
+        author_id = to_int(r.get('author_id', ''))
+        if author_id is None:
+            yield line_no, 'author-id-has-invalid-charactor', ()
+            continue
+        if author_id in authors:
+            yield line_no, 'author-id-already-exists', ()
+            continue
+        name = r.get('name', '')
+        if has_control_character(name):
+            yield line_no, 'name-has-control-charactor', ()
+            continue
+        # 生年は省略できる
+        birth_year_str = r.get('birth_year', '')
+        birth_year = to_int(birth_year_str) if birth_year_str else None
+        if birth_year_str and birth_year is None:
+            yield line_no, 'birth-year-has-invalid-charactor', ()
+            continue
+        authors.add(author_id)
+        yield line_no, None, (author_id, name, birth_year)
+
+
+def insert_authors(cur: sqlite3.Cursor, rows: list[tuple]) -> None:
+    cur.executemany('INSERT INTO Authors (AuthorID, Name, BirthYear) VALUES (?, ?, ?)', rows)
+
+
+def check_users(cur: sqlite3.Cursor,
+                batch: list[tuple[int, dict[str, str]]]) -> Iterator[tuple[int, str | None, tuple]]:
+    # user_add_execute と同じ順序でチェックする
+    users = existing_ids(cur, 'Users', 'UserID',
+                         {i for _, r in batch if (i := to_int(r.get('user_id', ''))) is not None})
+    for line_no, r in batch:
+        user_id = to_int(r.get('user_id', ''))
+        if user_id is None:
+            yield line_no, 'user-id-has-invalid-charactor', ()
+            continue
+        if user_id in users:
+            yield line_no, 'user-id-already-exists', ()
+            continue
+        name = r.get('name', '')
+        if has_control_character(name):
+            yield line_no, 'name-has-control-charactor', ()
+            continue
+        email_address = r.get('email_address', '')
+        if has_control_character(email_address):
+            yield line_no, 'email-address-has-control-charactor', ()
+            continue
+        phone_number = r.get('phone_number', '')
+        if has_control_character(phone_number):
+            yield line_no, 'phone-number-has-control-charactor', ()
+            continue
+        users.add(user_id)
+        yield line_no, None, (user_id, name, email_address, phone_number)
+
+
+def insert_users(cur: sqlite3.Cursor, rows: list[tuple]) -> None:
+    cur.executemany('INSERT INTO Users (UserID, Name, Email, PhoneNumber) VALUES (?, ?, ?, ?)',
+                    rows)
+    search_index_add_many(cur, 'UsersFts', [(row[0], row[1]) for row in rows])
+
+
+# 種類 -> (チェック, 挿入)
+IMPORTERS = {
+    'books': (check_books, insert_books),
+    'copies': (check_copies, insert_copies),
+    'authors': (check_authors, insert_authors),
+    'users': (check_users, insert_users),
+}
+
+
+def import_file(con: sqlite3.Connection, kind: str, f: TextIO, fmt: str,
+                on_error: ErrorHandler, batch_size: int = BATCH_SIZE) -> int:
+    # ファイルを読み込んで登録し、登録できた行数を返す
+    batch = []
+    inserted = 0
+    for line_no, record in read_records(f, fmt):
+        if record is None:
+            on_error(line_no, 'invalid-record')
+            continue
+        batch.append((line_no, record))
+        if len(batch) >= batch_size:
+            inserted += import_batch(con, kind, batch, on_error)
+            batch = []
+    if batch:
+        inserted += import_batch(con, kind, batch, on_error)
+    return inserted
+
+
+def import_batch(con: sqlite3.Connection, kind: str,
+                 batch: list[tuple[int, dict[str, str]]], on_error: ErrorHandler) -> int:
+    check, insert = IMPORTERS[kind]
+    cur = con.cursor()
+    rows = []
+    lines = []
+    for line_no, code, row in check(cur, batch):
+        if code is not None:
+            on_error(line_no, code)
+        else:
+            rows.append(row)
+            lines.append(line_no)
+    if not rows:
+        return 0
+    # シャードに分けている場合は他の書き込みと同じくカタログから順にロックを取る
+    # （分けていなければ最初の書き込みで始まる暗黙のトランザクションに任せる）
+    begin = shards.begin_write if shards.shard_schemas(cur) else None
+    try:
+        # ロックが取れなかった場合はバッチごとやり直す
+        run_transaction(con, lambda cur: insert(cur, rows), begin=begin)
+    except sqlite3.Error:
+        # どの行が原因か分からないので、1 行ずつ入れ直してエラーの行を特定する
+        con.rollback()
+        inserted = 0
+        if begin is not None:
+            begin(cur)
+        else:
+            cur.execute('BEGIN')
+        for line_no, row in zip(lines, rows):
+            cur.execute('SAVEPOINT import_row')
+            try:
+                insert(cur, [row])
+            except sqlite3.Error:
+                cur.execute('ROLLBACK TO import_row')
+                on_error(line_no, 'database-error')
+            else:
+                inserted += 1
+            cur.execute('RELEASE import_row')
+        con.commit()
+        return inserted
+    return len(rows)
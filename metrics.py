@@ -0,0 +1,180 @@
+# リクエストごとの計測（SQL・テンプレート・接続の取得・リクエスト全体）
+# 計測値はヒストグラムに集計し、Prometheus のテキスト形式で出力する
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable
+
+
+# 秒単位のヒストグラムの区切り
+DURATION_BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 件数のヒストグラムの区切り
+COUNT_BUCKETS: tuple[float, ...] = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# 1 つのヒストグラムが持つラベルの組み合わせの上限（超えた分は 'other' にまとめる）
+MAX_SERIES: int = 500
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str,
+                 buckets: tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.label = label  # ラベル名（値は observe で渡す）
+        self.buckets = buckets
+        # ラベルの値 -> (区切りごとの件数, 合計, 件数)
+        self._series: dict[str, tuple[list[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                if len(self._series) >= MAX_SERIES:
+                    label_value = 'other'
+                    series = self._series.get(label_value)
+                if series is None:
+                    series = ([0] * len(self.buckets), 0.0, 0)
+            counts, total, count = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._series[label_value] = (counts, total + value, count + 1)
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._series.items())
+        for label_value, (counts, total, count) in series:
+            label = f'{self.label}="{escape_label(label_value)}"'
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.request_duration = Histogram(
+            'library_request_duration_seconds', 'リクエスト全体の処理時間', 'route')
+        self.request_queries = Histogram(
+            'library_request_queries', '1 リクエストで実行した SQL の数', 'route', COUNT_BUCKETS)
+        self.request_sql_duration = Histogram(
+            'library_request_sql_seconds', '1 リクエストの SQL の合計時間', 'route')
+        self.query_duration = Histogram(
+            'library_query_duration_seconds', 'SQL ごとの実行時間（取り出しを含む）', 'query')
+        self.template_duration = Histogram(
+            'library_template_render_seconds', 'テンプレートの描画時間', 'template')
+        self.connection_duration = Histogram(
+            'library_connection_acquire_seconds', 'プールから接続を借りるまでの時間', 'pool')
+        self.write_lock_wait = Histogram(
+            'library_write_lock_wait_seconds',
+            '書き込みロックを取るまでの時間（やり直しの待ちを含む）', 'route')
+        self.write_retries = Histogram(
+            'library_write_retries', 'ロックが取れずに書き込みをやり直した回数', 'route',
+            COUNT_BUCKETS)
+
+    def expose(self) -> str:
+        return ''.join(h.expose() for h in (
+            self.request_duration, self.request_queries, self.request_sql_duration,
+            self.query_duration, self.template_duration, self.connection_duration,
+            self.write_lock_wait, self.write_retries))
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r'\?(?:\s*,\s*\?)+')
+_SPACES = re.compile(r'\s+')
+
+
+def fingerprint(sql: str) -> str:
+    # 値だけが違う SQL を同じものとして数えるため、リテラルを ? に置き換え、
+    # (?, ?, ?) のような並びと空白をまとめる
+    sql = _LITERALS.sub('?', sql)
+    sql = _PLACEHOLDER_LISTS.sub('?+', sql)
+    return _SPACES.sub(' ', sql).strip()[:200]
+
+
+# 実行した SQL・パラメータ（executemany では None）・所要時間（秒）を受け取る関数
+QueryObserver = Callable[[str, Any, float], None]
+
+
+class TimedCursor(sqlite3.Cursor):
+    # execute と fetch* にかかった時間を接続へ報告する
+    # （SQLite は行を取り出す時に問い合わせを進めるので、取り出しも含めて数える）
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record(self, sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.record(self, sql, None, time.perf_counter() - started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.record(self, None, None, time.perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self.connection.record(self, None, None, time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.record(self, None, None, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    # cursor() と execute 系のショートカットが TimedCursor を使う接続
+    # 1 つの SQL の実行と取り出しの時間を合計し、次の SQL を実行した時か flush() で
+    # observer に渡す（observer が None なら計測しない）
+    observer: QueryObserver | None = None
+    _pending: list | None = None  # [カーソル, SQL, パラメータ, 秒]
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def record(self, cur: sqlite3.Cursor, sql: str | None, parameters: Any,
+               seconds: float) -> None:
+        # sql が None なら cur で実行中の SQL の取り出し
+        if self.observer is None:
+            return
+        pending = self._pending
+        if sql is None and pending is not None and pending[0] is cur:
+            pending[3] += seconds
+            return
+        self.flush()
+        if sql is not None:
+            self._pending = [cur, sql, parameters, seconds]
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, None
+        if pending is not None and self.observer is not None:
+            self.observer(pending[1], pending[2], pending[3])
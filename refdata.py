@@ -0,0 +1,52 @@
+# 参照データ（ジャンル・図書館・著者）のメモリ上のキャッシュ
+# 件数が少なくほとんど更新されないので、まとめて読み込んでおき、
+# DataVersion の更新回数が変わった時だけ読み直す
+import sqlite3
+import threading
+import time
+
+
+# テーブル -> (ID, 名前) を取り出す問い合わせ
+REFERENCE_TABLES: dict[str, str] = {
+    'Genre': 'SELECT GenreID, Name FROM Genre',
+    'Libraries': 'SELECT LibraryID, Name FROM Libraries',
+    'Authors': 'SELECT AuthorID, Name FROM Authors',
+}
+
+
+class ReferenceData:
+    def __init__(self, ttl: float = 60.0) -> None:
+        # DataVersion が無い（マイグレーション前の）データベースでは ttl 秒ごとに読み直す
+        self.ttl = ttl
+        self.genres: dict[int, str] = {}
+        self.libraries: dict[int, str] = {}
+        self.authors: dict[int, str] = {}
+        self._version: tuple | None = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, cur: sqlite3.Cursor) -> None:
+        version = self.current_version(cur)
+        if version is None:
+            if time.monotonic() - self._loaded_at < self.ttl:
+                return
+        elif version == self._version:
+            return
+        with self._lock:
+            tables = {table: dict(cur.execute(query).fetchall())
+                      for table, query in REFERENCE_TABLES.items()}
+            # 読み込み終わってから入れ替える（読み込み中の参照は古いデータのまま）
+            self.genres = tables['Genre']
+            self.libraries = tables['Libraries']
+            self.authors = tables['Authors']
+            self._version = version
+            self._loaded_at = time.monotonic()
+
+    def current_version(self, cur: sqlite3.Cursor) -> tuple | None:
+        try:
+            rows = cur.execute('SELECT Name, Version FROM DataVersion '
+                               "WHERE Name IN ('Genre', 'Libraries', 'Authors') "
+                               'ORDER BY Name').fetchall()
+        except sqlite3.OperationalError:
+            return None
+        return tuple(tuple(row) for row in rows)
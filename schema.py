@@ -0,0 +1,301 @@
+# データベースのスキーマ定義とマイグレーション
+# 適用済みのバージョンは PRAGMA user_version に記録する
+#
+#   python schema.py [データベースファイル]
+#   flask migrate
+import sqlite3
+import sys
+from typing import Callable
+
+from validation import parse_timestamp
+
+
+# 1: アプリが前提としているテーブル（既存のデータベースでは何もしない）
+SCHEMA_TABLES = '''
+CREATE TABLE IF NOT EXISTS Genre (
+    GenreID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Books (
+    BookID INTEGER PRIMARY KEY,
+    Title TEXT NOT NULL,
+    Year INTEGER,
+    GenreID INTEGER REFERENCES Genre (GenreID)
+);
+CREATE TABLE IF NOT EXISTS Libraries (
+    LibraryID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS Copies (
+    CopyID INTEGER PRIMARY KEY,
+    BookID INTEGER NOT NULL REFERENCES Books (BookID),
+    LibraryID INTEGER NOT NULL REFERENCES Libraries (LibraryID)
+);
+CREATE TABLE IF NOT EXISTS Authors (
+    AuthorID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL,
+    BirthYear INTEGER
+);
+CREATE TABLE IF NOT EXISTS CoAuthors (
+    BookID INTEGER NOT NULL REFERENCES Books (BookID),
+    AuthorID INTEGER NOT NULL REFERENCES Authors (AuthorID)
+);
+CREATE TABLE IF NOT EXISTS Users (
+    UserID INTEGER PRIMARY KEY,
+    Name TEXT NOT NULL,
+    Email TEXT,
+    PhoneNumber TEXT
+);
+CREATE TABLE IF NOT EXISTS Histories (
+    CopyID INTEGER NOT NULL REFERENCES Copies (CopyID),
+    UserID INTEGER NOT NULL REFERENCES Users (UserID),
+    BorrowTime TEXT NOT NULL,
+    ReturnTime TEXT
+);
+'''
+
+# 2: よく使う検索条件のインデックス
+SCHEMA_LOOKUP_INDEXES = '''
+CREATE INDEX IF NOT EXISTS CopiesBookID ON Copies (BookID, LibraryID);
+CREATE INDEX IF NOT EXISTS CoAuthorsBookID ON CoAuthors (BookID, AuthorID);
+CREATE INDEX IF NOT EXISTS HistoriesUserCopyBorrow
+    ON Histories (UserID, CopyID, BorrowTime);
+'''
+
+# 3: タイトルと名前の全文検索インデックス（trigram トークナイザ）
+SCHEMA_SEARCH_INDEXES = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS BooksFts USING fts5(
+    Title, content='Books', content_rowid='BookID', tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS UsersFts USING fts5(
+    Name, content='Users', content_rowid='UserID', tokenize='trigram');
+INSERT INTO BooksFts (BooksFts) VALUES ('rebuild');
+INSERT INTO UsersFts (UsersFts) VALUES ('rebuild');
+'''
+
+
+def data_version_triggers(tables: list[str]) -> str:
+    # テーブルが更新されるたびに DataVersion の該当行を 1 増やすトリガー
+    # （他のプロセスによる更新もこの値を見れば分かる）
+    script = ''.join(f"INSERT OR IGNORE INTO DataVersion (Name) VALUES ('{table}');\n"
+                     for table in tables)
+    for table in tables:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            script += (f'CREATE TRIGGER IF NOT EXISTS {table}{event.title()}Version '
+                       f'AFTER {event} ON {table} BEGIN\n'
+                       f"    UPDATE DataVersion SET Version = Version + 1 WHERE Name = '{table}';\n"
+                       'END;\n')
+    return script
+
+
+# 4: 参照データ（ジャンル・図書館・著者）の更新回数
+SCHEMA_REFERENCE_VERSION = '''
+CREATE TABLE IF NOT EXISTS DataVersion (
+    Name TEXT PRIMARY KEY,
+    Version INTEGER NOT NULL DEFAULT 0
+);
+''' + data_version_triggers(['Genre', 'Libraries', 'Authors'])
+
+# 5: 貸し出し中（未返却）の蔵書は 1 冊につき 1 件だけ
+#    部分インデックスなので貸し出し中かどうかをこのインデックスだけで引ける
+def create_open_loan_index(cur: sqlite3.Cursor) -> None:
+    duplicated = cur.execute('SELECT CopyID FROM Histories WHERE ReturnTime IS NULL '
+                             'GROUP BY CopyID HAVING COUNT(*) > 1').fetchall()
+    if duplicated:
+        copy_ids = ', '.join(str(row[0]) for row in duplicated)
+        raise ValueError('返却されていない貸し出しが複数ある蔵書があります '
+                         f'（CopyID: {copy_ids}）- 先に返却日を登録してください')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS HistoriesOpenLoan '
+                'ON Histories (CopyID) WHERE ReturnTime IS NULL')
+
+
+# 6: 本・蔵書・ユーザー・貸し出し履歴の更新回数（API の ETag に使う）
+SCHEMA_DATA_VERSION = data_version_triggers(['Books', 'Copies', 'CoAuthors', 'Users', 'Histories'])
+
+# 7: 古い貸し出し履歴の移動先と、ユーザーごとの履歴を貸し出し日順に引くインデックス
+SCHEMA_HISTORY_ARCHIVE = '''
+CREATE TABLE IF NOT EXISTS HistoriesArchive (
+    CopyID INTEGER NOT NULL,
+    UserID INTEGER NOT NULL,
+    BorrowTime TEXT NOT NULL,
+    ReturnTime TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS HistoriesArchiveUserBorrow
+    ON HistoriesArchive (UserID, BorrowTime, CopyID);
+CREATE INDEX IF NOT EXISTS HistoriesUserBorrow ON Histories (UserID, BorrowTime, CopyID);
+''' + data_version_triggers(['HistoriesArchive'])
+
+# 8: 貸し出し日・返却日を 'YYYY-MM-DD HH:MM:SS' にそろえ、日時で引くインデックスを作る
+#    読めない値があれば何も変更せずに中止する
+CANONICAL_TIMESTAMP_GLOB = '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9]'
+
+SCHEMA_TIMESTAMP_INDEXES = '''
+CREATE INDEX IF NOT EXISTS HistoriesBorrowTime ON Histories (BorrowTime);
+CREATE INDEX IF NOT EXISTS HistoriesReturnTime ON Histories (ReturnTime)
+    WHERE ReturnTime IS NOT NULL;
+CREATE INDEX IF NOT EXISTS HistoriesOpenBorrowTime ON Histories (BorrowTime, CopyID)
+    WHERE ReturnTime IS NULL;
+'''
+
+
+def normalize_timestamps(cur: sqlite3.Cursor) -> None:
+    cur.connection.create_function('parse_timestamp', 1, parse_timestamp, deterministic=True)
+    columns = [('Histories', 'BorrowTime'), ('Histories', 'ReturnTime'),
+               ('HistoriesArchive', 'BorrowTime'), ('HistoriesArchive', 'ReturnTime')]
+    invalid = []
+    for table, column in columns:
+        invalid += cur.execute(f'SELECT DISTINCT {column} FROM {table} '
+                               f'WHERE {column} NOT GLOB ? AND parse_timestamp({column}) IS NULL '
+                               'LIMIT 20', (CANONICAL_TIMESTAMP_GLOB,)).fetchall()
+    if invalid:
+        values = ', '.join(repr(row[0]) for row in invalid[:20])
+        raise ValueError('日時として読めない貸し出し日・返却日があります '
+                         f'（{values}）- YYYY-MM-DD HH:MM:SS の形に直してください')
+    for table, column in columns:
+        cur.execute(f'UPDATE {table} SET {column} = parse_timestamp({column}) '
+                    f'WHERE {column} NOT GLOB ?', (CANONICAL_TIMESTAMP_GLOB,))
+    for statement in split_statements(SCHEMA_TIMESTAMP_INDEXES):
+        cur.execute(statement)
+
+
+# 9: 本・図書館・ジャンルごとの貸し出し統計（既存の貸し出し履歴から集計して作る）
+SCHEMA_LOAN_STATS = '''
+CREATE TABLE IF NOT EXISTS BookLoanStats (
+    BookID INTEGER PRIMARY KEY,
+    LoanCount INTEGER NOT NULL DEFAULT 0,
+    OpenCount INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS BookLoanStatsLoanCount ON BookLoanStats (LoanCount);
+CREATE TABLE IF NOT EXISTS LibraryLoanStats (
+    LibraryID INTEGER PRIMARY KEY,
+    LoanCount INTEGER NOT NULL DEFAULT 0,
+    OpenCount INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS GenreLoanStats (
+    GenreID INTEGER PRIMARY KEY,
+    LoanCount INTEGER NOT NULL DEFAULT 0,
+    OpenCount INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+# 集計は stats.rebuild と同じ内容だが、後で stats.py が変わってもこのバージョンで作る
+# 内容が変わらないよう、この時点の SQL をここに固定しておく
+# （HistoriesArchive はバージョン 7 で作られている）
+LOAN_STATS_BACKFILL = '''
+INSERT INTO BookLoanStats (BookID, LoanCount, OpenCount)
+SELECT c.BookID, COUNT(*), SUM(h.ReturnTime IS NULL)
+FROM (SELECT CopyID, ReturnTime FROM Histories
+      UNION ALL SELECT CopyID, ReturnTime FROM HistoriesArchive) h
+JOIN Copies c ON c.CopyID = h.CopyID
+JOIN Books b ON b.BookID = c.BookID
+WHERE c.BookID IS NOT NULL GROUP BY c.BookID;
+INSERT INTO LibraryLoanStats (LibraryID, LoanCount, OpenCount)
+SELECT c.LibraryID, COUNT(*), SUM(h.ReturnTime IS NULL)
+FROM (SELECT CopyID, ReturnTime FROM Histories
+      UNION ALL SELECT CopyID, ReturnTime FROM HistoriesArchive) h
+JOIN Copies c ON c.CopyID = h.CopyID
+JOIN Books b ON b.BookID = c.BookID
+WHERE c.LibraryID IS NOT NULL GROUP BY c.LibraryID;
+INSERT INTO GenreLoanStats (GenreID, LoanCount, OpenCount)
+SELECT b.GenreID, COUNT(*), SUM(h.ReturnTime IS NULL)
+FROM (SELECT CopyID, ReturnTime FROM Histories
+      UNION ALL SELECT CopyID, ReturnTime FROM HistoriesArchive) h
+JOIN Copies c ON c.CopyID = h.CopyID
+JOIN Books b ON b.BookID = c.BookID
+WHERE b.GenreID IS NOT NULL GROUP BY b.GenreID;
+'''
+
+
+def create_loan_stats(cur: sqlite3.Cursor) -> None:
+    for statement in split_statements(SCHEMA_LOAN_STATS):
+        cur.execute(statement)
+    for table in ('BookLoanStats', 'LibraryLoanStats', 'GenreLoanStats'):
+        cur.execute(f'DELETE FROM {table}')
+    for statement in split_statements(LOAN_STATS_BACKFILL):
+        cur.execute(statement)
+
+
+# 10: 著者ごとの本を引くインデックス（著者ページで CoAuthors を全件走査しないように）
+SCHEMA_AUTHOR_INDEX = '''
+CREATE INDEX IF NOT EXISTS CoAuthorsAuthorID ON CoAuthors (AuthorID, BookID);
+'''
+
+
+# (バージョン, SQL 文またはカーソルを受け取る関数) の一覧
+# 既存のマイグレーションは書き換えず、末尾に追加していくこと
+MIGRATIONS: list[tuple[int, str | Callable[[sqlite3.Cursor], None]]] = [
+    (1, SCHEMA_TABLES),
+    (2, SCHEMA_LOOKUP_INDEXES),
+    (3, SCHEMA_SEARCH_INDEXES),
+    (4, SCHEMA_REFERENCE_VERSION),
+    (5, create_open_loan_index),
+    (6, SCHEMA_DATA_VERSION),
+    (7, SCHEMA_HISTORY_ARCHIVE),
+    (8, normalize_timestamps),
+    (9, create_loan_stats),
+    (10, SCHEMA_AUTHOR_INDEX),
+]
+
+
+def current_version(con: sqlite3.Connection) -> int:
+    return con.execute('PRAGMA user_version').fetchone()[0]
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0]
+
+
+def migrate(con: sqlite3.Connection, target: int | None = None) -> list[int]:
+    # 未適用のマイグレーションを順に（target が指定されればそのバージョンまで）適用し、
+    # 適用したバージョンを返す
+    # 1 バージョンずつ 1 トランザクションで適用する
+    applied = []
+    for version, step in MIGRATIONS:
+        if version <= current_version(con):
+            continue
+        if target is not None and version > target:
+            break
+        cur = con.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            if callable(step):
+                step(cur)
+            else:
+                for statement in split_statements(step):
+                    cur.execute(statement)
+            cur.execute(f'PRAGMA user_version = {version}')
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+        applied.append(version)
+    return applied
+
+
+def split_statements(script: str) -> list[str]:
+    # executescript は暗黙にコミットするので、1 文ずつに分けて実行する
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    return statements
+
+
+def main(argv: list[str]) -> None:
+    database = argv[1] if len(argv) > 1 else 'sample.db'
+    con = sqlite3.connect(database, isolation_level=None)
+    try:
+        applied = migrate(con)
+    finally:
+        con.close()
+    if applied:
+        print(f'{database}: バージョン {applied[-1]} まで更新しました')
+    else:
+        print(f'{database}: 最新です（バージョン {latest_version()}）')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
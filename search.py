@@ -0,0 +1,53 @@
+# 全文検索インデックス（FTS5）の管理
+import sqlite3
+
+
+# インデックス名 -> (テーブル, 行ID のカラム, 検索対象カラム)
+# 日本語は単語区切りが無いので trigram トークナイザで部分一致を引く
+SEARCH_INDEXES: dict[str, tuple[str, str, str]] = {
+    'BooksFts': ('Books', 'BookID', 'Title'),
+    'UsersFts': ('Users', 'UserID', 'Name'),
+}
+
+
+def has_search_index(cur: sqlite3.Cursor, index: str) -> bool:
+    # rebuild-search を実行していないデータベースでは LIKE 検索に戻す
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                       (index,)).fetchone() is not None
+
+
+def search_index_add(cur: sqlite3.Cursor, index: str, rowid: int, text: str) -> None:
+    if has_search_index(cur, index):
+        column = SEARCH_INDEXES[index][2]
+        cur.execute(f'INSERT INTO {index} (rowid, {column}) VALUES (?, ?)',
+                    (rowid, text))
+
+
+def search_index_add_many(cur: sqlite3.Cursor, index: str,
+                          rows: list[tuple[int, str]]) -> None:
+    # (行ID, 文字列) の一覧をまとめて登録する
+    if has_search_index(cur, index):
+        column = SEARCH_INDEXES[index][2]
+        cur.executemany(f'INSERT INTO {index} (rowid, {column}) VALUES (?, ?)', rows)
+
+
+def search_index_delete(cur: sqlite3.Cursor, index: str, rowid: int, text: str) -> None:
+    # 外部コンテンツ表なので削除時には登録した時の値を渡す必要がある
+    if has_search_index(cur, index):
+        column = SEARCH_INDEXES[index][2]
+        cur.execute(f"INSERT INTO {index} ({index}, rowid, {column}) VALUES ('delete', ?, ?)",
+                    (rowid, text))
+
+
+def search_match(text: str) -> str | None:
+    # ワイルドカードを含まず 3 文字以上（trigram の最小単位）なら MATCH 式を返す
+    if '%' in text or '_' in text or len(text) < 3:
+        return None
+    return '"' + text.replace('"', '""') + '"'
+
+
+def like_pattern(text: str) -> str:
+    # ワイルドカードの無い検索語は部分一致として扱う
+    if '%' in text or '_' in text:
+        return text
+    return f'%{text}%'
@@ -0,0 +1,223 @@
+# 図書館ごとのデータベースファイルへの分割（シャーディング）
+# 蔵書（Copies）と貸し出し履歴（Histories）を図書館ごとに library-<図書館番号>.db へ分け、
+# 本・ジャンル・著者・ユーザーなどは共通のカタログ（DATABASE）に残す
+# ある図書館の一括登録が書き込みロックを持っていても、他の図書館の貸し出しは止まらない
+#
+# 接続ごとにシャードを library_<図書館番号> として ATTACH し、同じ名前の一時ビュー
+# （カタログと全シャードの UNION ALL）で Copies・Histories を隠すので、読み取りの SQL は
+# 分割していない場合と同じまま全シャードを引ける（WHERE 句は各シャードのインデックスで引かれる）
+# 一時ビューには書き込めず、一時トリガーからも他のデータベースへは書き込めないので、
+# 書き込みは copies_table / histories_table などで書き込み先のテーブル名を求めて行う
+# （既にある貸し出し履歴の更新・削除は、その行を持つテーブルが蔵書の今の図書館とは限らないので
+#   all_tables の全てに対して行う）
+# シャードの無い図書館の蔵書はカタログの Copies・Histories にそのまま置く
+#
+# 注意:
+# - WAL モードでは複数のデータベースファイルにまたがるトランザクションの原子性は
+#   ファイルごとにしか保証されない（貸し出し統計とシャードの履歴がずれたら rebuild-stats で直す）
+# - ATTACH できる数には上限がある（通常 10）
+# - 分割した後のマイグレーションはカタログにしか適用されない
+# - Copies の主キー（CopyID）の一意性はファイルごとにしか保証されない。蔵書の追加は全て
+#   begin_write でカタログのロックを取った後に insert_copies で全シャードの重複を確かめる
+from contextlib import closing
+import json
+import os
+import re
+import sqlite3
+import urllib.parse
+
+
+CATALOG: str = 'catalog.db'
+
+# 分割するテーブル -> 一時ビューで使うカラム
+SHARDED_TABLES: dict[str, str] = {
+    'Copies': 'CopyID, BookID, LibraryID',
+    'Histories': 'CopyID, UserID, BorrowTime, ReturnTime',
+}
+
+# 接続全体に効く（データベースごとに設定しない）PRAGMA
+CONNECTION_PRAGMAS = ('busy_timeout',)
+
+SHARD_FILE = re.compile(r'library-(\d+)\.db')
+
+
+def shard_path(directory: str, library_id: int) -> str:
+    return os.path.join(directory, f'library-{library_id}.db')
+
+
+def shard_schema(library_id: int) -> str:
+    return f'library_{library_id}'
+
+
+def find_shards(directory: str) -> dict[int, str]:
+    # ディレクトリにあるシャード（図書館番号 -> ファイル）
+    shards = {}
+    for name in os.listdir(directory):
+        match = SHARD_FILE.fullmatch(name)
+        if match:
+            shards[int(match.group(1))] = os.path.join(directory, name)
+    return dict(sorted(shards.items()))
+
+
+def attach_shards(con: sqlite3.Connection, directory: str,
+                  pragmas: dict[str, str | int], readonly: bool = False) -> None:
+    # シャードを ATTACH し、Copies・Histories・DataVersion の一時ビューを作る
+    shards = find_shards(directory)
+    limit = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(shards) > limit:
+        raise ValueError(f'{directory}: シャードが {len(shards)} 個ありますが、'
+                         f'ATTACH できるのは {limit} 個までです')
+    for library_id, path in shards.items():
+        schema = shard_schema(library_id)
+        if readonly:
+            # 読み取り専用の接続は URI で開いているので、シャードも URI で読み取り専用にする
+            path = f'file:{urllib.parse.quote(path)}?mode=ro'
+        con.execute(f'ATTACH DATABASE ? AS {schema}', (path,))
+        for name, value in pragmas.items():
+            if name in CONNECTION_PRAGMAS or (readonly and name == 'journal_mode'):
+                continue
+            con.execute(f'PRAGMA {schema}.{name} = {value}')
+    schemas = ['main'] + [shard_schema(library_id) for library_id in shards]
+    for table, columns in SHARDED_TABLES.items():
+        con.execute(f'CREATE TEMP VIEW {table} AS ' + ' UNION ALL '.join(
+            f'SELECT {columns} FROM {schema}.{table}' for schema in schemas))
+    # 分割したテーブルの更新回数は全シャードの合計にする（どこが更新されても値が変わる）
+    names = ', '.join(f"'{table}'" for table in SHARDED_TABLES)
+    con.execute('CREATE TEMP VIEW DataVersion AS '
+                f'SELECT Name, Version FROM main.DataVersion WHERE Name NOT IN ({names}) '
+                'UNION ALL SELECT Name, SUM(Version) FROM (' + ' UNION ALL '.join(
+                    f'SELECT Name, Version FROM {schema}.DataVersion WHERE Name IN ({names})'
+                    for schema in schemas) + ') GROUP BY Name')
+
+
+def shard_schemas(cur: sqlite3.Cursor) -> dict[int, str]:
+    # この接続に ATTACH されているシャード（図書館番号 -> スキーマ名）
+    schemas = {}
+    for row in cur.execute('PRAGMA database_list').fetchall():
+        match = re.fullmatch(r'library_(\d+)', row[1])
+        if match:
+            schemas[int(match.group(1))] = row[1]
+    return schemas
+
+
+def copies_tables(cur: sqlite3.Cursor, library_ids: set[int]) -> dict[int, str]:
+    # 図書館番号 -> 蔵書を書き込むテーブル
+    schemas = shard_schemas(cur)
+    return {library_id: f'{schemas.get(library_id, "main")}.Copies' for library_id in library_ids}
+
+
+def copies_table(cur: sqlite3.Cursor, library_id: int) -> str:
+    return copies_tables(cur, {library_id})[library_id]
+
+
+def histories_tables(cur: sqlite3.Cursor, copy_ids: list[int | str]) -> dict[int | str, str]:
+    # 蔵書番号 -> 新しい貸し出し履歴を挿入するテーブル（蔵書のある図書館のシャード）
+    # （フォームの値のままの蔵書番号も受け付ける。見つからない蔵書はカタログ）
+    # 既にある履歴の更新・削除には使わない（蔵書を削除した後の履歴はシャードに残っている）
+    schemas = shard_schemas(cur)
+    if not schemas:
+        return {copy_id: 'main.Histories' for copy_id in copy_ids}
+    libraries = {str(row[0]): row[1] for row in cur.execute(
+        'SELECT CopyID, LibraryID FROM Copies WHERE CopyID IN (SELECT value FROM json_each(?))',
+        (json.dumps(copy_ids),))}
+    return {copy_id: f'{schemas.get(libraries.get(str(copy_id)), "main")}.Histories'
+            for copy_id in copy_ids}
+
+
+def histories_table(cur: sqlite3.Cursor, copy_id: int | str) -> str:
+    return histories_tables(cur, [copy_id])[copy_id]
+
+
+def begin_write(cur: sqlite3.Cursor) -> None:
+    # 書き込みのトランザクションを始め、先にカタログの書き込みロックを取る
+    # BEGIN IMMEDIATE は ATTACH した全てのシャードもロックしてしまうので、カタログにだけ
+    # 何も変えない書き込みをしてロックする。書き込みは全てカタログ・シャードの順にロックを
+    # 取るので、互いに相手のロックを待ってデッドロックすることはない
+    # （カタログのロックを持っている間は他の書き込みが無いので、全シャードの重複を確かめられる）
+    cur.execute('BEGIN')
+    cur.execute('UPDATE main.DataVersion SET Version = Version WHERE 0')
+
+
+def insert_copies(cur: sqlite3.Cursor, rows: list[tuple[int, int, int]]) -> None:
+    # 蔵書 (CopyID, BookID, LibraryID) を図書館のシャードごとにまとめて挿入する
+    # シャードに分けている場合は begin_write で始めたトランザクションの中で呼ぶこと
+    # （主キーはファイルごとにしか効かないので、全シャードに同じ蔵書番号が無いことを確かめ、
+    #   あれば主キーの重複と同じく sqlite3.IntegrityError を送出する）
+    if shard_schemas(cur):
+        copy_ids = sorted({row[0] for row in rows})
+        duplicate = cur.execute(
+            f'SELECT CopyID FROM Copies WHERE CopyID IN ({", ".join("?" * len(copy_ids))}) '
+            'LIMIT 1', copy_ids).fetchone()
+        if duplicate is not None:
+            raise sqlite3.IntegrityError(f'UNIQUE constraint failed: Copies.CopyID ({duplicate[0]})')
+    tables = copies_tables(cur, {row[2] for row in rows})
+    for table in sorted(set(tables.values())):
+        cur.executemany(f'INSERT INTO {table} (CopyID, BookID, LibraryID) VALUES (?, ?, ?)',
+                        [row for row in rows if tables[row[2]] == table])
+
+
+def all_tables(cur: sqlite3.Cursor, table: str) -> list[str]:
+    # カタログと全シャードの table
+    return [f'{schema}.{table}' for schema in ['main', *shard_schemas(cur).values()]]
+
+
+def split_database(con: sqlite3.Connection, directory: str,
+                   library_ids: list[int] | None = None) -> dict[int, tuple[int, int]]:
+    # con のデータベースを directory へカタログとシャードに分けて書き出し、
+    # 図書館番号 -> (蔵書の件数, 貸し出し履歴の件数) を返す（元のデータベースは変更しない）
+    # library_ids を省略すると蔵書のある全ての図書館を分ける
+    os.makedirs(directory, exist_ok=True)
+    catalog = os.path.join(directory, CATALOG)
+    if os.path.exists(catalog) or find_shards(directory):
+        raise FileExistsError(f'{directory}: 既にカタログかシャードがあります')
+    if library_ids is None:
+        library_ids = [row[0] for row in con.execute(
+            'SELECT DISTINCT LibraryID FROM Copies ORDER BY LibraryID')]
+    limit = con.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    if len(library_ids) > limit:
+        raise ValueError(f'図書館が {len(library_ids)} 館ありますが、'
+                         f'シャードにできるのは {limit} 館までです（library_ids で絞ってください）')
+
+    # シャードのテーブル・インデックス・トリガーは元のデータベースと同じものを作る
+    tables = ', '.join(f"'{table}'" for table in SHARDED_TABLES)
+    ddl = [row[0] for row in con.execute(
+        'SELECT sql FROM sqlite_master '
+        f"WHERE (tbl_name IN ({tables}) OR name = 'DataVersion') AND sql IS NOT NULL "
+        "ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END, name")]
+    con.execute('VACUUM INTO ?', (catalog,))
+
+    counts = {}
+    with closing(sqlite3.connect(catalog, isolation_level=None)) as cat:
+        cat.execute('PRAGMA journal_mode = WAL')
+        for library_id in library_ids:
+            path = shard_path(directory, library_id)
+            with closing(sqlite3.connect(path, isolation_level=None)) as shard:
+                shard.execute('PRAGMA journal_mode = WAL')
+                shard.execute('BEGIN')
+                for statement in ddl:
+                    shard.execute(statement)
+                shard.executemany('INSERT OR IGNORE INTO DataVersion (Name) VALUES (?)',
+                                  [(table,) for table in SHARDED_TABLES])
+                shard.execute('COMMIT')
+
+            cat.execute('ATTACH DATABASE ? AS shard', (path,))
+            cat.execute('BEGIN')
+            copies = cat.execute('INSERT INTO shard.Copies (CopyID, BookID, LibraryID) '
+                                 'SELECT CopyID, BookID, LibraryID FROM main.Copies '
+                                 'WHERE LibraryID = ?', (library_id,)).rowcount
+            histories = cat.execute(
+                'INSERT INTO shard.Histories (CopyID, UserID, BorrowTime, ReturnTime) '
+                'SELECT CopyID, UserID, BorrowTime, ReturnTime FROM main.Histories '
+                'WHERE CopyID IN (SELECT CopyID FROM main.Copies WHERE LibraryID = ?)',
+                (library_id,)).rowcount
+            cat.execute('DELETE FROM main.Histories '
+                        'WHERE CopyID IN (SELECT CopyID FROM main.Copies WHERE LibraryID = ?)',
+                        (library_id,))
+            cat.execute('DELETE FROM main.Copies WHERE LibraryID = ?', (library_id,))
+            cat.execute('COMMIT')
+            cat.execute('ANALYZE shard')
+            cat.execute('DETACH DATABASE shard')
+            counts[library_id] = (copies, histories)
+        cat.execute('VACUUM')
+        cat.execute('ANALYZE')
+    return counts
@@ -0,0 +1,170 @@
+# 遅い SQL の記録
+# しきい値を超えた SQL をパラメータと EXPLAIN QUERY PLAN の結果とともに
+# ローテーションするログファイルへ JSON で 1 行ずつ書き出し、
+# 管理画面用に SQL の種類（フィンガープリント）ごとの集計をメモリ上に持つ
+import json
+import logging
+import logging.handlers
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any
+
+
+# EXPLAIN QUERY PLAN を取る文（BEGIN や PRAGMA などは対象外）
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# SCAN しても全件走査とみなさないスキーマの表
+SCHEMA_TABLES = ('sqlite_master', 'sqlite_schema', 'sqlite_temp_master', 'sqlite_temp_schema')
+
+# ログに書くパラメータの文字列の長さの上限
+MAX_PARAMETER_LENGTH: int = 200
+
+
+def explain(con: sqlite3.Connection, sql: str, parameters: Any) -> list[str]:
+    # 実行計画の detail 列を、入れ子を字下げして返す（取れなければ空のリスト）
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return []
+    # 計測用のカーソルを通さないよう、素のカーソルで実行する
+    cur = sqlite3.Cursor(con)
+    try:
+        rows = cur.execute('EXPLAIN QUERY PLAN ' + sql,
+                           parameters if parameters is not None else ()).fetchall()
+    except (sqlite3.Error, ValueError):
+        return []
+    finally:
+        cur.close()
+    depth = {0: -1}
+    plan = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        plan.append('  ' * depth[node_id] + detail)
+    return plan
+
+
+def is_full_scan(plan: list[str]) -> bool:
+    # テーブル（またはインデックス全体）を先頭から読む SCAN があるか
+    # 次のものは実際のテーブルではないので除く
+    # ・全文検索の仮想テーブルと定数行
+    # ・副問い合わせや WITH の結果（SCAN (subquery-1) や CO-ROUTINE / MATERIALIZE で作った x の SCAN x）
+    # ・スキーマの表（sqlite_master / sqlite_schema）
+    derived = set()
+    for line in plan:
+        detail = line.strip()
+        if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE ')):
+            derived.add(detail.split(' ', 1)[1])
+    for line in plan:
+        detail = line.strip()
+        if not detail.startswith('SCAN ') or 'VIRTUAL TABLE' in detail:
+            continue
+        name = detail[len('SCAN '):].split(' USING ', 1)[0]
+        if (name == 'CONSTANT ROW' or name.startswith('(') or name in derived
+                or name.lower() in SCHEMA_TABLES):
+            continue
+        return True
+    return False
+
+
+def loggable(parameters: Any) -> Any:
+    if isinstance(parameters, dict):
+        return {k: loggable(v) for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [loggable(v) for v in parameters]
+    if isinstance(parameters, bytes):
+        return f'<{len(parameters)} bytes>'
+    if isinstance(parameters, str) and len(parameters) > MAX_PARAMETER_LENGTH:
+        return parameters[:MAX_PARAMETER_LENGTH] + '...'
+    return parameters
+
+
+class SlowQueryLog:
+    def __init__(self, path: str | None, max_bytes: int = 10 * 1024 * 1024,
+                 backup_count: int = 5, max_entries: int = 200) -> None:
+        self.max_entries = max_entries  # 集計する SQL の種類の上限（超えたら合計時間の短いものから捨てる）
+        # フィンガープリント -> 集計
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(f'{__name__}.{id(self)}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if path:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+
+    def record(self, key: str, sql: str, parameters: Any, seconds: float,
+               plan: list[str], route: str) -> None:
+        full_scan = is_full_scan(plan)
+        self._logger.info(json.dumps({
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'route': route,
+            'ms': round(seconds * 1000, 3),
+            'full_scan': full_scan,
+            'sql': sql,
+            'parameters': loggable(parameters),
+            'plan': plan,
+        }, ensure_ascii=False, default=str))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    del self._entries[min(self._entries,
+                                          key=lambda k: self._entries[k]['total'])]
+                entry = self._entries[key] = {'query': key, 'count': 0, 'total': 0.0,
+                                              'max': 0.0, 'routes': set()}
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['routes'].add(route)
+            entry['full_scan'] = full_scan
+            entry['plan'] = plan
+            if seconds >= entry['max']:
+                entry['max'] = seconds
+                entry['parameters'] = loggable(parameters)
+
+    def worst(self, limit: int = 50, order: str = 'total') -> list[dict[str, Any]]:
+        # 合計時間（order='max' なら最大時間、'count' なら回数）の大きい順
+        with self._lock:
+            entries = [dict(entry, routes=sorted(entry['routes']))
+                       for entry in self._entries.values()]
+        entries.sort(key=lambda entry: entry[order], reverse=True)
+        return entries[:limit]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def main(argv: list[str]) -> None:
+    # ユーザーの履歴のページ（/users/<id>）の文の実行計画を取り、is_full_scan の判定を確かめる
+    #   python slowlog.py library.db
+    # 副問い合わせの SCAN などを全件走査と誤って判定したら終了コード 1
+    from app import history_page_queries, loan_page_query
+
+    database = argv[1] if len(argv) > 1 else 'sample.db'
+    con = sqlite3.connect(database)
+    try:
+        queries = history_page_queries(con.cursor())
+        failed = False
+        for has_cursor in (False, True):
+            sql = loan_page_query(queries, 'DESC', has_cursor)
+            parameters = (1, '2000-01-01 00:00:00', 0) if has_cursor else (1,)
+            plan = explain(con, sql, (parameters + (11,)) * len(queries) + (11,))
+            print('\n'.join(plan))
+            if not plan or is_full_scan(plan):
+                print('-> 全件走査と判定されました（インデックスを使う文のはず）')
+                failed = True
+        # 実際のテーブルを先頭から読む文は全件走査と判定する
+        if not is_full_scan(explain(con, 'SELECT * FROM Histories', ())):
+            print('-> SELECT * FROM Histories が全件走査と判定されませんでした')
+            failed = True
+    finally:
+        con.close()
+    if failed:
+        sys.exit(1)
+    print(f'{database}: ユーザーの履歴の文は全件走査と判定されませんでした')
+
+
+if __name__ == '__main__':
+    main(sys.argv)
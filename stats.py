@@ -0,0 +1,66 @@
+# 貸し出し統計の集計表
+# 本・図書館・ジャンルごとの貸し出し回数と貸し出し中の冊数を、貸し出し・返却・履歴の削除と
+# 同じトランザクションで増減させておく（統計画面で Histories を集計しなくて済むように）
+# 集計先は蔵書の現在の本・図書館・ジャンル。ずれた場合は rebuild で作り直す
+import json
+import sqlite3
+
+from db import has_table
+
+
+# 集計表 -> (キーのカラム, 蔵書 c・本 b から求めるキー)
+ROLLUPS: dict[str, tuple[str, str]] = {
+    'BookLoanStats': ('BookID', 'c.BookID'),
+    'LibraryLoanStats': ('LibraryID', 'c.LibraryID'),
+    'GenreLoanStats': ('GenreID', 'b.GenreID'),
+}
+
+
+def add_loans(cur: sqlite3.Cursor, copy_ids: list[int], loans: int, open_loans: int) -> None:
+    # copy_ids の蔵書 1 件ごとに、貸し出し回数を loans、貸し出し中の冊数を open_loans ずつ増やす
+    # （負の値なら減らす。同じ蔵書が複数回あればその回数分）
+    if not copy_ids or not has_table(cur, 'BookLoanStats'):
+        return
+    # 蔵書は先に蔵書番号の並びで絞ってから JOIN する
+    # （図書館ごとのシャードに分けている場合も、各シャードの主キーで引かれるように）
+    unique_ids = sorted(set(copy_ids))
+    copies = ('(SELECT CopyID, BookID, LibraryID FROM Copies '
+              f'WHERE CopyID IN ({", ".join("?" * len(unique_ids))})) c')
+    for table, (column, key) in ROLLUPS.items():
+        cur.execute(f'INSERT INTO {table} ({column}, LoanCount, OpenCount) '
+                    f'SELECT {key}, COUNT(*) * ?, COUNT(*) * ? FROM json_each(?) j '
+                    f'JOIN {copies} ON c.CopyID = j.value '
+                    'JOIN Books b ON b.BookID = c.BookID '
+                    f'WHERE {key} IS NOT NULL GROUP BY {key} '
+                    f'ON CONFLICT ({column}) DO UPDATE SET '
+                    'LoanCount = LoanCount + excluded.LoanCount, '
+                    'OpenCount = OpenCount + excluded.OpenCount',
+                    (loans, open_loans, json.dumps(copy_ids), *unique_ids))
+
+
+def record_borrows(cur: sqlite3.Cursor, copy_ids: list[int]) -> None:
+    add_loans(cur, copy_ids, 1, 1)
+
+
+def record_returns(cur: sqlite3.Cursor, copy_ids: list[int]) -> None:
+    add_loans(cur, copy_ids, 0, -1)
+
+
+def record_deleted_loans(cur: sqlite3.Cursor, copy_ids: list[int], open_copy_ids: list[int]) -> None:
+    # 削除した貸し出し履歴の分を減らす（open_copy_ids は削除したうち返却されていなかったもの）
+    add_loans(cur, copy_ids, -1, 0)
+    add_loans(cur, open_copy_ids, 0, -1)
+
+
+def rebuild(cur: sqlite3.Cursor) -> None:
+    # 貸し出し履歴（移動済みのものを含む）から集計し直す
+    histories = 'SELECT CopyID, ReturnTime FROM Histories'
+    if has_table(cur, 'HistoriesArchive'):
+        histories += ' UNION ALL SELECT CopyID, ReturnTime FROM HistoriesArchive'
+    for table, (column, key) in ROLLUPS.items():
+        cur.execute(f'DELETE FROM {table}')
+        cur.execute(f'INSERT INTO {table} ({column}, LoanCount, OpenCount) '
+                    f'SELECT {key}, COUNT(*), SUM(h.ReturnTime IS NULL) FROM ({histories}) h '
+                    'JOIN Copies c ON c.CopyID = h.CopyID '
+                    'JOIN Books b ON b.BookID = c.BookID '
+                    f'WHERE {key} IS NOT NULL GROUP BY {key}')
@@ -0,0 +1,204 @@
+# 複数プロセスからの同時書き込みの負荷試験
+# gunicorn のワーカーと同じくプロセスごとにアプリケーションを読み込み、同じデータベースへ
+# ユーザー追加・蔵書追加・貸し出し・返却を同時に送る
+# 最後に、成功を返した書き込みが全てデータベースに残っているか（書き込みが失われていないか）を
+# 確かめ、ロックの待ち時間（/metrics の library_write_lock_wait_seconds）を表示する
+# データを追加するので、gen_data.py で作った試験用のデータベースで実行すること
+#
+#   python gen_data.py stress.db
+#   python stress.py stress.db --processes 4 --threads 4 --iterations 50
+#   python stress.py stress.db --writer-mode   # 書き込み専用スレッドでまとめてコミットする
+import argparse
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from bench import Dataset, Recorder, TestClient, percentile
+from db import connect
+
+
+# 処理結果コード（リダイレクト先の末尾）が期待どおりなら True
+def succeeded(location: str, code: str) -> bool:
+    return location.rstrip('/').endswith('/' + code)
+
+
+def metric_sum(text: str, name: str) -> tuple[float, float]:
+    # Prometheus のテキスト形式から name の合計と件数を（全ラベルの分を足して）取り出す
+    total = count = 0.0
+    for line in text.splitlines():
+        match = re.match(rf'{name}_(sum|count)\{{.*\}} (\S+)$', line)
+        if match:
+            if match.group(1) == 'sum':
+                total += float(match.group(2))
+            else:
+                count += float(match.group(2))
+    return total, count
+
+
+def run_worker(options: dict) -> dict:
+    # 1 プロセス分の負荷をかけ、成功した書き込みと計測値を返す
+    from app import create_app
+    app = create_app({
+        'DATABASE': options['database'],
+        'SHARD_DIRECTORY': options['shard_directory'],
+        'WRITER_MODE': options['writer_mode'],
+        'METRICS_ENABLED': True,
+        'SLOW_QUERY_LOG': None,
+    })
+    client = TestClient(app)
+    recorder = Recorder()
+    lock = threading.Lock()
+    written: dict[str, list] = {'users': [], 'copies': [], 'loans': []}
+    rng = random.Random(options['seed'])
+
+    def flow(first_id: int) -> None:
+        for i in range(options['iterations']):
+            # ユーザーと蔵書の番号はプロセス・スレッドごとに重ならないよう割り当ててある
+            new_id = first_id + i
+            with lock:
+                book_id = rng.choice(options['book_ids'])
+                library_id = rng.choice(options['library_ids'])
+            steps = [
+                ('POST /user-add', '/user-add', 'user-added', {
+                    'user_id': new_id, 'name': f'負荷試験 {new_id}',
+                    'email_address': f'stress{new_id}@example.com', 'phone_number': ''}),
+                ('POST /copy-add', '/copy-add', 'copy-added', {
+                    'book_id': book_id, 'copy_id': new_id, 'library_id': library_id}),
+            ]
+            borrow_time = time.strftime('%Y-%m-%d %H:%M:%S')
+            steps.append(('POST /borrow-add', '/borrow-add', 'borrow-added', {
+                'user_id': new_id, 'copy_id': new_id, 'borrow_time': borrow_time}))
+            steps.append(('POST /return-add', '/return-add', 'return-added', {
+                'user_id': new_id, 'copy_id': new_id, 'borrow_time': borrow_time,
+                'return_time': borrow_time}))
+            done = 0
+            for route, path, code, form in steps:
+                started = time.perf_counter()
+                try:
+                    status, location = client('POST', path, form)
+                    ok = status < 400 and succeeded(location, code)
+                except Exception:
+                    ok = False
+                recorder.record(route, time.perf_counter() - started, ok)
+                if not ok:
+                    # 前の書き込みが失敗したら、それに続く書き込みは送らない
+                    break
+                done += 1
+            with lock:
+                if done >= 1:
+                    written['users'].append(new_id)
+                if done >= 2:
+                    written['copies'].append((new_id, library_id))
+                if done >= 3:
+                    written['loans'].append((new_id, borrow_time, borrow_time if done >= 4 else None))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(options['threads']) as executor:
+        for future in [executor.submit(flow, options['first_id'] + t * options['iterations'])
+                       for t in range(options['threads'])]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    metrics = app.test_client().get('/metrics').get_data(as_text=True)
+    lock_wait, writes = metric_sum(metrics, 'library_write_lock_wait_seconds')
+    retries, _ = metric_sum(metrics, 'library_write_retries')
+    return {'written': written, 'latencies': recorder.latencies, 'errors': recorder.errors,
+            'elapsed': elapsed, 'lock_wait': lock_wait, 'writes': writes, 'retries': retries}
+
+
+def find_lost_writes(database: str, shard_directory: str | None,
+                     written: dict[str, list]) -> list[str]:
+    # 成功を返したのにデータベースに無い（または内容が違う）書き込み
+    lost = []
+    con = connect(database, {}, shard_directory=shard_directory)
+    try:
+        for user_id in written['users']:
+            if con.execute('SELECT 1 FROM Users WHERE UserID = ?', (user_id,)).fetchone() is None:
+                lost.append(f'ユーザー {user_id}')
+        for copy_id, library_id in written['copies']:
+            row = con.execute('SELECT LibraryID FROM Copies WHERE CopyID = ?',
+                              (copy_id,)).fetchone()
+            if row is None or row[0] != library_id:
+                lost.append(f'蔵書 {copy_id}')
+        for copy_id, borrow_time, return_time in written['loans']:
+            row = con.execute('SELECT ReturnTime FROM Histories '
+                              'WHERE CopyID = ? AND UserID = ? AND BorrowTime = ?',
+                              (copy_id, copy_id, borrow_time)).fetchone()
+            if row is None:
+                lost.append(f'貸し出し {copy_id}')
+            elif return_time is not None and row[0] != return_time:
+                lost.append(f'返却 {copy_id}')
+    finally:
+        con.close()
+    return lost
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='複数プロセスからの同時書き込みの負荷試験')
+    parser.add_argument('database', help='試験に使うデータベース（gen_data.py で作成。データを追加する）')
+    parser.add_argument('--processes', type=int, default=4, help='ワーカープロセスの数')
+    parser.add_argument('--threads', type=int, default=4, help='プロセスごとのスレッド数')
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='1 スレッドあたりの繰り返し回数（1 回でユーザー追加・蔵書追加・貸し出し・返却）')
+    parser.add_argument('--writer-mode', action='store_true', help='WRITER_MODE を有効にする')
+    parser.add_argument('--shard-directory',
+                        help='図書館ごとのシャードのディレクトリ（split-shards で作成）')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = Dataset(args.database, shard_directory=args.shard_directory)
+    per_process = args.threads * args.iterations
+    jobs = [{'database': args.database, 'shard_directory': args.shard_directory,
+             'writer_mode': args.writer_mode, 'threads': args.threads,
+             'iterations': args.iterations, 'first_id': data.next_id + p * per_process,
+             'book_ids': data.book_ids, 'library_ids': data.library_ids,
+             'seed': args.seed + p} for p in range(args.processes)]
+    # fork で親の状態を引き継がないよう、ワーカーは新しいプロセスで起動する
+    context = multiprocessing.get_context('spawn')
+    started = time.perf_counter()
+    with ProcessPoolExecutor(args.processes, mp_context=context) as executor:
+        results = list(executor.map(run_worker, jobs))
+    elapsed = time.perf_counter() - started
+
+    written: dict[str, list] = {'users': [], 'copies': [], 'loans': []}
+    latencies: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    for result in results:
+        for kind, items in result['written'].items():
+            written[kind].extend(items)
+        for route, values in result['latencies'].items():
+            latencies.setdefault(route, []).extend(values)
+        for route, count in result['errors'].items():
+            errors[route] = errors.get(route, 0) + count
+
+    print(f'{"ルート":<24} {"回数":>4} {"エラー":>3} {"req/s":>9} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for route, values in latencies.items():
+        values.sort()
+        print(f'{route:<27} {len(values):>6} {errors.get(route, 0):>6} '
+              f'{len(values) / elapsed:>9.1f} {percentile(values, 50) * 1000:>8.2f} '
+              f'{percentile(values, 95) * 1000:>8.2f} {percentile(values, 99) * 1000:>8.2f}')
+
+    lock_wait = sum(result['lock_wait'] for result in results)
+    writes = sum(result['writes'] for result in results)
+    retries = sum(result['retries'] for result in results)
+    print(f'書き込みのトランザクション: {writes:.0f} 回、やり直し: {retries:.0f} 回')
+    if writes:
+        print(f'ロックの待ち時間: 合計 {lock_wait:.3f} 秒、'
+              f'1 回あたり {lock_wait / writes * 1000:.2f} ms')
+
+    lost = find_lost_writes(args.database, args.shard_directory, written)
+    print(f'成功した書き込み: ユーザー {len(written["users"])} 件、蔵書 {len(written["copies"])} 件、'
+          f'貸し出し {len(written["loans"])} 件、失われた書き込み: {len(lost)} 件')
+    for item in lost[:20]:
+        print('失われた書き込み:', item)
+    if lost or errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# 入力補完用の前方一致インデックス
+# タイトル・著者名・ユーザー名を正規化した文字列の昇順リストで持ち、二分探索で前方一致を引く
+# 全角と半角・大文字と小文字は区別しない（NFKC 正規化と casefold）
+import bisect
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+# 種類 -> 読み込む問い合わせ（ID, 文字列）
+SOURCES: dict[str, str] = {
+    'books': 'SELECT BookID, Title FROM Books',
+    'authors': 'SELECT AuthorID, Name FROM Authors',
+    'users': 'SELECT UserID, Name FROM Users',
+}
+
+# 更新回数を見るテーブル
+SOURCE_TABLES: dict[str, str] = {'books': 'Books', 'authors': 'Authors', 'users': 'Users'}
+
+
+def normalize(s: str) -> str:
+    return unicodedata.normalize('NFKC', s).casefold()
+
+
+class PrefixIndex:
+    def __init__(self, max_entries: int = 1000000, max_key_length: int = 64) -> None:
+        self.max_entries = max_entries  # 1 種類あたりの件数の上限（超えた分は補完の対象外）
+        self.max_key_length = max_key_length  # 先頭からこの文字数だけで引く
+        self.truncated = False  # 上限のため登録しなかったものがあるか
+        self._keys: list[tuple[str, int]] = []  # (正規化した文字列, ID) の昇順
+        self._texts: dict[int, str] = {}  # ID -> 元の文字列
+        self._lock = threading.Lock()
+
+    def key(self, text: str) -> str:
+        return normalize(text)[:self.max_key_length]
+
+    def load(self, rows: list[tuple[int, str]]) -> None:
+        # 全件を入れ替える（作り終わってから差し替えるので、作っている間も引ける）
+        rows = [(id, text) for id, text in rows if text is not None]
+        truncated = len(rows) > self.max_entries
+        rows = rows[:self.max_entries]
+        keys = sorted((self.key(text), id) for id, text in rows)
+        texts = dict(rows)
+        with self._lock:
+            self._keys, self._texts, self.truncated = keys, texts, truncated
+
+    def add(self, id: int, text: str) -> None:
+        with self._lock:
+            if id in self._texts:
+                self._remove(id)
+            if len(self._texts) >= self.max_entries:
+                self.truncated = True
+                return
+            bisect.insort(self._keys, (self.key(text), id))
+            self._texts[id] = text
+
+    def remove(self, id: int) -> None:
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id: int) -> None:
+        text = self._texts.pop(id, None)
+        if text is None:
+            return
+        entry = (self.key(text), id)
+        i = bisect.bisect_left(self._keys, entry)
+        if i < len(self._keys) and self._keys[i] == entry:
+            del self._keys[i]
+
+    def search(self, prefix: str, limit: int) -> list[tuple[int, str]]:
+        # 前方一致する (ID, 文字列) を正規化した文字列の順に limit 件まで返す
+        prefix = self.key(prefix)
+        if not prefix:
+            return []
+        results = []
+        with self._lock:
+            i = bisect.bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and len(results) < limit:
+                key, id = self._keys[i]
+                if not key.startswith(prefix):
+                    break
+                results.append((id, self._texts[id]))
+                i += 1
+        return results
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+
+class Suggester:
+    # 種類ごとの PrefixIndex
+    # 自分のプロセスでの追加・削除はその場で反映し、他のプロセスによる更新は
+    # refresh_interval 秒ごとに DataVersion を見て読み直す
+    def __init__(self, max_entries: int = 1000000, max_key_length: int = 64,
+                 refresh_interval: float = 300.0) -> None:
+        self.refresh_interval = refresh_interval
+        self.indexes = {kind: PrefixIndex(max_entries, max_key_length) for kind in SOURCES}
+        self._versions: dict[str, int | None] = {}
+        self._checked_at = 0.0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def refresh(self, cur: sqlite3.Cursor) -> None:
+        # 初回は全件を読み込む。以降は refresh_interval 秒ごとに、更新されていれば読み直す
+        if self._loaded and time.monotonic() - self._checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if self._loaded and time.monotonic() - self._checked_at < self.refresh_interval:
+                return
+            versions = self.current_versions(cur)
+            for kind, query in SOURCES.items():
+                if not self._loaded or versions.get(kind) is None \
+                        or versions[kind] != self._versions.get(kind):
+                    self.indexes[kind].load(cur.execute(query).fetchall())
+            self._versions = versions
+            self._checked_at = time.monotonic()
+            self._loaded = True
+
+    def current_versions(self, cur: sqlite3.Cursor) -> dict[str, int | None]:
+        try:
+            rows = dict(cur.execute('SELECT Name, Version FROM DataVersion').fetchall())
+        except sqlite3.OperationalError:
+            rows = {}
+        return {kind: rows.get(table) for kind, table in SOURCE_TABLES.items()}
+
+    def add(self, kind: str, id: int, text: str) -> None:
+        if self._loaded:
+            self.indexes[kind].add(id, text)
+
+    def remove(self, kind: str, id: int) -> None:
+        if self._loaded:
+            self.indexes[kind].remove(id)
+
+    def invalidate(self) -> None:
+        # 一括登録の後などは次に使う時に全件を読み直す
+        self._loaded = False
+
+    def search(self, prefix: str, kinds: list[str], limit: int) -> list[dict]:
+        return [{'kind': kind, 'id': id, 'text': text}
+                for kind in kinds
+                for id, text in self.indexes[kind].search(prefix, limit)]
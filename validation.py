@@ -0,0 +1,53 @@
+# 入力値のチェック
+import datetime
+import re
+import unicodedata
+
+
+def has_control_character(s: str) -> bool:
+    return any(map(lambda c: unicodedata.category(c) == 'Cc', s))
+
+
+def split_ids(s: str) -> list[str]:
+    # カンマ・読点・空白・改行で区切られた番号の並びを分ける
+    return [item for item in re.split(r'[\s,、]+', s) if item]
+
+
+# 貸し出し日・返却日の保存形式（文字列の大小がそのまま日時の前後になる）
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_TIMESTAMP = re.compile(r'(\d{4})[-/年](\d{1,2})[-/月](\d{1,2})日?'
+                        r'(?:[ T]*(\d{1,2})[:時](\d{1,2})分?(?:[:](\d{1,2})(?:\.\d+)?秒?)?)?'
+                        r'\s*(Z|[+-]\d{2}:?\d{2})?')
+
+
+def format_timestamp(t: datetime.datetime) -> str:
+    return t.strftime(TIMESTAMP_FORMAT)
+
+
+def now_timestamp() -> str:
+    return format_timestamp(datetime.datetime.now())
+
+
+def parse_timestamp(s: str) -> str | None:
+    # 入力された日時を TIMESTAMP_FORMAT の文字列にそろえる（読めなければ None）
+    # 2024-04-01 / 2024/4/1 10:30 / 2024年4月1日 10時30分 / 2024-04-01T10:30:00+09:00 など
+    # 時差が付いていればこのサーバの時刻に直す
+    m = _TIMESTAMP.fullmatch(unicodedata.normalize('NFKC', s).strip())
+    if m is None:
+        return None
+    year, month, day, hour, minute, second, zone = m.groups()
+    try:
+        t = datetime.datetime(int(year), int(month), int(day),
+                              int(hour or 0), int(minute or 0), int(second or 0))
+        if zone is not None:
+            offset = datetime.timezone.utc
+            if zone != 'Z':
+                sign = -1 if zone[0] == '-' else 1
+                digits = zone[1:].replace(':', '')
+                offset = datetime.timezone(sign * datetime.timedelta(
+                    hours=int(digits[:2]), minutes=int(digits[2:])))
+            t = t.replace(tzinfo=offset).astimezone().replace(tzinfo=None)
+    except ValueError:
+        return None
+    return format_timestamp(t)
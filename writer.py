@@ -0,0 +1,113 @@
+# 書き込み専用スレッドによるグループコミット
+# 各リクエストの書き込み処理をキューに入れ、専用スレッドがまとめて
+# 1 つのトランザクションで実行してコミットする（書き込みロックの取り合いと fsync を減らす）
+# 書き込み処理ごとにセーブポイントを置くので、失敗した処理だけが取り消される
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable
+
+from db import begin_immediate, is_busy, run_transaction
+
+# カーソルを受け取って書き込みを行う関数（戻り値はそのまま呼び出し元へ返す）
+WriteJob = Callable[[sqlite3.Cursor], Any]
+
+
+class GroupCommitWriter:
+    def __init__(self, connect: Callable[[], sqlite3.Connection],
+                 max_batch: int = 64, max_wait: float = 0.001,
+                 begin: Callable[[sqlite3.Cursor], None] = begin_immediate,
+                 retries: int = 5, backoff: float = 0.01,
+                 observe: Callable[[float, int], None] | None = None) -> None:
+        self.connect = connect  # 書き込み用の接続を作る関数
+        self.max_batch = max_batch  # 1 回のコミットにまとめる書き込みの上限
+        self.max_wait = max_wait  # 後続の書き込みを待つ秒数
+        self.begin = begin  # トランザクションを始める関数（シャードに分けている場合は shards.begin_write）
+        self.retries = retries  # ロックが取れなかった時にまとめた書き込みをやり直す回数
+        self.backoff = backoff  # 最初にやり直すまでの秒数
+        self.observe = observe  # ロックを待った秒数とやり直した回数を受け取る関数
+        self._queue: queue.Queue[tuple[WriteJob, Future] | None] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                # 接続はここで作って書き込みスレッドへ渡す（WAL への切り替えなどを先に済ませる）
+                con = self.connect()
+                self._thread = threading.Thread(target=self._run, args=(con,),
+                                                name='group-commit-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def submit(self, job: WriteJob) -> Any:
+        # 書き込みを依頼し、コミットされるまで待って結果を返す
+        # （書き込み処理やコミットで起きた例外はここで送出される）
+        self.start()
+        future: Future = Future()
+        self._queue.put((job, future))
+        return future.result()
+
+    def _run(self, con: sqlite3.Connection) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # 続けて届いた書き込みを同じトランザクションにまとめる
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(con, batch)
+        con.close()
+
+    def _commit(self, con: sqlite3.Connection, batch: list[tuple[WriteJob, Future]]) -> None:
+        try:
+            results = run_transaction(con, lambda cur: self._run_jobs(cur, batch), self.begin,
+                                      self.retries, self.backoff, self.observe)
+        except sqlite3.Error as e:
+            # コミットできなかった場合はまとめた書き込みが全て失敗
+            for job, future in batch:
+                future.set_exception(e)
+            return
+        for future, result in results:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _run_jobs(self, cur: sqlite3.Cursor,
+                  batch: list[tuple[WriteJob, Future]]) -> list[tuple[Future, Any]]:
+        results = []
+        for job, future in batch:
+            cur.execute('SAVEPOINT job')
+            try:
+                result = job(cur)
+            except Exception as e:
+                if is_busy(e):
+                    # ロックが取れなかったのは書き込み処理のせいではないので、まとめてやり直す
+                    raise
+                # この書き込みだけを取り消す
+                cur.execute('ROLLBACK TO job')
+                cur.execute('RELEASE job')
+                results.append((future, e))
+            else:
+                cur.execute('RELEASE job')
+                results.append((future, result))
+        return results
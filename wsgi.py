@@ -0,0 +1,8 @@
+# 本番用の WSGI エントリポイント
+# データベースは LIBRARY_SETTINGS の設定ファイルか環境変数 LIBRARY_DATABASE で指定する
+#
+#   LIBRARY_DATABASE=/srv/library/library.db gunicorn -c gunicorn.conf.py wsgi:app
+from app import create_app
+
+
+app = create_app()